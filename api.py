@@ -1,41 +1,189 @@
+import os
+import sys
 from datetime import datetime
+from urllib.parse import parse_qsl
 
 from flask import Flask, jsonify, request
+from werkzeug.datastructures import MultiDict
 from flasgger import Swagger
 
 import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+
+#local libraries in src/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+from wxsketch import TDigest, merge_all
+from wxclimo import DOY_SQL
+from wxcoverage import COVERAGE_BITS, period_mask, missing_dates
+from wxdirectory import StationDirectory
+from wxtrends import TREND_VARIABLES, ROLLING_WINDOWS
+from wxhotpages import HotPages, accepted_encoding, compress, page_key, COMPRESS_MIN_BYTES
 
 app = Flask(__name__)
 swagger = Swagger(app)
 
 # Database connection parameters
 DB_HOST = "localhost"
-DB_NAME = "wxdata"
+DB_NAME = os.environ.get('WXDATA_DB', "wxdata")
 DB_USER = "web_user" #only has SELECT privileges
 DB_PASSWORD = ""
 DB_PORT = "5432"
+# Seconds a query of a pooled connection may run before the server cancels it
+STATEMENT_TIMEOUT_S = float(os.environ.get('WXAPI_STATEMENT_TIMEOUT', 30))
 
 # Pagination parameters
 DEFAULT_PAGE = 1
 DEFAULT_PER_PAGE = 10
 
+# Variables with quantile sketches in station_year_sketches
+SKETCH_VARIABLES = ['max_temperature', 'min_temperature', 'precipitation']
+
+# Sort orders of /api/weather/trends
+TREND_SORTS = {'slope_desc': "t.slope_per_year DESC NULLS LAST, t.station_id",
+               'slope_asc': "t.slope_per_year ASC NULLS LAST, t.station_id",
+               'station_id': "t.station_id"}
+
+# Pages always kept pre-serialized in memory ({last_year}: last year with data),
+# besides the most requested ones
+HOT_PAGE_SEEDS = ['/api/weather/stats?year={last_year}',
+                  '/api/weather/stats?year={last_year}&per_page=1000',
+                  '/api/weather/trends']
+
+# Downsampled series: approximate days per point at each resolution, finest first
+SERIES_RESOLUTIONS = {'day': 1., 'week': 7., 'month': 30.44, 'year': 365.25}
+DEFAULT_MAX_POINTS = 500
+
+# Connection pool of this process, set up by warm_up (served by gunicorn);
+# without it (debug server) every request opens its own connection
+db_pool = None
+
+def init_db_pool(minconn, maxconn, lazy=False):
+    """
+    Opens a pool of minconn (up to maxconn) database connections, with a
+    statement timeout of STATEMENT_TIMEOUT_S.  With lazy the connections are
+    opened on first use instead, and minconn of them are kept once opened.
+    """
+    global db_pool
+    db_pool = ThreadedConnectionPool(0 if lazy else minconn, maxconn,
+                                     host=DB_HOST,
+                                     database=DB_NAME,
+                                     user=DB_USER,
+                                     password=DB_PASSWORD,
+                                     port=DB_PORT,
+                                     options=f'-c statement_timeout={int(STATEMENT_TIMEOUT_S*1000)}')
+    #the pool keeps returned connections while it holds fewer than minconn
+    db_pool.minconn = minconn
+
 def connect_db():
-    """Connects to the PostgreSQL database."""
+    """Connects to the PostgreSQL database (takes a pooled connection if there is a pool)."""
     conn = None
     try:
-        conn = psycopg2.connect(host=DB_HOST,
-                                database=DB_NAME,
-                                user=DB_USER,
-                                password=DB_PASSWORD,
-                                port=DB_PORT)
+        if db_pool is not None:
+            conn = db_pool.getconn()
+            #read-only queries: no transaction left open between requests
+            conn.autocommit = True
+        else:
+            conn = psycopg2.connect(host=DB_HOST,
+                                    database=DB_NAME,
+                                    user=DB_USER,
+                                    password=DB_PASSWORD,
+                                    port=DB_PORT)
     except psycopg2.Error as e:
         print(f"Error connecting to database: {e}")
     return conn
 
 def close_db(conn):
-    """Closes the database connection."""
+    """Closes the database connection (returns it to the pool if there is one)."""
     if conn:
-        conn.close()
+        if db_pool is not None:
+            db_pool.putconn(conn)
+        else:
+            conn.close()
+
+# Station ids, dates and years with data, for rejecting requests without a query
+station_directory = StationDirectory(connect_db, release=close_db)
+
+def warm_up(threads):
+    """
+    Start-up of a serving process: opens a connection per request thread,
+    loads the station directory, builds the Swagger spec and starts building
+    the hot pages, so the first requests do not pay for them.
+    """
+    #one more connection than threads for the hot page builder
+    try:
+        init_db_pool(threads, threads + 1)
+    except psycopg2.Error as e:
+        #database not up yet: open the pooled connections on demand
+        print(f"Error connecting to database: {e}")
+        init_db_pool(threads, threads + 1, lazy=True)
+    station_directory.refresh(force=True)
+    with app.test_request_context():
+        swagger.get_apispecs()
+    hot_pages.refresh()
+
+@app.before_request
+def refresh_station_directory():
+    """Reloads the station directory if the data version changed."""
+    station_directory.refresh()
+
+def render_page(key):
+    """
+    Runs the view of a page key (path?query) without the request hooks.
+    Output:
+        status code, content type and body bytes of the response
+    """
+    with app.test_request_context(key):
+        response = app.make_response(app.dispatch_request())
+    return response.status_code, response.content_type, response.get_data()
+
+def hot_page_seeds():
+    """Page keys of HOT_PAGE_SEEDS for the current station directory."""
+    last_year = station_directory.last_year
+    if last_year is None:
+        return []
+    keys = []
+    for url in HOT_PAGE_SEEDS:
+        path, _, query = url.format(last_year=last_year).partition('?')
+        keys.append(page_key(path, MultiDict(parse_qsl(query))))
+    return keys
+
+# Most requested pages, serialized and compressed, rebuilt after ingest and stats runs
+hot_pages = HotPages(connect_db, render_page, seeds=hot_page_seeds, release=close_db)
+
+@app.before_request
+def serve_hot_page():
+    """Answers requests for hot pages straight from memory."""
+    if request.method != 'GET':
+        return None
+    hot_pages.refresh()
+    page = hot_pages.get(page_key(request.path, request.args))
+    if page is None:
+        return None
+    encoding = accepted_encoding(request.headers.get('Accept-Encoding'))
+    body = page.bodies.get(encoding)
+    response = app.response_class(body if body is not None else page.bodies[None],
+                                  content_type=page.content_type)
+    if body is not None and encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+@app.after_request
+def compress_response(response):
+    """Compresses responses of at least COMPRESS_MIN_BYTES as the client accepts."""
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = accepted_encoding(request.headers.get('Accept-Encoding'))
+    if encoding is None:
+        return response
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return response
+    response.set_data(compress(body, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
 
 def paginate(cursor, page, per_page):
     """Paginates the cursor results."""
@@ -45,6 +193,36 @@ def paginate(cursor, page, per_page):
     start = (page - 1) * per_page
     return cursor, page, per_page, start, per_page
 
+def empty_page():
+    """Response for a request that cannot match any rows."""
+    _, page, per_page, _, _ = paginate(None, DEFAULT_PAGE, DEFAULT_PER_PAGE)
+    return jsonify({
+        'items': [],
+        'page': page,
+        'per_page': per_page
+    })
+
+def run_query(query, params):
+    """
+    Runs a SELECT and returns its rows as a list of dicts keyed by column name.
+    Output:
+        items, error: error is None, or a (response, status) tuple to return
+    """
+    conn = connect_db()
+    if not conn:
+        return None, (jsonify({'error': 'Failed to connect to the database'}), 500)
+    cursor = conn.cursor()
+    try:
+        cursor.execute(query, tuple(params))
+        columns = [desc[0] for desc in cursor.description]
+        items = [dict(zip(columns, row)) for row in cursor.fetchall()]
+    except psycopg2.Error as e:
+        return None, (jsonify({'error': f"Database query error: {e}"}), 500)
+    finally:
+        cursor.close()
+        close_db(conn)
+    return items, None
+
 @app.route('/api/weather', methods=['GET'])
 def get_weather_data():
     """
@@ -101,6 +279,9 @@ def get_weather_data():
                     type: number
                     format: float
                     description: Total precipitation in mm
+                  qc_flags:
+                    type: integer
+                    description: QC flag bitmask (0 = passed all checks, see src/wxqc.py)
             page:
               type: integer
               description: Current page number
@@ -124,34 +305,41 @@ def get_weather_data():
               type: string
               description: Error message
     """
-    conn = connect_db()
-    if not conn:
-        return jsonify({'error': 'Failed to connect to the database'}), 500
-    cursor = conn.cursor()
-
     query = "SELECT * FROM station_data WHERE 1=1"
     conditions = []
     params = []
 
+    day = None
     date_str = request.args.get('date')
     if date_str:
         conditions.append("date = %s")
         try:
-            params.append(datetime.strptime(date_str, '%Y-%m-%d').date())
+            day = datetime.strptime(date_str, '%Y-%m-%d').date()
         except ValueError:
-            close_db(conn)
             return jsonify({'error': 'Invalid date format. Please use YYYY-MM-DD.'}), 400
+        params.append(day)
 
     station_id = request.args.get('station_id')
     if station_id:
         conditions.append("station_id = %s")
         params.append(station_id)
 
+    #nothing to find for unknown stations or dates outside the station's data
+    if station_id and not station_directory.has_station(station_id):
+        return empty_page()
+    if station_id and day and not station_directory.has_date(station_id, day):
+        return empty_page()
+
     if conditions:
         query += " AND " + " AND ".join(conditions)
 
     query += " ORDER BY date DESC, station_id LIMIT %s OFFSET %s"
 
+    conn = connect_db()
+    if not conn:
+        return jsonify({'error': 'Failed to connect to the database'}), 500
+    cursor = conn.cursor()
+
     cursor, page, per_page, start, limit = paginate(cursor, DEFAULT_PAGE, DEFAULT_PER_PAGE)
     params.append(limit)
     params.append(start)
@@ -161,7 +349,6 @@ def get_weather_data():
         columns = [desc[0] for desc in cursor.description]
         items = [dict(zip(columns, row)) for row in cursor.fetchall()]
     except psycopg2.Error as e:
-        close_db(conn)
         return jsonify({'error': f"Database query error: {e}"}), 500
     finally:
         cursor.close()
@@ -252,40 +439,45 @@ def get_weather_stats():
               type: string
               description: Error message
     """
-    conn = connect_db()
-    if not conn:
-        return jsonify({'error': 'Failed to connect to the database'}), 500
-    cursor = conn.cursor()
-
     query = "SELECT station_id, year, max_temperature_avg, min_temperature_avg, precipitation_accum FROM weather_stats WHERE 1=1"
     conditions = []
     params = []
 
+    year = None
     date_str = request.args.get('year')
     if date_str:
         conditions.append("year = %s")
         try:
             year = int(date_str)
-            if (year > 2014 or year < 1985):
-                raise ValueError()
-            params.append(year)
         except ValueError:
-            session.close()
-            return jsonify({'error': 'Invalid year.  Year must be between 1985 and 2014'}), 400
-        except TypeError:
-            session.close()
             return jsonify({'error': 'Invalid year.  Year must be an integer'}), 400
+        #valid years come from the data (station directory)
+        first_year, last_year = station_directory.first_year, station_directory.last_year
+        if first_year is not None and not first_year <= year <= last_year:
+            return jsonify({'error': f'Invalid year.  Year must be between {first_year} and {last_year}'}), 400
+        params.append(year)
 
     station_id = request.args.get('station_id')
     if station_id:
         conditions.append("station_id = %s")
         params.append(station_id)
 
+    #nothing to find for unknown stations or years outside the station's data
+    if station_id and not station_directory.has_station(station_id):
+        return empty_page()
+    if station_id and year is not None and not station_directory.covers_year(station_id, year):
+        return empty_page()
+
     if conditions:
         query += " AND " + " AND ".join(conditions)
 
     query += " ORDER BY year DESC, station_id LIMIT %s OFFSET %s"
 
+    conn = connect_db()
+    if not conn:
+        return jsonify({'error': 'Failed to connect to the database'}), 500
+    cursor = conn.cursor()
+
     cursor, page, per_page, start, limit = paginate(cursor, DEFAULT_PAGE, DEFAULT_PER_PAGE)
     params.append(limit)
     params.append(start)
@@ -295,7 +487,6 @@ def get_weather_stats():
         columns = [desc[0] for desc in cursor.description]
         items = [dict(zip(columns, row)) for row in cursor.fetchall()]
     except psycopg2.Error as e:
-        close_db(conn)
         return jsonify({'error': f"Database query error: {e}"}), 500
     finally:
         cursor.close()
@@ -307,5 +498,1401 @@ def get_weather_stats():
         'per_page': per_page
     })
 
+@app.route('/api/weather/stats/monthly', methods=['GET'])
+def get_weather_stats_monthly():
+    """
+    Get monthly weather statistics from GHCN stations
+    Allows filtering by year, month and station ID, and supports pagination.
+    ---
+    parameters:
+      - name: year
+        in: query
+        type: integer
+        description: Filter by year
+      - name: month
+        in: query
+        type: integer
+        description: Filter by month (1-12)
+      - name: station_id
+        in: query
+        type: string
+        description: Filter by station ID
+      - name: page
+        in: query
+        type: integer
+        default: 1
+        description: Page number for pagination
+      - name: per_page
+        in: query
+        type: integer
+        default: 10
+        description: Number of items per page
+    responses:
+      200:
+        description: A list of monthly weather statistics records
+        schema:
+          type: object
+          properties:
+            items:
+              type: array
+              items:
+                type: object
+                properties:
+                  station_id:
+                    type: string
+                    description: Station ID
+                  year:
+                    type: integer
+                    description: Year
+                  month:
+                    type: integer
+                    description: Month
+                  max_temperature_avg:
+                    type: number
+                    format: float
+                    description: Average maximum temperature in C
+                  min_temperature_avg:
+                    type: number
+                    format: float
+                    description: Average minimum temperature in C
+                  precipitation_accum:
+                    type: number
+                    format: float
+                    description: Total monthly precipitation in cm
+            page:
+              type: integer
+              description: Current page number
+            per_page:
+              type: integer
+              description: Number of items per page
+      400:
+        description: Invalid input (e.g., invalid month)
+        schema:
+          type: object
+          properties:
+            error:
+              type: string
+              description: Error message
+      500:
+        description: Database connection or query error
+        schema:
+          type: object
+          properties:
+            error:
+              type: string
+              description: Error message
+    """
+    query = ("SELECT station_id, year, month, max_temperature_avg, min_temperature_avg, "
+             "precipitation_accum FROM weather_stats_monthly WHERE 1=1")
+    conditions = []
+    params = []
+
+    for name, lo, hi in (('year', None, None), ('month', 1, 12)):
+        value = request.args.get(name)
+        if value:
+            try:
+                value = int(value)
+                if lo is not None and not lo <= value <= hi:
+                    raise ValueError()
+            except ValueError:
+                return jsonify({'error': f'Invalid {name}.'}), 400
+            conditions.append(f"{name} = %s")
+            params.append(value)
+
+    station_id = request.args.get('station_id')
+    if station_id:
+        if not station_directory.has_station(station_id):
+            return empty_page()
+        conditions.append("station_id = %s")
+        params.append(station_id)
+
+    if conditions:
+        query += " AND " + " AND ".join(conditions)
+
+    query += " ORDER BY year DESC, month DESC, station_id LIMIT %s OFFSET %s"
+
+    _, page, per_page, start, limit = paginate(None, DEFAULT_PAGE, DEFAULT_PER_PAGE)
+    params.append(limit)
+    params.append(start)
+
+    items, error = run_query(query, params)
+    if error:
+        return error
+
+    return jsonify({
+        'items': items,
+        'page': page,
+        'per_page': per_page
+    })
+
+@app.route('/api/weather/stats/seasonal', methods=['GET'])
+def get_weather_stats_seasonal():
+    """
+    Get seasonal weather statistics from GHCN stations
+    Allows filtering by year, season and station ID, and supports pagination.
+    The growing season is April-September.
+    ---
+    parameters:
+      - name: year
+        in: query
+        type: integer
+        description: Filter by year
+      - name: season
+        in: query
+        type: string
+        default: growing
+        description: Season name
+      - name: station_id
+        in: query
+        type: string
+        description: Filter by station ID
+      - name: page
+        in: query
+        type: integer
+        default: 1
+        description: Page number for pagination
+      - name: per_page
+        in: query
+        type: integer
+        default: 10
+        description: Number of items per page
+    responses:
+      200:
+        description: A list of seasonal weather statistics records
+        schema:
+          type: object
+          properties:
+            items:
+              type: array
+              items:
+                type: object
+                properties:
+                  station_id:
+                    type: string
+                    description: Station ID
+                  year:
+                    type: integer
+                    description: Year
+                  season:
+                    type: string
+                    description: Season name
+                  max_temperature_avg:
+                    type: number
+                    format: float
+                    description: Average maximum temperature in C
+                  min_temperature_avg:
+                    type: number
+                    format: float
+                    description: Average minimum temperature in C
+                  precipitation_accum:
+                    type: number
+                    format: float
+                    description: Total seasonal precipitation in cm
+            page:
+              type: integer
+              description: Current page number
+            per_page:
+              type: integer
+              description: Number of items per page
+      400:
+        description: Invalid input (e.g., invalid year)
+        schema:
+          type: object
+          properties:
+            error:
+              type: string
+              description: Error message
+      500:
+        description: Database connection or query error
+        schema:
+          type: object
+          properties:
+            error:
+              type: string
+              description: Error message
+    """
+    query = ("SELECT station_id, year, season, max_temperature_avg, min_temperature_avg, "
+             "precipitation_accum FROM weather_stats_seasonal WHERE season = %s")
+    conditions = []
+    params = [request.args.get('season', 'growing')]
+
+    year = request.args.get('year')
+    if year:
+        try:
+            params.append(int(year))
+        except ValueError:
+            return jsonify({'error': 'Invalid year.  Year must be an integer'}), 400
+        conditions.append("year = %s")
+
+    station_id = request.args.get('station_id')
+    if station_id:
+        if not station_directory.has_station(station_id):
+            return empty_page()
+        conditions.append("station_id = %s")
+        params.append(station_id)
+
+    if conditions:
+        query += " AND " + " AND ".join(conditions)
+
+    query += " ORDER BY year DESC, station_id LIMIT %s OFFSET %s"
+
+    _, page, per_page, start, limit = paginate(None, DEFAULT_PAGE, DEFAULT_PER_PAGE)
+    params.append(limit)
+    params.append(start)
+
+    items, error = run_query(query, params)
+    if error:
+        return error
+
+    return jsonify({
+        'items': items,
+        'page': page,
+        'per_page': per_page
+    })
+
+@app.route('/api/weather/anomaly', methods=['GET'])
+def get_weather_anomaly():
+    """
+    Get weather data with anomalies from the station climatology
+    The climatology is the mean and standard deviation for each station and
+    day of year over all years, smoothed over a 15-day window.
+    Allows filtering by date range and station ID, and supports pagination.
+    ---
+    parameters:
+      - name: station_id
+        in: query
+        type: string
+        description: Filter by station ID
+      - name: date
+        in: query
+        type: string
+        format: date
+        description: Filter by date (YYYY-MM-DD)
+      - name: start_date
+        in: query
+        type: string
+        format: date
+        description: First date (YYYY-MM-DD)
+      - name: end_date
+        in: query
+        type: string
+        format: date
+        description: Last date (YYYY-MM-DD)
+      - name: page
+        in: query
+        type: integer
+        default: 1
+        description: Page number for pagination
+      - name: per_page
+        in: query
+        type: integer
+        default: 10
+        description: Number of items per page
+    responses:
+      200:
+        description: A list of weather data records with anomalies
+        schema:
+          type: object
+          properties:
+            items:
+              type: array
+              items:
+                type: object
+                properties:
+                  station_id:
+                    type: string
+                    description: Station ID
+                  date:
+                    type: string
+                    format: date
+                    description: Observation date
+                  max_temperature:
+                    type: number
+                    format: float
+                    description: Maximum Temperature in C
+                  max_temperature_normal:
+                    type: number
+                    format: float
+                    description: Climatological mean maximum temperature in C
+                  max_temperature_anomaly:
+                    type: number
+                    format: float
+                    description: Maximum temperature minus its climatological mean in C
+                  max_temperature_zscore:
+                    type: number
+                    format: float
+                    description: Maximum temperature anomaly in standard deviations
+                  min_temperature:
+                    type: number
+                    format: float
+                    description: Minimum Temperature in C
+                  min_temperature_normal:
+                    type: number
+                    format: float
+                    description: Climatological mean minimum temperature in C
+                  min_temperature_anomaly:
+                    type: number
+                    format: float
+                    description: Minimum temperature minus its climatological mean in C
+                  min_temperature_zscore:
+                    type: number
+                    format: float
+                    description: Minimum temperature anomaly in standard deviations
+                  precipitation:
+                    type: number
+                    format: float
+                    description: Total precipitation in mm
+                  precipitation_normal:
+                    type: number
+                    format: float
+                    description: Climatological mean precipitation in mm
+                  precipitation_anomaly:
+                    type: number
+                    format: float
+                    description: Precipitation minus its climatological mean in mm
+            page:
+              type: integer
+              description: Current page number
+            per_page:
+              type: integer
+              description: Number of items per page
+      400:
+        description: Invalid input (e.g., invalid date format)
+        schema:
+          type: object
+          properties:
+            error:
+              type: string
+              description: Error message
+      500:
+        description: Database connection or query error
+        schema:
+          type: object
+          properties:
+            error:
+              type: string
+              description: Error message
+    """
+    query = f"""
+        SELECT d.station_id, d.date,
+               d.max_temperature, c.max_temperature_mean AS max_temperature_normal,
+               d.max_temperature - c.max_temperature_mean AS max_temperature_anomaly,
+               ROUND((d.max_temperature - c.max_temperature_mean)
+                     / NULLIF(c.max_temperature_std, 0), 2) AS max_temperature_zscore,
+               d.min_temperature, c.min_temperature_mean AS min_temperature_normal,
+               d.min_temperature - c.min_temperature_mean AS min_temperature_anomaly,
+               ROUND((d.min_temperature - c.min_temperature_mean)
+                     / NULLIF(c.min_temperature_std, 0), 2) AS min_temperature_zscore,
+               d.precipitation, c.precipitation_mean AS precipitation_normal,
+               d.precipitation - c.precipitation_mean AS precipitation_anomaly
+        FROM station_data d
+        JOIN station_climatology c
+          ON c.station_id = d.station_id AND c.doy = {DOY_SQL.format(col='d.date')}
+        WHERE 1=1"""
+    conditions = []
+    params = []
+
+    for name, condition in (('date', "d.date = %s"),
+                            ('start_date', "d.date >= %s"),
+                            ('end_date', "d.date <= %s")):
+        date_str = request.args.get(name)
+        if date_str:
+            try:
+                params.append(datetime.strptime(date_str, '%Y-%m-%d').date())
+            except ValueError:
+                return jsonify({'error': 'Invalid date format. Please use YYYY-MM-DD.'}), 400
+            conditions.append(condition)
+
+    station_id = request.args.get('station_id')
+    if station_id:
+        conditions.append("d.station_id = %s")
+        params.append(station_id)
+
+    if conditions:
+        query += " AND " + " AND ".join(conditions)
+
+    query += " ORDER BY d.date DESC, d.station_id LIMIT %s OFFSET %s"
+
+    _, page, per_page, start, limit = paginate(None, DEFAULT_PAGE, DEFAULT_PER_PAGE)
+    params.append(limit)
+    params.append(start)
+
+    items, error = run_query(query, params)
+    if error:
+        return error
+
+    return jsonify({
+        'items': items,
+        'page': page,
+        'per_page': per_page
+    })
+
+@app.route('/api/yield/features', methods=['GET'])
+def get_yield_features():
+    """
+    Get the yearly growing season feature matrix joined to US corn grain yield
+    Features are averaged over stations with at least 150 days of growing
+    season (April-September) data in the year.
+    ---
+    parameters:
+      - name: start_year
+        in: query
+        type: integer
+        description: First year
+      - name: end_year
+        in: query
+        type: integer
+        description: Last year
+    responses:
+      200:
+        description: One row of features per year
+        schema:
+          type: object
+          properties:
+            items:
+              type: array
+              items:
+                type: object
+                properties:
+                  year:
+                    type: integer
+                    description: Year
+                  number_stations:
+                    type: integer
+                    description: Number of stations averaged
+                  gdd_mean:
+                    type: number
+                    format: float
+                    description: Mean corn growing degree days (10/30 C) in C days
+                  gdd_std:
+                    type: number
+                    format: float
+                    description: Standard deviation of growing degree days across stations
+                  precipitation_mean:
+                    type: number
+                    format: float
+                    description: Mean growing season precipitation in cm
+                  precipitation_std:
+                    type: number
+                    format: float
+                    description: Standard deviation of growing season precipitation in cm
+                  heat_stress_days_mean:
+                    type: number
+                    format: float
+                    description: Mean number of days with maximum temperature of 35 C or more
+                  grain_yield:
+                    type: integer
+                    description: US corn grain yield, as given in yld_data
+      400:
+        description: Invalid input (e.g., invalid year)
+        schema:
+          type: object
+          properties:
+            error:
+              type: string
+              description: Error message
+      500:
+        description: Database connection or query error
+        schema:
+          type: object
+          properties:
+            error:
+              type: string
+              description: Error message
+    """
+    query = "SELECT * FROM yield_features WHERE 1=1"
+    conditions = []
+    params = []
+
+    for name, condition in (('start_year', "year >= %s"), ('end_year', "year <= %s")):
+        year = request.args.get(name)
+        if year:
+            try:
+                params.append(int(year))
+            except ValueError:
+                return jsonify({'error': 'Invalid year.  Year must be an integer'}), 400
+            conditions.append(condition)
+
+    if conditions:
+        query += " AND " + " AND ".join(conditions)
+
+    query += " ORDER BY year"
+
+    items, error = run_query(query, params)
+    if error:
+        return error
+
+    return jsonify({'items': items})
+
+@app.route('/api/weather/series', methods=['GET'])
+def get_weather_series():
+    """
+    Get a station time series for charting at daily, weekly, monthly or yearly resolution
+    Weekly, monthly and yearly points carry the min, max and mean of each
+    variable over the period.  With resolution=auto (default) the finest
+    resolution that fits the requested date range into max_points is used.
+    When the range needs more than max_points points at the resolution, the
+    first max_points are returned with truncated set and next_start the
+    start_date of the next request.
+    ---
+    parameters:
+      - name: station_id
+        in: query
+        type: string
+        required: true
+        description: Station ID
+      - name: start_date
+        in: query
+        type: string
+        format: date
+        description: First date (YYYY-MM-DD), default first date of the station
+      - name: end_date
+        in: query
+        type: string
+        format: date
+        description: Last date (YYYY-MM-DD), default last date of the station
+      - name: resolution
+        in: query
+        type: string
+        enum: [auto, day, week, month, year]
+        default: auto
+        description: Resolution of the series
+      - name: max_points
+        in: query
+        type: integer
+        default: 500
+        description: Maximum number of points returned
+    responses:
+      200:
+        description: A station time series
+        schema:
+          type: object
+          properties:
+            station_id:
+              type: string
+              description: Station ID
+            resolution:
+              type: string
+              description: Resolution of the returned series
+            truncated:
+              type: boolean
+              description: True if the range has more than max_points points
+            next_start:
+              type: string
+              format: date
+              description: start_date of the remaining points (only if truncated)
+            items:
+              type: array
+              items:
+                type: object
+                description: >
+                  period_start with max_temperature_min/max/mean, min_temperature_min/max/mean,
+                  precipitation_min/max/mean and number_obs; daily points have date,
+                  max_temperature, min_temperature and precipitation
+      400:
+        description: Invalid input (e.g., invalid date format)
+        schema:
+          type: object
+          properties:
+            error:
+              type: string
+              description: Error message
+      500:
+        description: Database connection or query error
+        schema:
+          type: object
+          properties:
+            error:
+              type: string
+              description: Error message
+    """
+    station_id = request.args.get('station_id')
+    if not station_id:
+        return jsonify({'error': 'station_id is required'}), 400
+
+    resolution = request.args.get('resolution', 'auto')
+    if resolution != 'auto' and resolution not in SERIES_RESOLUTIONS:
+        return jsonify({'error': f"Invalid resolution.  Use auto, {', '.join(SERIES_RESOLUTIONS)}"}), 400
+    try:
+        max_points = max(int(request.args.get('max_points', DEFAULT_MAX_POINTS)), 1)
+        dates = [datetime.strptime(request.args[name], '%Y-%m-%d').date()
+                 if request.args.get(name) else None for name in ('start_date', 'end_date')]
+    except ValueError:
+        return jsonify({'error': 'Invalid date format or max_points.'}), 400
+
+    if None in dates:
+        items, error = run_query("SELECT MIN(date), MAX(date) FROM station_data WHERE station_id = %s",
+                                 [station_id])
+        if error:
+            return error
+        first, last = items[0].values()
+        if first is None:
+            return jsonify({'station_id': station_id, 'resolution': resolution,
+                            'truncated': False, 'items': []})
+        dates = [dates[0] or first, dates[1] or last]
+    start_date, end_date = dates
+
+    if resolution == 'auto':
+        ndays = (end_date - start_date).days + 1
+        resolution = next((res for res, days in SERIES_RESOLUTIONS.items()
+                           if ndays/days <= max_points), 'year')
+
+    if resolution == 'day':
+        query = """
+            SELECT date, max_temperature, min_temperature, precipitation FROM station_data
+            WHERE station_id = %s AND date BETWEEN %s AND %s ORDER BY date LIMIT %s"""
+        params = [station_id, start_date, end_date, max_points + 1]
+    else:
+        query = """
+            SELECT period_start, max_temperature_min, max_temperature_max, max_temperature_mean,
+                   min_temperature_min, min_temperature_max, min_temperature_mean,
+                   precipitation_min, precipitation_max, precipitation_mean, number_obs
+            FROM station_data_pyramid
+            WHERE station_id = %s AND resolution = %s
+              AND period_start BETWEEN date_trunc(%s, %s::timestamp)::date AND %s
+            ORDER BY period_start LIMIT %s"""
+        params = [station_id, resolution, resolution, start_date, end_date, max_points + 1]
+
+    #one point more than asked for tells whether the range was cut
+    items, error = run_query(query, params)
+    if error:
+        return error
+
+    result = {'station_id': station_id, 'resolution': resolution,
+              'truncated': len(items) > max_points, 'items': items[:max_points]}
+    if result['truncated']:
+        result['next_start'] = items[max_points]['date' if resolution == 'day' else 'period_start'].isoformat()
+    return jsonify(result)
+
+@app.route('/api/weather/regional', methods=['GET'])
+def get_weather_regional():
+    """
+    Get daily aggregates across stations
+    Region ALL covers every station; other regions group stations by the
+    first 7 characters of the station ID (network and state code, e.g. USC0011).
+    Allows filtering by date range and region, and supports pagination.
+    ---
+    parameters:
+      - name: region
+        in: query
+        type: string
+        default: ALL
+        description: Region (ALL or a 7-character station ID prefix)
+      - name: date
+        in: query
+        type: string
+        format: date
+        description: Filter by date (YYYY-MM-DD)
+      - name: start_date
+        in: query
+        type: string
+        format: date
+        description: First date (YYYY-MM-DD)
+      - name: end_date
+        in: query
+        type: string
+        format: date
+        description: Last date (YYYY-MM-DD)
+      - name: page
+        in: query
+        type: integer
+        default: 1
+        description: Page number for pagination
+      - name: per_page
+        in: query
+        type: integer
+        default: 10
+        description: Number of items per page
+    responses:
+      200:
+        description: A list of daily regional aggregates
+        schema:
+          type: object
+          properties:
+            items:
+              type: array
+              items:
+                type: object
+                properties:
+                  region:
+                    type: string
+                    description: Region
+                  date:
+                    type: string
+                    format: date
+                    description: Observation date
+                  max_temperature_mean:
+                    type: number
+                    format: float
+                    description: Mean of station maximum temperatures in C (also _min, _max)
+                  min_temperature_mean:
+                    type: number
+                    format: float
+                    description: Mean of station minimum temperatures in C (also _min, _max)
+                  precipitation_mean:
+                    type: number
+                    format: float
+                    description: Mean of station precipitation in mm (also _min, _max)
+                  station_count:
+                    type: integer
+                    description: Number of stations reporting
+            page:
+              type: integer
+              description: Current page number
+            per_page:
+              type: integer
+              description: Number of items per page
+      400:
+        description: Invalid input (e.g., invalid date format)
+        schema:
+          type: object
+          properties:
+            error:
+              type: string
+              description: Error message
+      500:
+        description: Database connection or query error
+        schema:
+          type: object
+          properties:
+            error:
+              type: string
+              description: Error message
+    """
+    query = "SELECT * FROM regional_daily WHERE region = %s"
+    conditions = []
+    params = [request.args.get('region', 'ALL')]
+
+    for name, condition in (('date', "date = %s"),
+                            ('start_date', "date >= %s"),
+                            ('end_date', "date <= %s")):
+        date_str = request.args.get(name)
+        if date_str:
+            try:
+                params.append(datetime.strptime(date_str, '%Y-%m-%d').date())
+            except ValueError:
+                return jsonify({'error': 'Invalid date format. Please use YYYY-MM-DD.'}), 400
+            conditions.append(condition)
+
+    if conditions:
+        query += " AND " + " AND ".join(conditions)
+
+    query += " ORDER BY date DESC LIMIT %s OFFSET %s"
+
+    _, page, per_page, start, limit = paginate(None, DEFAULT_PAGE, DEFAULT_PER_PAGE)
+    params.append(limit)
+    params.append(start)
+
+    items, error = run_query(query, params)
+    if error:
+        return error
+
+    return jsonify({
+        'items': items,
+        'page': page,
+        'per_page': per_page
+    })
+
+@app.route('/api/weather/percentile', methods=['GET'])
+def get_weather_percentile():
+    """
+    Get percentiles of daily values from the per station-year quantile sketches
+    Sketches of all station-years matching the filters are merged, either into
+    one result or one result per station or per year (group_by).
+    ---
+    parameters:
+      - name: variable
+        in: query
+        type: string
+        required: true
+        enum: [max_temperature, min_temperature, precipitation]
+        description: Variable
+      - name: q
+        in: query
+        type: string
+        default: "0.5"
+        description: Comma separated quantiles between 0 and 1 (e.g. 0.9,0.99)
+      - name: station_id
+        in: query
+        type: string
+        description: Filter by station ID
+      - name: start_year
+        in: query
+        type: integer
+        description: First year
+      - name: end_year
+        in: query
+        type: integer
+        description: Last year
+      - name: group_by
+        in: query
+        type: string
+        enum: [none, station_id, year]
+        default: none
+        description: Merge the sketches into one result, or one per station or year
+    responses:
+      200:
+        description: Percentiles
+        schema:
+          type: object
+          properties:
+            variable:
+              type: string
+              description: Variable
+            items:
+              type: array
+              items:
+                type: object
+                properties:
+                  station_id:
+                    type: string
+                    description: Station ID (with group_by=station_id)
+                  year:
+                    type: integer
+                    description: Year (with group_by=year)
+                  number_obs:
+                    type: integer
+                    description: Number of daily values summarized
+                  percentiles:
+                    type: object
+                    description: Estimated value for each requested quantile
+      400:
+        description: Invalid input (e.g., invalid quantile)
+        schema:
+          type: object
+          properties:
+            error:
+              type: string
+              description: Error message
+      500:
+        description: Database connection or query error
+        schema:
+          type: object
+          properties:
+            error:
+              type: string
+              description: Error message
+    """
+    variable = request.args.get('variable')
+    if variable not in SKETCH_VARIABLES:
+        return jsonify({'error': f"Invalid variable.  Use one of {', '.join(SKETCH_VARIABLES)}"}), 400
+    group_by = request.args.get('group_by', 'none')
+    if group_by not in ('none', 'station_id', 'year'):
+        return jsonify({'error': 'Invalid group_by.  Use none, station_id or year'}), 400
+    try:
+        quantiles = [float(q) for q in request.args.get('q', '0.5').split(',')]
+        if not all(0. <= q <= 1. for q in quantiles):
+            raise ValueError()
+    except ValueError:
+        return jsonify({'error': 'Invalid quantile.  Use numbers between 0 and 1'}), 400
+
+    query = "SELECT station_id, year, sketch FROM station_year_sketches WHERE variable = %s"
+    conditions = []
+    params = [variable]
+
+    for name, condition in (('start_year', "year >= %s"), ('end_year', "year <= %s")):
+        year = request.args.get(name)
+        if year:
+            try:
+                params.append(int(year))
+            except ValueError:
+                return jsonify({'error': 'Invalid year.  Year must be an integer'}), 400
+            conditions.append(condition)
+
+    station_id = request.args.get('station_id')
+    if station_id:
+        conditions.append("station_id = %s")
+        params.append(station_id)
+
+    if conditions:
+        query += " AND " + " AND ".join(conditions)
+
+    rows, error = run_query(query, params)
+    if error:
+        return error
+
+    groups = {}
+    for row in rows:
+        key = None if group_by == 'none' else row[group_by]
+        groups.setdefault(key, []).append(TDigest.from_bytes(row['sketch']))
+
+    items = []
+    for key in sorted(groups, key=lambda key: (key is None, key)):
+        digest = merge_all(groups[key])
+        item = {} if key is None else {group_by: key}
+        item['number_obs'] = int(digest.count)
+        item['percentiles'] = {str(q): (None if value != value else round(float(value), 2))
+                               for q, value in zip(quantiles, digest.quantile(quantiles))}
+        items.append(item)
+
+    return jsonify({'variable': variable, 'items': items})
+
+@app.route('/api/weather/coverage', methods=['GET'])
+def get_weather_coverage():
+    """
+    Get station data coverage for a year from the coverage bitmaps
+    A day is covered when the station has a value for the variable that was
+    not flagged by QC.  Use complete=true to find the stations without gaps
+    in a period, or station_id and missing=true to list a station's gaps.
+    ---
+    parameters:
+      - name: year
+        in: query
+        type: integer
+        required: true
+        description: Year
+      - name: variable
+        in: query
+        type: string
+        enum: [max_temperature, min_temperature, precipitation]
+        default: max_temperature
+        description: Variable
+      - name: station_id
+        in: query
+        type: string
+        description: Filter by station ID
+      - name: start_date
+        in: query
+        type: string
+        format: date
+        description: First date of the period (YYYY-MM-DD, in year; default Jan 1)
+      - name: end_date
+        in: query
+        type: string
+        format: date
+        description: Last date of the period (YYYY-MM-DD, in year; default Dec 31)
+      - name: complete
+        in: query
+        type: boolean
+        default: false
+        description: Only stations with every day of the period covered
+      - name: missing
+        in: query
+        type: boolean
+        default: false
+        description: Include the list of missing dates in the period
+      - name: page
+        in: query
+        type: integer
+        default: 1
+        description: Page number for pagination
+      - name: per_page
+        in: query
+        type: integer
+        default: 10
+        description: Number of items per page
+    responses:
+      200:
+        description: Coverage per station
+        schema:
+          type: object
+          properties:
+            items:
+              type: array
+              items:
+                type: object
+                properties:
+                  station_id:
+                    type: string
+                    description: Station ID
+                  year:
+                    type: integer
+                    description: Year
+                  number_days:
+                    type: integer
+                    description: Days covered in the whole year
+                  period_days:
+                    type: integer
+                    description: Days covered in the period
+                  missing_days:
+                    type: integer
+                    description: Days of the period not covered
+                  complete:
+                    type: boolean
+                    description: True if every day of the period is covered
+                  missing_dates:
+                    type: array
+                    items:
+                      type: string
+                      format: date
+                    description: Dates not covered (with missing=true)
+            page:
+              type: integer
+              description: Current page number
+            per_page:
+              type: integer
+              description: Number of items per page
+      400:
+        description: Invalid input (e.g., missing year, date outside year)
+        schema:
+          type: object
+          properties:
+            error:
+              type: string
+              description: Error message
+      500:
+        description: Database connection or query error
+        schema:
+          type: object
+          properties:
+            error:
+              type: string
+              description: Error message
+    """
+    try:
+        year = int(request.args.get('year'))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid year.  Year must be an integer'}), 400
+    variable = request.args.get('variable', 'max_temperature')
+    if variable not in SKETCH_VARIABLES:
+        return jsonify({'error': f"Invalid variable.  Use one of {', '.join(SKETCH_VARIABLES)}"}), 400
+
+    period = {}
+    for name in ('start_date', 'end_date'):
+        date_str = request.args.get(name)
+        if date_str:
+            try:
+                period[name] = datetime.strptime(date_str, '%Y-%m-%d').date()
+            except ValueError:
+                return jsonify({'error': 'Invalid date format. Please use YYYY-MM-DD.'}), 400
+            if period[name].year != year:
+                return jsonify({'error': 'start_date and end_date must be in year'}), 400
+    mask = period_mask(year, period.get('start_date'), period.get('end_date'))
+    show_missing = request.args.get('missing', 'false').lower() == 'true'
+
+    #covered = days AND mask; missing = mask AND NOT days
+    query = f"""
+        SELECT c.station_id, c.year, c.number_days,
+               length(replace((c.days & m.mask)::text, '0', '')) AS period_days,
+               length(replace((m.mask & ~c.days)::text, '0', '')) AS missing_days,
+               (c.days & m.mask) = m.mask AS complete
+               {', c.days::text AS days' if show_missing else ''}
+        FROM station_coverage c
+        CROSS JOIN (SELECT %s::bit({COVERAGE_BITS}) AS mask) m
+        WHERE c.variable = %s AND c.year = %s"""
+    params = [mask, variable, year]
+
+    station_id = request.args.get('station_id')
+    if station_id:
+        query += " AND c.station_id = %s"
+        params.append(station_id)
+    if request.args.get('complete', 'false').lower() == 'true':
+        query += " AND (c.days & m.mask) = m.mask"
+
+    query += " ORDER BY c.station_id LIMIT %s OFFSET %s"
+
+    _, page, per_page, start, limit = paginate(None, DEFAULT_PAGE, DEFAULT_PER_PAGE)
+    params.append(limit)
+    params.append(start)
+
+    items, error = run_query(query, params)
+    if error:
+        return error
+
+    if show_missing:
+        for item in items:
+            item['missing_dates'] = [day.isoformat()
+                                     for day in missing_dates(year, item.pop('days'), mask)]
+
+    return jsonify({
+        'items': items,
+        'page': page,
+        'per_page': per_page
+    })
+
+@app.route('/api/weather/trends', methods=['GET'])
+def get_weather_trends():
+    """
+    Get per station linear trends of the yearly statistics
+    Least-squares slope of a yearly statistic over all years with a value,
+    with the latest 5 and 10 year rolling means.  Filter by station, number
+    of years and slope, and sort by slope.
+    ---
+    parameters:
+      - name: variable
+        in: query
+        type: string
+        enum: [max_temperature_avg, min_temperature_avg, precipitation_accum]
+        default: max_temperature_avg
+        description: Yearly statistic (column of /api/weather/stats)
+      - name: station_id
+        in: query
+        type: string
+        description: Filter by station ID
+      - name: min_years
+        in: query
+        type: integer
+        description: Only trends fitted on at least this many years
+      - name: min_slope
+        in: query
+        type: number
+        description: Only slopes (per year) of at least this value
+      - name: max_slope
+        in: query
+        type: number
+        description: Only slopes (per year) of at most this value
+      - name: sort
+        in: query
+        type: string
+        enum: [slope_desc, slope_asc, station_id]
+        default: slope_desc
+        description: Sort order
+      - name: page
+        in: query
+        type: integer
+        default: 1
+        description: Page number for pagination
+      - name: per_page
+        in: query
+        type: integer
+        default: 10
+        description: Number of items per page
+    responses:
+      200:
+        description: Trends per station
+        schema:
+          type: object
+          properties:
+            variable:
+              type: string
+              description: Yearly statistic
+            items:
+              type: array
+              items:
+                type: object
+                properties:
+                  station_id:
+                    type: string
+                    description: Station ID
+                  first_year:
+                    type: integer
+                    description: First year with a value
+                  last_year:
+                    type: integer
+                    description: Last year with a value
+                  number_years:
+                    type: integer
+                    description: Years the trend is fitted on
+                  mean:
+                    type: number
+                    format: float
+                    description: Mean over all years
+                  slope_per_year:
+                    type: number
+                    format: float
+                    description: Least-squares slope (units of the statistic per year)
+                  mean_5y:
+                    type: number
+                    format: float
+                    description: Mean over the 5 years ending at last_year
+                  number_years_5y:
+                    type: integer
+                    description: Years with a value in the 5 year window
+                  mean_10y:
+                    type: number
+                    format: float
+                    description: Mean over the 10 years ending at last_year
+                  number_years_10y:
+                    type: integer
+                    description: Years with a value in the 10 year window
+            page:
+              type: integer
+              description: Current page number
+            per_page:
+              type: integer
+              description: Number of items per page
+      400:
+        description: Invalid input (e.g., unknown variable or sort)
+        schema:
+          type: object
+          properties:
+            error:
+              type: string
+              description: Error message
+      500:
+        description: Database connection or query error
+        schema:
+          type: object
+          properties:
+            error:
+              type: string
+              description: Error message
+    """
+    variable = request.args.get('variable', 'max_temperature_avg')
+    if variable not in TREND_VARIABLES:
+        return jsonify({'error': f"Invalid variable.  Use one of {', '.join(TREND_VARIABLES)}"}), 400
+    sort = request.args.get('sort', 'slope_desc')
+    if sort not in TREND_SORTS:
+        return jsonify({'error': f"Invalid sort.  Use one of {', '.join(TREND_SORTS)}"}), 400
+
+    #latest rolling means: the windows ending at the station's last year
+    rolling_columns = ''.join(f", r{n}.mean AS mean_{n}y, r{n}.number_years AS number_years_{n}y"
+                              for n in ROLLING_WINDOWS)
+    rolling_joins = ''.join(f"""
+        LEFT JOIN station_rolling_stats r{n}
+               ON r{n}.station_id = t.station_id AND r{n}.variable = t.variable
+              AND r{n}.window_years = {n} AND r{n}.year = t.last_year"""
+                            for n in ROLLING_WINDOWS)
+    query = f"""
+        SELECT t.station_id, t.first_year, t.last_year, t.number_years, t.mean, t.slope_per_year
+               {rolling_columns}
+        FROM station_trends t {rolling_joins}
+        WHERE t.variable = %s"""
+    params = [variable]
+
+    _, page, per_page, start, limit = paginate(None, DEFAULT_PAGE, DEFAULT_PER_PAGE)
+
+    station_id = request.args.get('station_id')
+    if station_id:
+        #nothing to find for unknown stations
+        if not station_directory.has_station(station_id):
+            return jsonify({'variable': variable, 'items': [], 'page': page, 'per_page': per_page})
+        query += " AND t.station_id = %s"
+        params.append(station_id)
+    for name, condition, convert in (('min_years', "t.number_years >= %s", int),
+                                     ('min_slope', "t.slope_per_year >= %s", float),
+                                     ('max_slope', "t.slope_per_year <= %s", float)):
+        value = request.args.get(name)
+        if value:
+            try:
+                params.append(convert(value))
+            except ValueError:
+                return jsonify({'error': f'Invalid {name}.  Must be a number'}), 400
+            query += " AND " + condition
+
+    query += f" ORDER BY {TREND_SORTS[sort]} LIMIT %s OFFSET %s"
+    params.append(limit)
+    params.append(start)
+
+    items, error = run_query(query, params)
+    if error:
+        return error
+
+    return jsonify({
+        'variable': variable,
+        'items': items,
+        'page': page,
+        'per_page': per_page
+    })
+
+@app.route('/api/weather/stats/rolling', methods=['GET'])
+def get_weather_stats_rolling():
+    """
+    Get rolling multi-year means of a station's yearly statistics
+    Mean of a yearly statistic over the window_years years ending at each
+    year, with the number of those years that have a value.
+    ---
+    parameters:
+      - name: station_id
+        in: query
+        type: string
+        required: true
+        description: Station ID
+      - name: variable
+        in: query
+        type: string
+        enum: [max_temperature_avg, min_temperature_avg, precipitation_accum]
+        default: max_temperature_avg
+        description: Yearly statistic (column of /api/weather/stats)
+      - name: window_years
+        in: query
+        type: integer
+        enum: [5, 10]
+        default: 5
+        description: Window length in years
+      - name: start_year
+        in: query
+        type: integer
+        description: First year
+      - name: end_year
+        in: query
+        type: integer
+        description: Last year
+    responses:
+      200:
+        description: Rolling means, by year
+        schema:
+          type: object
+          properties:
+            station_id:
+              type: string
+              description: Station ID
+            variable:
+              type: string
+              description: Yearly statistic
+            window_years:
+              type: integer
+              description: Window length in years
+            items:
+              type: array
+              items:
+                type: object
+                properties:
+                  year:
+                    type: integer
+                    description: Last year of the window
+                  mean:
+                    type: number
+                    format: float
+                    description: Mean over the window
+                  number_years:
+                    type: integer
+                    description: Years with a value in the window
+      400:
+        description: Invalid input (e.g., missing station_id, unknown window)
+        schema:
+          type: object
+          properties:
+            error:
+              type: string
+              description: Error message
+      500:
+        description: Database connection or query error
+        schema:
+          type: object
+          properties:
+            error:
+              type: string
+              description: Error message
+    """
+    station_id = request.args.get('station_id')
+    if not station_id:
+        return jsonify({'error': 'station_id is required'}), 400
+    variable = request.args.get('variable', 'max_temperature_avg')
+    if variable not in TREND_VARIABLES:
+        return jsonify({'error': f"Invalid variable.  Use one of {', '.join(TREND_VARIABLES)}"}), 400
+    try:
+        window_years = int(request.args.get('window_years', ROLLING_WINDOWS[0]))
+    except ValueError:
+        window_years = None
+    if window_years not in ROLLING_WINDOWS:
+        return jsonify({'error': f"Invalid window_years.  Use one of {', '.join(map(str, ROLLING_WINDOWS))}"}), 400
+
+    result = {'station_id': station_id, 'variable': variable, 'window_years': window_years,
+              'items': []}
+    if not station_directory.has_station(station_id):
+        return jsonify(result)
+
+    query = """
+        SELECT year, mean, number_years FROM station_rolling_stats
+        WHERE station_id = %s AND variable = %s AND window_years = %s"""
+    params = [station_id, variable, window_years]
+    for name, condition in (('start_year', "year >= %s"), ('end_year', "year <= %s")):
+        year = request.args.get(name)
+        if year:
+            try:
+                params.append(int(year))
+            except ValueError:
+                return jsonify({'error': 'Invalid year.  Year must be an integer'}), 400
+            query += " AND " + condition
+    query += " ORDER BY year"
+
+    items, error = run_query(query, params)
+    if error:
+        return error
+    result['items'] = items
+    return jsonify(result)
+
 if __name__ == '__main__':
+    station_directory.refresh(force=True)
     app.run(debug=True)
@@ -0,0 +1,40 @@
+import multiprocessing
+import os
+
+# Production serving of api.py: gunicorn -c gunicorn.conf.py
+# Preforked worker processes with a thread pool each (gthread); every worker
+# opens a connection per thread, loads the station directory and builds the
+# Swagger spec when it starts (api.warm_up).  kill -HUP <master pid> starts
+# new workers with the current code and stops the old ones once their
+# requests are done.
+# Settings can be overridden with the WXAPI_* environment variables.
+
+wsgi_app = 'api:app'
+bind = os.environ.get('WXAPI_BIND', '0.0.0.0:8000')
+
+workers = int(os.environ.get('WXAPI_WORKERS', multiprocessing.cpu_count() + 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('WXAPI_THREADS', 4))
+
+# seconds a worker may go without a heartbeat before it is killed and replaced.
+# gthread workers heartbeat from their main loop while requests run in the
+# thread pool, so this only catches hung workers, not slow requests: those are
+# bounded by the database statement timeout of api.py (WXAPI_STATEMENT_TIMEOUT)
+timeout = int(os.environ.get('WXAPI_TIMEOUT', 30))
+# seconds workers get to finish their requests on reload or shutdown
+graceful_timeout = int(os.environ.get('WXAPI_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+
+#import the app in each worker (not the master) so a reload picks up new code
+preload_app = False
+
+accesslog = os.environ.get('WXAPI_ACCESS_LOG')
+errorlog = '-'
+
+
+def post_worker_init(worker):
+    """
+    Warm up a worker once its application is loaded, before it accepts requests
+    """
+    from api import warm_up
+    warm_up(threads)
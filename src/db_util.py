@@ -1,15 +1,51 @@
+import os
+import re
+import time
+from collections import Counter
+
 import psycopg2
 from psycopg2 import OperationalError, errorcodes
+from psycopg2.extensions import connection as pg_connection
+from psycopg2.extras import execute_values
 
-# Database connection parameters
-dbname = "wxdata"
+# Database connection parameters (WXDATA_DB selects another database, e.g. for benchmarks)
+dbname = os.environ.get('WXDATA_DB', "wxdata")
 dbuser = "postgres"
 dbpassword = "test"
 dbhost = "localhost"
 dbport = "5432"
 
+# Rows that fail inside a batched write are logged here
+quarantine_table = "ingest_quarantine"
+
+# Read-only role the API connects as (see api.py): granted SELECT on the
+# tables it reads when they are created (see grant_select)
+api_role = "web_user"
+
+# Query profiling (see enable_query_profiling)
+profile_queries = False
+slow_query_ms = 250.
+explain_slow_queries = False
+query_profile = {} #normalized SQL -> calls, total_ms, max_ms, rows
+
 # PostGreSQL utilities
 
+class WxConnection(pg_connection):
+    """
+    psycopg2 connection that keeps track of the named server-side prepared
+    statements created on it (see prepared_sql).
+
+    Attributes:
+        prepared: dict of statement name -> SQL text it was prepared from
+        prepared_calls: Counter of executions per statement name
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = {}
+        self.prepared_calls = Counter()
+
+
 def create_table(conn, create_table_sql, logger):
     """
     Creates a new table in the PostgreSQL database.
@@ -54,7 +90,8 @@ def connect_to_db(logger):
             user=dbuser,
             password=dbpassword,
             host=dbhost,
-            port=dbport
+            port=dbport,
+            connection_factory=WxConnection
         )
         #print("Connected to the database successfully.")
     except OperationalError as e:
@@ -86,6 +123,158 @@ def init_table(table_sql, logger):
         logger.exceptions("Failed to connect to the database.")
 
 
+def grant_select(tables, logger, role=api_role):
+    """
+    Grant SELECT on tables to the API's read-only role.  Nothing is granted
+    when the role does not exist in this cluster.
+    Input:
+        tables: names of the tables
+        logger: logging object
+        role: role to grant to
+    """
+    conn = connect_to_db(logger)
+    if conn is None:
+        logger.error("Failed to connect to the database.")
+        return
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT to_regrole(%s);", (role,))
+            if cursor.fetchone()[0] is None:
+                logger.warning(f"Role {role} does not exist, SELECT on {', '.join(tables)} not granted")
+                return
+            cursor.execute(f"GRANT SELECT ON {', '.join(tables)} TO {role};")
+        conn.commit()
+    except psycopg2.Error as e:
+        conn.rollback()
+        logger.exception(f"Error granting SELECT on {', '.join(tables)}: {e}")
+    finally:
+        conn.close()
+
+
+def init_quarantine_table(logger):
+    """
+    Connect to the wxdata database and create the quarantine table used by
+    execute_batch_db for rows that could not be written.
+    """
+
+    create_table_sql = f"""
+        CREATE TABLE IF NOT EXISTS {quarantine_table} (
+            id SERIAL PRIMARY KEY,
+            logged_at TIMESTAMP NOT NULL DEFAULT now(),
+            source VARCHAR(255),
+            row_data TEXT,
+            error TEXT
+        );
+    """
+
+    return init_table(create_table_sql, logger)
+
+
+def enable_query_profiling(slow_ms=250., explain=False):
+    """
+    Turns on timing of every statement sent through the execute_* helpers.
+
+    Input:
+        slow_ms: statements slower than this (ms) are logged individually
+        explain: also log EXPLAIN (ANALYZE, BUFFERS) for slow statements
+    """
+    global profile_queries, slow_query_ms, explain_slow_queries
+    profile_queries = True
+    slow_query_ms = slow_ms
+    explain_slow_queries = explain
+
+
+def normalize_sql(sqlcommand):
+    """
+    Collapse whitespace and replace literals with ? so that statements
+    differing only in their values are aggregated together
+    """
+    sql = re.sub(r"'(?:[^']|'')*'", "?", sqlcommand)
+    sql = re.sub(r"(?<![\w$])-?\d+(?:\.\d+)?", "?", sql)
+    return ' '.join(sql.split()).rstrip(';')
+
+
+def _explain(conn, logger, sqlcommand, data):
+    """
+    Log EXPLAIN (ANALYZE, BUFFERS) for a statement.  The statement is run
+    again inside a savepoint that is rolled back, so writes are not repeated.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SAVEPOINT explain_query")
+        if data:
+            cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + sqlcommand, data)
+        else:
+            cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + sqlcommand)
+        plan = '\n'.join(row[0] for row in cursor.fetchall())
+        cursor.execute("ROLLBACK TO SAVEPOINT explain_query")
+        cursor.execute("RELEASE SAVEPOINT explain_query")
+        logger.warning(f"Query plan:\n{plan}")
+    except psycopg2.Error as e:
+        logger.warning(f"Could not explain query: {e}")
+        #an error aborts the transaction: undo back to the savepoint so the
+        #statement being profiled can still be committed
+        try:
+            cursor.execute("ROLLBACK TO SAVEPOINT explain_query")
+            cursor.execute("RELEASE SAVEPOINT explain_query")
+        except psycopg2.Error as e:
+            logger.warning(f"Could not roll back to the explain savepoint: {e}")
+    finally:
+        cursor.close()
+
+
+def _record_query(conn, logger, sqlcommand, data, elapsed_ms, nrows):
+    """
+    Add one statement execution to query_profile and log it if it is slow.
+    logger=None records without logging (e.g. for multi-row batches).
+    """
+    key = normalize_sql(sqlcommand)
+    stats = query_profile.setdefault(key, {'calls': 0, 'total_ms': 0., 'max_ms': 0., 'rows': 0})
+    stats['calls'] += 1
+    stats['total_ms'] += elapsed_ms
+    stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+    stats['rows'] += max(nrows, 0)
+
+    if logger is not None and elapsed_ms > slow_query_ms:
+        logger.warning(f"Slow query ({elapsed_ms:.1f} ms, {nrows} rows): {key}")
+        if explain_slow_queries:
+            _explain(conn, logger, sqlcommand, data)
+
+
+def _execute(conn, cursor, logger, sqlcommand, data=None):
+    """
+    cursor.execute, timed when query profiling is on
+    """
+    start = time.perf_counter()
+    if data:
+        cursor.execute(sqlcommand, data)
+    else:
+        cursor.execute(sqlcommand)
+    if profile_queries:
+        _record_query(conn, logger, sqlcommand, data,
+                      (time.perf_counter() - start)*1000., cursor.rowcount)
+
+
+def log_query_profile(logger, top=20):
+    """
+    Writes the slowest statements (by total time) recorded since profiling was
+    enabled to the log.
+
+    Input:
+        logger: logging object
+        top: number of statements to report
+    """
+    if not profile_queries:
+        return
+    ranked = sorted(query_profile.items(), key=lambda item: item[1]['total_ms'], reverse=True)
+    logger.info(f"Query profile: {len(query_profile)} distinct statements, "
+                f"{sum(stats['calls'] for stats in query_profile.values())} calls")
+    for key, stats in ranked[:top]:
+        logger.info(f"  {stats['total_ms']:.1f} ms total, {stats['calls']} calls, "
+                    f"{stats['total_ms']/stats['calls']:.2f} ms mean, {stats['max_ms']:.1f} ms max, "
+                    f"{stats['rows']} rows: {key[:200]}")
+
+
 def execute_insert_db(conn, logger, sqlcommand, data=None):
     """
     Executes the given command
@@ -98,10 +287,7 @@ def execute_insert_db(conn, logger, sqlcommand, data=None):
     """
     cursor = conn.cursor()
     try:
-        if data:
-            cursor.execute(sqlcommand, data)
-        else:
-            cursor.execute(sqlcommand)
+        _execute(conn, cursor, logger, sqlcommand, data)
         conn.commit()
     except psycopg2.Error as e:
         conn.rollback()
@@ -124,10 +310,7 @@ def execute_select_db(conn, logger, sqlcommand, data=None):
     """
     cursor = conn.cursor()
     try:
-        if data:
-            cursor.execute(sqlcommand, data)
-        else:
-            cursor.execute(sqlcommand)
+        _execute(conn, cursor, logger, sqlcommand, data)
         return cursor.fetchall()
     except psycopg2.Error as e:
         conn.rollback()
@@ -135,3 +318,311 @@ def execute_select_db(conn, logger, sqlcommand, data=None):
         return None
     finally:
         cursor.close()
+
+
+def _write_bisect(cursor, sqlcommand, rows, bad, fetch):
+    """
+    Writes rows inside a savepoint. If the write fails the savepoint is rolled
+    back and each half of rows is retried, until the failing rows are isolated.
+
+    Input:
+        cursor: cursor on an open transaction
+        sqlcommand: multi-row command with a single "VALUES %s" placeholder
+        rows: list of parameter tuples
+        bad: list that collects (row, error) for rows that could not be written
+        fetch: True if sqlcommand has a RETURNING clause
+    Output:
+        list of RETURNING rows for the rows that were written
+    """
+    cursor.execute("SAVEPOINT batch_write")
+    try:
+        start = time.perf_counter()
+        res = execute_values(cursor, sqlcommand, rows, page_size=len(rows), fetch=fetch)
+        if profile_queries:
+            _record_query(cursor.connection, None, sqlcommand, None,
+                          (time.perf_counter() - start)*1000., len(rows))
+    except psycopg2.Error as e:
+        cursor.execute("ROLLBACK TO SAVEPOINT batch_write")
+        cursor.execute("RELEASE SAVEPOINT batch_write")
+        if len(rows) == 1:
+            bad.append((rows[0], e))
+            return []
+        mid = len(rows) // 2
+        return (_write_bisect(cursor, sqlcommand, rows[:mid], bad, fetch)
+                + _write_bisect(cursor, sqlcommand, rows[mid:], bad, fetch))
+    cursor.execute("RELEASE SAVEPOINT batch_write")
+    return res or []
+
+
+def execute_batch_db(conn, logger, sqlcommand, rows, batch_size=1000, source=None, fetch=False):
+    """
+    Executes a multi-row command for a list of rows, committing every
+    batch_size rows.  When a batch fails it is bisected with savepoints so
+    only the offending rows are skipped; those are logged and written to the
+    quarantine table, and the rest of the batch is committed.
+
+    Input:
+        conn: The connection object to the db
+        logger: logging object
+        sqlcommand: The PostgreSQL command with a single "VALUES %s" placeholder
+        rows: list of parameter tuples
+        batch_size: number of rows per transaction
+        source: label stored with quarantined rows (e.g. the input file)
+        fetch: True if sqlcommand has a RETURNING clause
+    Output:
+        results, nbad: list of RETURNING rows, number of quarantined rows
+    """
+    results = []
+    nbad = 0
+    cursor = conn.cursor()
+    try:
+        for start in range(0, len(rows), batch_size):
+            bad = []
+            results.extend(_write_bisect(cursor, sqlcommand, rows[start:start+batch_size],
+                                         bad, fetch))
+            for row, e in bad:
+                logger.error(f"Quarantined row {row} from {source}: {e}")
+                cursor.execute(f"INSERT INTO {quarantine_table} (source, row_data, error) "
+                               "VALUES (%s, %s, %s)",
+                               (source, repr(row), str(e).strip()))
+            conn.commit()
+            nbad += len(bad)
+    except psycopg2.Error as e:
+        conn.rollback()
+        logger.exception(f"Error inserting or updating data: {e}")
+    finally:
+        cursor.close()
+
+    return results, nbad
+
+
+def count_upserts(results, nrows, nbad=0):
+    """
+    Tallies the outcome of a conditional upsert written with execute_batch_db.
+
+    Input:
+        results: RETURNING (xmax = 0) rows returned for the written rows
+        nrows: number of rows sent
+        nbad: number of quarantined rows
+    Output:
+        Counter with inserted, updated, unchanged and quarantined rows
+    """
+    inserted = sum(1 for res in results if res[0])
+    return Counter(inserted=inserted,
+                   updated=len(results) - inserted,
+                   unchanged=nrows - len(results) - nbad,
+                   quarantined=nbad)
+
+
+def prepared_sql(conn, logger, name, sqlcommand):
+    """
+    Prepares sqlcommand as a named server-side statement on conn (once per
+    connection) and returns the matching EXECUTE command, so repeated calls
+    skip parsing and planning.  The returned command takes the same
+    parameters as sqlcommand and can be passed to execute_select_db or
+    execute_insert_db.
+
+    Input:
+        conn: The connection object to the db (from connect_to_db)
+        logger: logging object
+        name: statement name, unique per SQL text
+        sqlcommand: The PostgreSQL command with %s placeholders
+    Output:
+        "EXECUTE name (%s, ...)" command, or sqlcommand itself if the
+        statement could not be prepared
+    """
+    nparams = sqlcommand.count('%s')
+    if name not in conn.prepared:
+        #number the placeholders: %s -> $1, $2, ...
+        pieces = sqlcommand.rstrip().rstrip(';').split('%s')
+        pgsql = pieces[0] + ''.join(f'${i}{piece}' for i, piece in enumerate(pieces[1:], 1))
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f"PREPARE {name} AS {pgsql}")
+            conn.prepared[name] = sqlcommand
+        except psycopg2.Error as e:
+            conn.rollback()
+            logger.exception(f"Error preparing statement {name}: {e}")
+            return sqlcommand
+        finally:
+            cursor.close()
+
+    conn.prepared_calls[name] += 1
+    if nparams == 0:
+        return f"EXECUTE {name}"
+    return f"EXECUTE {name} ({', '.join(['%s']*nparams)})"
+
+
+def get_prepared_stats(conn, logger):
+    """
+    Plan cache statistics for the statements prepared on conn.  generic_plans
+    and custom_plans come from pg_prepared_statements (PostgreSQL 14+); a
+    statement that keeps using custom plans is being re-planned on every call.
+
+    Input:
+        conn: The connection object to the db (from connect_to_db)
+        logger: logging object
+    Output:
+        list of dicts with name, calls, generic_plans, custom_plans
+    """
+    sql = """
+        SELECT name, generic_plans, custom_plans FROM pg_prepared_statements
+        WHERE from_sql;
+        """
+    res = execute_select_db(conn, logger, sql) or []
+    plans = {row[0]: row[1:] for row in res}
+    return [{'name': name,
+             'calls': conn.prepared_calls[name],
+             'generic_plans': plans.get(name, (None, None))[0],
+             'custom_plans': plans.get(name, (None, None))[1]}
+            for name in conn.prepared]
+
+
+def log_prepared_stats(conn, logger):
+    """
+    Writes the plan cache statistics from get_prepared_stats to the log
+    """
+    for stat in get_prepared_stats(conn, logger):
+        logger.info(f"Prepared {stat['name']}: {stat['calls']} calls, "
+                    f"{stat['generic_plans']} generic plans, {stat['custom_plans']} custom plans")
+
+
+# Data versioning and change tracking
+#
+# Every ingest run that changes station_data records the (station_id, year)
+# pairs it touched in dirty_station_years, stamped with the data version the
+# run will publish, and then bumps data_version.  Jobs that maintain derived
+# tables remember the last data version they processed in job_versions, so
+# each job only recomputes the station-years that changed since its last run.
+
+def init_version_tables(logger):
+    """
+    Connect to the wxdata database and create the data version and change
+    tracking tables.
+    """
+
+    create_table_sql = """
+        CREATE TABLE IF NOT EXISTS data_version (
+            id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+            version BIGINT NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT now()
+        );
+        INSERT INTO data_version (version) VALUES (0) ON CONFLICT DO NOTHING;
+        CREATE TABLE IF NOT EXISTS dirty_station_years (
+            station_id VARCHAR(20) NOT NULL,
+            year INT NOT NULL,
+            version BIGINT NOT NULL,
+            PRIMARY KEY (station_id, year)
+        );
+        CREATE INDEX IF NOT EXISTS dirty_station_years_version ON dirty_station_years (version);
+        CREATE TABLE IF NOT EXISTS job_versions (
+            job VARCHAR(40) PRIMARY KEY,
+            version BIGINT NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT now()
+        );
+    """
+
+    init_table(create_table_sql, logger)
+    grant_select(['data_version', 'job_versions'], logger)
+
+
+def get_data_version(conn, logger):
+    """
+    Output:
+        the current (published) data version, or None on error
+    """
+    res = execute_select_db(conn, logger, "SELECT version FROM data_version;")
+    return res[0][0] if res else None
+
+
+def publish_data_version(conn, logger, version):
+    """
+    Makes version the current data version (never moves it backwards)
+    """
+    sql = """
+        UPDATE data_version SET version = GREATEST(version, %s), updated_at = now();
+        """
+    execute_insert_db(conn, logger, sql, (version,))
+
+
+def mark_dirty(conn, logger, station, years, version):
+    """
+    Records that station changed in years as of data version
+
+    Input:
+        conn: The connection object to the db
+        logger: logging object
+        station: station id
+        years: iterable of years that changed
+        version: data version the change will be published as
+    """
+    sql = """
+        INSERT INTO dirty_station_years (station_id, year, version) VALUES %s
+        ON CONFLICT (station_id, year) DO UPDATE SET version = EXCLUDED.version
+        WHERE dirty_station_years.version < EXCLUDED.version;
+        """
+    rows = [(station, int(year), version) for year in sorted(years)]
+    if rows:
+        execute_batch_db(conn, logger, sql, rows, source='dirty_station_years')
+
+
+def get_job_version(conn, logger, job):
+    """
+    Output:
+        last data version processed by job, or None if the job never ran
+    """
+    res = execute_select_db(conn, logger, "SELECT version FROM job_versions WHERE job = %s;", (job,))
+    return res[0][0] if res else None
+
+
+def set_job_version(conn, logger, job, version):
+    """
+    Records that job has processed all changes up to data version
+    """
+    sql = """
+        INSERT INTO job_versions (job, version) VALUES (%s, %s)
+        ON CONFLICT (job) DO UPDATE SET version = EXCLUDED.version, updated_at = now();
+        """
+    execute_insert_db(conn, logger, sql, (job, version))
+
+
+def count_job_run(conn, logger, job):
+    """
+    Counts a run of job that changed data without a new data version (e.g. a
+    new yield file) in job_versions, so readers keyed on the job versions
+    (the API's hot pages) see the change
+    """
+    sql = """
+        INSERT INTO job_versions (job, version) VALUES (%s, 1)
+        ON CONFLICT (job) DO UPDATE SET version = job_versions.version + 1, updated_at = now();
+        """
+    execute_insert_db(conn, logger, sql, (job,))
+
+
+def get_dirty_station_years(conn, logger, job):
+    """
+    Station-years changed since job last ran
+
+    Input:
+        conn: The connection object to the db
+        logger: logging object
+        job: job name, as passed to set_job_version
+    Output:
+        version, dirty: the current data version and a dict of
+        station id -> sorted list of changed years.  dirty is None if the
+        job has never run (i.e. everything needs to be computed).
+    """
+    version = get_data_version(conn, logger)
+    since = get_job_version(conn, logger, job)
+    if since is None or version is None:
+        return version, None
+
+    sql = """
+        SELECT station_id, year FROM dirty_station_years
+        WHERE version > %s AND version <= %s
+        ORDER BY station_id, year;
+        """
+    dirty = {}
+    for station, year in execute_select_db(conn, logger, sql, (since, version)) or []:
+        dirty.setdefault(station, []).append(year)
+    return version, dirty
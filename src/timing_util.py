@@ -0,0 +1,115 @@
+import cProfile
+import pstats
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Timing and profiling utilities for the ingest and stats jobs
+
+class StageTimer:
+    """
+    Accumulates wall time per named stage, both for the current item
+    (file or station) and for the whole run.
+
+    Usage:
+        timer = StageTimer()
+        with timer.stage('read'):
+            ...
+        timer.log_item(logger, station, nrows)
+        ...
+        timer.log_totals(logger, ntotal)
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.totals = defaultdict(float)
+        self.item = defaultdict(float)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time the enclosed block and add it to stage name
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.item[name] += elapsed
+            self.totals[name] += elapsed
+
+    def merge(self, other):
+        """
+        Add the stage totals of another timer (e.g. of a pipeline thread)
+        """
+        for name, elapsed in other.totals.items():
+            self.totals[name] += elapsed
+
+    def log_item(self, logger, label, nrows):
+        """
+        Log the stage times of the current item and start a new one
+
+        Input:
+            logger: logging object
+            label: name of the item (file or station)
+            nrows: rows processed for the item
+        """
+        stages = ', '.join(f'{name} {elapsed:.3f}s' for name, elapsed in self.item.items())
+        logger.info(f'{label}: {stages}, {nrows} rows')
+        self.reset_item()
+
+    def reset_item(self):
+        """
+        Start a new item without logging the current one (e.g. at a batch
+        boundary, so stages timed after the last item do not show up with the
+        next one); the run totals keep them
+        """
+        self.item = defaultdict(float)
+
+    def summary(self, nrows):
+        """
+        Output:
+            dict with wall time, rows, rows/s and per-stage totals (s)
+        """
+        wall = time.perf_counter() - self.started
+        return {'wall_s': wall,
+                'rows': nrows,
+                'rows_per_s': nrows/wall if wall > 0 else 0.,
+                'stages': dict(self.totals)}
+
+    def log_totals(self, logger, nrows):
+        """
+        Log per-stage totals and throughput for the run
+
+        Input:
+            logger: logging object
+            nrows: rows processed in the run
+        """
+        summary = self.summary(nrows)
+        for name, elapsed in summary['stages'].items():
+            rate = nrows/elapsed if elapsed > 0 else 0.
+            logger.info(f'Stage {name}: {elapsed:.2f}s total ({rate:.0f} rows/s)')
+        logger.info(f"Total: {summary['wall_s']:.2f}s for {nrows} rows "
+                    f"({summary['rows_per_s']:.0f} rows/s)")
+
+
+def run_profiled(func, outfile, logger, *args):
+    """
+    Runs func(*args) under cProfile and dumps the stats to outfile
+    (readable with pstats or snakeviz)
+
+    Input:
+        func: function to run
+        outfile: file name for the profile stats
+        logger: logging object
+    Output:
+        return value of func
+    """
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args)
+    finally:
+        profiler.dump_stats(outfile)
+        top = pstats.Stats(profiler).sort_stats('cumulative')
+        logger.info(f'cProfile stats written to {outfile} '
+                    f'({top.total_calls} calls, {top.total_tt:.2f}s)')
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+#general use libraries
+import argparse
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import psycopg2
+
+import db_util
+from wxgenerate import generate, station_ids
+
+# End-to-end benchmark: for each scale (number of stations), generate
+# synthetic station files, load them into a fresh scratch database with the
+# ingest job, run the stats job and time a set of representative API
+# queries.  Every job runs in its own process so its peak RSS can be
+# measured; results (rows/s, peak RSS, per-stage timings) are written as JSON
+# so runs can be compared between commits.  The jobs log to wxbenchmark.log.
+
+maindir = '../'
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO,
+                    format = '%(asctime)s - %(message)s',
+                    filename=maindir + 'wxbenchmark.log')
+
+# Scratch database, dropped and recreated for every scale
+BENCH_DB = 'wxdata_bench'
+
+# Default scales (stations); the repo's wx_data has 167
+DEFAULT_SCALES = [167, 1670]
+
+# Representative API queries ({station} and {year} are filled in)
+API_QUERIES = {'weather_station': '/api/weather?station_id={station}&per_page=100',
+               'weather_date': '/api/weather?date={year}-07-01&per_page=100',
+               'stats_year': '/api/weather/stats?year={year}&per_page=100',
+               'stats_station': '/api/weather/stats?station_id={station}&per_page=100',
+               'series': '/api/weather/series?station_id={station}',
+               'regional': '/api/weather/regional?start_date={year}-01-01&per_page=100',
+               'percentile': '/api/weather/percentile?variable=max_temperature&q=0.05,0.5,0.95',
+               'trends': '/api/weather/trends?variable=max_temperature_avg&min_years=10&per_page=100',
+               'unknown_station': '/api/weather?station_id=UNKNOWN'}
+API_REPEATS = 20
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process (MB; ru_maxrss is in KB on Linux)
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+
+
+def reset_database(dbname):
+    """
+    Drop and recreate the scratch database dbname
+    """
+    conn = psycopg2.connect(dbname='postgres', user=db_util.dbuser, password=db_util.dbpassword,
+                            host=db_util.dbhost, port=db_util.dbport)
+    conn.autocommit = True #CREATE/DROP DATABASE cannot run in a transaction
+    with conn.cursor() as cursor:
+        cursor.execute(f'DROP DATABASE IF EXISTS {dbname};')
+        cursor.execute(f'CREATE DATABASE {dbname};')
+    conn.close()
+
+
+def bench_api(station, year, repeats=API_REPEATS):
+    """
+    Time each of API_QUERIES repeats times through the Flask test client
+
+    Output:
+        dict of query name -> status, p50_ms, p95_ms, max_ms
+    """
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    import api
+    #the scratch database belongs to the job user, not the read-only web user
+    api.DB_USER, api.DB_PASSWORD = db_util.dbuser, db_util.dbpassword
+    client = api.app.test_client()
+    results = {}
+    for name, url in API_QUERIES.items():
+        url = url.format(station=station, year=year)
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            response = client.get(url)
+            times.append((time.perf_counter() - start)*1000.)
+        times.sort()
+        results[name] = {'status': response.status_code,
+                         'p50_ms': times[len(times)//2],
+                         'p95_ms': times[min(len(times) - 1, int(len(times)*0.95))],
+                         'max_ms': times[-1]}
+    return results
+
+
+def run_job(job, argv):
+    """
+    Run one job (ingest, stats, features or api) of the benchmark in this process and
+    print its summary as JSON on the last line of stdout
+    """
+    if job == 'ingest':
+        import wxdata_ingest
+        summary = wxdata_ingest.main(wxdata_ingest.parse_args(argv))
+    elif job == 'stats':
+        import wxstats_ingest
+        summary = wxstats_ingest.main(wxstats_ingest.parse_args(argv))
+    elif job == 'features':
+        import wxyield_features
+        summary = wxyield_features.main(wxyield_features.parse_args(argv))
+    else:
+        station, year = argv
+        start = time.perf_counter()
+        summary = {'queries': bench_api(station, int(year))}
+        summary['wall_s'] = time.perf_counter() - start
+    summary = summary or {}
+    summary['peak_rss_mb'] = peak_rss_mb()
+    print(json.dumps(summary))
+
+
+def run_job_process(job, argv, dbname):
+    """
+    Run a job in a child process against dbname
+
+    Output:
+        the job's summary dict
+    """
+    env = dict(os.environ, WXDATA_DB=dbname)
+    srcdir = os.path.dirname(os.path.abspath(__file__))
+    res = subprocess.run([sys.executable, os.path.abspath(__file__), '--job', job, '--', *argv],
+                         cwd=srcdir, env=env, capture_output=True, text=True, check=True)
+    return json.loads(res.stdout.strip().splitlines()[-1])
+
+
+def git_commit():
+    """
+    Output:
+        current git commit id, or None outside a git checkout
+    """
+    try:
+        res = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True)
+        return res.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_scale(nstations, args):
+    """
+    Generate, ingest, compute stats and yield features and query the API for one scale
+
+    Output:
+        dict of results for the scale
+    """
+    result = {'stations': nstations, 'first_year': args.first_year, 'last_year': args.last_year,
+              'missing_rate': args.missing_rate}
+    with tempfile.TemporaryDirectory() as datadir:
+        start = time.perf_counter()
+        result['rows_generated'] = generate(datadir, nstations, args.first_year, args.last_year,
+                                            args.missing_rate, args.seed)
+        result['generate_s'] = time.perf_counter() - start
+        logger.info(f'{nstations} stations: generated {result["rows_generated"]} rows '
+                    f'in {result["generate_s"]:.1f}s')
+
+        reset_database(args.db)
+        result['ingest'] = run_job_process('ingest', ['--data-dir', datadir], args.db)
+        logger.info(f'{nstations} stations: ingest {result["ingest"]}')
+    result['stats'] = run_job_process('stats', ['--full'], args.db)
+    logger.info(f'{nstations} stations: stats {result["stats"]}')
+    result['features'] = run_job_process('features', ['--full'], args.db)
+    logger.info(f'{nstations} stations: features {result["features"]}')
+    result['api'] = run_job_process('api', [station_ids(1)[0], str(args.first_year + 1)], args.db)
+    logger.info(f'{nstations} stations: api {result["api"]}')
+    return result
+
+
+def main(args):
+    """
+    Run the benchmark at every scale and write the results as JSON
+    """
+    if args.db == 'wxdata':
+        sys.exit('Refusing to benchmark against (and drop) the wxdata database')
+    logger.info(f'Started benchmark: scales {args.scales}, database {args.db}')
+    results = {'commit': git_commit(),
+               'started': datetime.now().isoformat(timespec='seconds'),
+               'scales': [bench_scale(nstations, args) for nstations in args.scales]}
+    output = json.dumps(results, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    logger.info('Ended benchmark')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark ingest, stats and API queries on synthetic data')
+    parser.add_argument('--scales', type=int, nargs='+', default=DEFAULT_SCALES,
+                        help='numbers of stations to benchmark')
+    parser.add_argument('--first-year', type=int, default=1985)
+    parser.add_argument('--last-year', type=int, default=2014)
+    parser.add_argument('--missing-rate', type=float, default=0.03,
+                        help='fraction of missing values per variable')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--db', default=BENCH_DB,
+                        help='scratch database (dropped and recreated for every scale)')
+    parser.add_argument('--out', help='write the JSON results to this file (default stdout)')
+    parser.add_argument('--job', choices=['ingest', 'stats', 'features', 'api'], help=argparse.SUPPRESS)
+    parser.add_argument('job_args', nargs='*', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.job:
+        run_job(args.job, args.job_args)
+    else:
+        main(args)
@@ -0,0 +1,163 @@
+import numpy as np
+
+from db_util import init_table, grant_select, execute_select_db, execute_batch_db, count_upserts, prepared_sql
+from wxqc import QC_BAD_MAXT, QC_BAD_MINT, QC_BAD_PRECIP
+
+# Day-of-year climatology per station.
+# Days are numbered 1-366 on a leap-year calendar (Mar 1 is always day 61), so
+# a calendar date maps to the same day in every year; see DOY_SQL for the
+# same mapping in SQL.
+
+# Half width (days) of the moving window used to smooth the climatology
+CLIMO_HALF_WINDOW = 7
+
+# Leap-year day number of a date, as used in station_climatology.doy
+DOY_SQL = ("EXTRACT(doy FROM make_date(2000, EXTRACT(month FROM {col})::int, "
+           "EXTRACT(day FROM {col})::int))::int")
+
+# 0-based leap-year day of the first of each month
+_MONTH_START = np.cumsum([0, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30])
+
+# (column prefix, index into the series values, QC flags that exclude the value)
+CLIMO_VARIABLES = [('max_temperature', 0, QC_BAD_MAXT),
+                   ('min_temperature', 1, QC_BAD_MINT),
+                   ('precipitation', 2, QC_BAD_PRECIP)]
+
+
+def init_climatology_table(logger):
+    """
+    Connect to the wxdata database and create the station_climatology table.
+    """
+
+    create_table_sql = """
+        CREATE TABLE IF NOT EXISTS station_climatology (
+            station_id VARCHAR(20) NOT NULL,
+            doy SMALLINT NOT NULL,
+            max_temperature_mean DECIMAL(7, 2),
+            max_temperature_std DECIMAL(7, 2),
+            min_temperature_mean DECIMAL(7, 2),
+            min_temperature_std DECIMAL(7, 2),
+            precipitation_mean DECIMAL(7, 2),
+            precipitation_std DECIMAL(7, 2),
+            number_obs INT NOT NULL,
+            PRIMARY KEY (station_id, doy)
+        );
+    """
+
+    init_table(create_table_sql, logger)
+    grant_select(['station_climatology'], logger)
+
+
+def get_station_series(conn, station, logger):
+    """
+    Get the full daily series of a station
+    Input:
+        conn: The connection object to the db
+        station: station id
+        logger: logging object
+    Output:
+        dates, values, flags: datetime64[D] array, (n, 3) float array of
+        max T, min T and precip, int array of QC flags
+    """
+    sql = prepared_sql(conn, logger, 'station_series', """
+        SELECT date, max_temperature, min_temperature, precipitation, qc_flags
+        FROM station_data WHERE station_id = %s ORDER BY date;
+        """)
+    res = execute_select_db(conn, logger, sql, (station,)) or []
+    dates = np.array([row[0] for row in res], dtype='datetime64[D]')
+    values = np.array([row[1:4] for row in res], dtype=float).reshape(-1, 3)
+    flags = np.array([row[4] for row in res], dtype=int)
+    return dates, values, flags
+
+
+def leap_doy(dates):
+    """
+    0-based leap-year day number (0-365) of each date
+    """
+    months = dates.astype('datetime64[M]')
+    return _MONTH_START[months.astype(int) % 12] + (dates - months).astype(int)
+
+
+def _smooth(counts, half=CLIMO_HALF_WINDOW):
+    """
+    Circular moving sum over 2*half+1 days
+    """
+    padded = np.concatenate((counts[-half:], counts, counts[:half]))
+    return np.convolve(padded, np.ones(2*half + 1), mode='valid')
+
+
+def climatology(dates, values, flags, half=CLIMO_HALF_WINDOW):
+    """
+    Smoothed day-of-year mean and standard deviation of each variable
+
+    Input:
+        dates, values, flags: output of get_station_series
+        half: half width of the smoothing window in days
+    Output:
+        means, stds: (366, 3) arrays (NaN where there is no data), and
+        nobs: (366,) number of days in each (unsmoothed) day of year
+    """
+    doy = leap_doy(dates)
+    means = np.full((366, 3), np.nan)
+    stds = np.full((366, 3), np.nan)
+    for _, i, badflags in CLIMO_VARIABLES:
+        ok = ~np.isnan(values[:, i]) & (flags & badflags == 0)
+        x = values[ok, i]
+        n = _smooth(np.bincount(doy[ok], minlength=366).astype(float), half)
+        s1 = _smooth(np.bincount(doy[ok], weights=x, minlength=366), half)
+        s2 = _smooth(np.bincount(doy[ok], weights=x*x, minlength=366), half)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means[:, i] = s1/n
+            var = (s2 - n*means[:, i]**2)/(n - 1)
+        stds[:, i] = np.sqrt(np.clip(var, 0., None))
+    return means, stds, np.bincount(doy, minlength=366)
+
+
+def upsert_climatology(conn, station, means, stds, nobs, logger):
+    """
+    Inserts or updates (only if any value differs) a station's climatology
+
+    Input:
+        conn: The connection object to the db
+        station: station id
+        means, stds, nobs: output of climatology
+        logger: logging object
+    Output:
+        Counter with inserted, updated, unchanged and quarantined rows
+    """
+
+    sql = """
+    INSERT INTO station_climatology
+            (station_id, doy,
+             max_temperature_mean, max_temperature_std,
+             min_temperature_mean, min_temperature_std,
+             precipitation_mean, precipitation_std, number_obs)
+    VALUES %s
+    ON CONFLICT (station_id, doy) DO UPDATE
+    SET max_temperature_mean = EXCLUDED.max_temperature_mean,
+        max_temperature_std = EXCLUDED.max_temperature_std,
+        min_temperature_mean = EXCLUDED.min_temperature_mean,
+        min_temperature_std = EXCLUDED.min_temperature_std,
+        precipitation_mean = EXCLUDED.precipitation_mean,
+        precipitation_std = EXCLUDED.precipitation_std,
+        number_obs = EXCLUDED.number_obs
+    WHERE (station_climatology.max_temperature_mean, station_climatology.max_temperature_std,
+           station_climatology.min_temperature_mean, station_climatology.min_temperature_std,
+           station_climatology.precipitation_mean, station_climatology.precipitation_std,
+           station_climatology.number_obs)
+          IS DISTINCT FROM
+          (EXCLUDED.max_temperature_mean, EXCLUDED.max_temperature_std,
+           EXCLUDED.min_temperature_mean, EXCLUDED.min_temperature_std,
+           EXCLUDED.precipitation_mean, EXCLUDED.precipitation_std,
+           EXCLUDED.number_obs)
+    RETURNING (xmax = 0);
+    """
+    #interleave mean/std per variable, NaN -> NULL
+    stats = np.empty((366, 6))
+    stats[:, 0::2] = means
+    stats[:, 1::2] = stds
+    stats = stats.round(2).astype(object)
+    stats[np.isnan(stats.astype(float))] = None
+    rows = [(station, doy + 1, *stats[doy], int(nobs[doy])) for doy in range(366)]
+    results, nbad = execute_batch_db(conn, logger, sql, rows, source='station_climatology', fetch=True)
+    return count_upserts(results, len(rows), nbad)
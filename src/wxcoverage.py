@@ -0,0 +1,115 @@
+from datetime import date, timedelta
+
+from db_util import init_table, grant_select, execute_insert_db, prepared_sql
+from wxqc import QC_BAD_MAXT, QC_BAD_MINT, QC_BAD_PRECIP
+from wxclimo import DOY_SQL
+
+# Per station-year coverage bitmaps.
+# station_coverage holds one BIT(366) string per station, year and variable
+# with bit i (0 = leftmost) set when the station has a good (not QC flagged)
+# value on leap-year day i (Jan 1 = 0, Feb 29 = 59, Dec 31 = 365), so gap and
+# completeness questions are bitwise operations on a single row.
+
+# (variable, column, QC flags that exclude the value)
+COVERAGE_VARIABLES = [('max_temperature', 'max_temperature', QC_BAD_MAXT),
+                      ('min_temperature', 'min_temperature', QC_BAD_MINT),
+                      ('precipitation', 'precipitation', QC_BAD_PRECIP)]
+
+COVERAGE_BITS = 366
+
+
+def init_coverage_table(logger):
+    """
+    Connect to the wxdata database and create the station_coverage table.
+    """
+
+    create_table_sql = f"""
+        CREATE TABLE IF NOT EXISTS station_coverage (
+            station_id VARCHAR(20) NOT NULL,
+            year INT NOT NULL,
+            variable VARCHAR(20) NOT NULL,
+            days BIT({COVERAGE_BITS}) NOT NULL,
+            number_days INT NOT NULL,
+            PRIMARY KEY (station_id, year, variable)
+        );
+    """
+
+    init_table(create_table_sql, logger)
+    grant_select(['station_coverage'], logger)
+
+
+def refresh_coverage(conn, station, years, logger):
+    """
+    Rebuild the coverage bitmaps of a station for the given years.  Rows are
+    only rewritten where the bitmap changed.
+
+    Input:
+        conn: The connection object to the db
+        station: station id
+        years: iterable of years that changed
+        logger: logging object
+    """
+    if not years:
+        return
+    variables = ', '.join(f"('{name}', d.{col}, {badflags})"
+                          for name, col, badflags in COVERAGE_VARIABLES)
+    #one bit per day: OR together single-bit strings, empty bitmap if no good values
+    sql = prepared_sql(conn, logger, 'refresh_coverage', f"""
+    INSERT INTO station_coverage (station_id, year, variable, days, number_days)
+    SELECT d.station_id, date_part('year', d.date)::int, v.variable,
+           COALESCE(bit_or(set_bit(repeat('0', {COVERAGE_BITS})::bit({COVERAGE_BITS}),
+                                   {DOY_SQL.format(col='d.date')} - 1, 1)) FILTER (WHERE v.ok),
+                    repeat('0', {COVERAGE_BITS})::bit({COVERAGE_BITS})),
+           COUNT(*) FILTER (WHERE v.ok)
+    FROM station_data d
+    CROSS JOIN LATERAL (
+        SELECT variable, value IS NOT NULL AND d.qc_flags & badflags = 0 AS ok
+        FROM (VALUES {variables}) AS t(variable, value, badflags)
+    ) v
+    WHERE d.station_id = %s
+      AND d.date BETWEEN make_date(%s, 1, 1) AND make_date(%s, 12, 31)
+    GROUP BY 1, 2, 3
+    ON CONFLICT (station_id, year, variable) DO UPDATE
+    SET days = EXCLUDED.days,
+        number_days = EXCLUDED.number_days
+    WHERE station_coverage.days IS DISTINCT FROM EXCLUDED.days;
+    """)
+    execute_insert_db(conn, logger, sql, (station, min(years), max(years)))
+
+
+def leap_doy_of(day):
+    """
+    0-based leap-year day number of a date (bit position in station_coverage.days)
+    """
+    return (date(2000, day.month, day.day) - date(2000, 1, 1)).days
+
+
+def doy_to_date(year, doy):
+    """
+    Date of 0-based leap-year day doy in year (None for Feb 29 of a non-leap year)
+    """
+    day = date(2000, 1, 1) + timedelta(days=doy)
+    try:
+        return date(year, day.month, day.day)
+    except ValueError:
+        return None
+
+
+def period_mask(year, start=None, end=None):
+    """
+    Bit string with the days of year between start and end (dates, inclusive,
+    default the whole year) set; Feb 29 is only set in leap years
+    """
+    first = leap_doy_of(start) if start else 0
+    last = leap_doy_of(end) if end else COVERAGE_BITS - 1
+    return ''.join('1' if first <= doy <= last and doy_to_date(year, doy) else '0'
+                   for doy in range(COVERAGE_BITS))
+
+
+def missing_dates(year, days, mask):
+    """
+    Dates set in mask but not in days (bit strings as returned by psycopg2)
+    """
+    return [doy_to_date(year, doy) for doy in range(COVERAGE_BITS)
+            if mask[doy] == '1' and days[doy] == '0']
+
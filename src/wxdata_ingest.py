@@ -1,12 +1,29 @@
 #!/usr/bin/env python
 
 #general use libraries
+import argparse
 import glob
+import hashlib
+import io
 import logging
+import os
+import queue
+import threading
+from collections import Counter, namedtuple
 import pandas as pd
 
 #database libraries (local)
-from db_util import connect_to_db, init_table, execute_insert_db #local library
+from db_util import (connect_to_db, init_table, grant_select, init_quarantine_table, #local library
+                     execute_batch_db, execute_select_db, count_upserts,
+                     enable_query_profiling, log_query_profile, init_version_tables,
+                     get_data_version, publish_data_version, mark_dirty,
+                     get_dirty_station_years, set_job_version, count_job_run)
+from timing_util import StageTimer, run_profiled
+from wxqc import qc_flags, FLAT_RUN, QC_DUP_DATE
+from wxpyramid import init_pyramid_table, refresh_pyramid
+from wxregional import init_regional_table, refresh_regional
+from wxcoverage import init_coverage_table, refresh_coverage
+from wxwatch import make_watcher, next_batch, POLL_INTERVAL_S
 
 
 #maindir
@@ -23,6 +40,26 @@ dbpassword = "test"
 dbhost = "localhost"
 dbport = "5432"
 
+# Name of the rebuild of the derived tables in job_versions, which counts its
+# runs (see rebuild_derived)
+REBUILD_JOB = 'ingest_rebuild'
+
+# Longest wait for file changes before the watch loop checks again (s)
+WATCH_TIMEOUT_S = 60.
+
+# Pipelined ingest: bytes read per chunk, and chunks buffered between stages
+CHUNK_BYTES = 1 << 20
+QUEUE_CHUNKS = 4
+# Rows of a station carried to its next chunk: flags of a row depend on up to
+# FLAT_RUN rows before it, so the carried tail holds that much context as well
+TAIL_ROWS = 2*FLAT_RUN
+
+# Messages between pipeline stages; _DONE ends the stream
+# (file identity: inode, modification time and sha1 of the bytes read so far)
+Chunk = namedtuple('Chunk', ['file', 'ident', 'data', 'offset', 'first', 'last', 'tail'])
+Parsed = namedtuple('Parsed', ['file', 'ident', 'rows', 'offset', 'last', 'tail'])
+_DONE = None
+
 
 def init_station_table(logger):
     """
@@ -36,38 +73,53 @@ def init_station_table(logger):
             max_temperature DECIMAL(7, 2),
             min_temperature DECIMAL(7, 2),
             precipitation DECIMAL(7, 2),
+            qc_flags SMALLINT NOT NULL DEFAULT 0,
             PRIMARY KEY (station_id, date)
         );
+        ALTER TABLE station_data ADD COLUMN IF NOT EXISTS qc_flags SMALLINT NOT NULL DEFAULT 0;
     """
 
-    return init_table(create_table_sql, logger)
+    init_table(create_table_sql, logger)
+    grant_select(['station_data'], logger)
 
 
-def upsert_station_data(conn, data, logger):
+def upsert_station_data_batch(conn, rows, logger, source=None):
     """
-    Inserts data into the station_data table or updates the record
-    if station_id and date already exist.
+    Inserts rows into the station_data table or updates the record if
+    station_id and date already exist and any value differs.  Writes rows in
+    multi-row batches, committing every batch and quarantining rows that
+    cannot be written.
 
     Input:
         conn: The connection object to the db
-        data: a tuple containing:
-            station_id: station id (key)
-            date: date to be added (key)
-            maxt: maximum temperature (C)
-            mint: minimum temperature (C)
-            precip: accumulated precipitation (mm)
-
+        rows: list of (station_id, date, maxt, mint, precip, qcflags) tuples
+              (temperatures in C, precipitation in mm, qcflags the wxqc bitmask)
+        logger: logging object
+        source: label stored with quarantined rows (e.g. the input file)
+    Output:
+        counts, dates: Counter with inserted, updated, unchanged and
+                       quarantined rows, and the set of dates with
+                       inserted or updated rows
     """
 
     sql = """
-    INSERT INTO station_data (station_id, date, max_temperature, min_temperature, precipitation)
-    VALUES (%s, %s, %s, %s, %s)
+    INSERT INTO station_data
+            (station_id, date, max_temperature, min_temperature, precipitation, qc_flags)
+    VALUES %s
     ON CONFLICT (station_id, date) DO UPDATE
     SET max_temperature = EXCLUDED.max_temperature,
         min_temperature = EXCLUDED.min_temperature,
-        precipitation = EXCLUDED.precipitation;
+        precipitation = EXCLUDED.precipitation,
+        qc_flags = EXCLUDED.qc_flags
+    WHERE (station_data.max_temperature, station_data.min_temperature,
+           station_data.precipitation, station_data.qc_flags)
+          IS DISTINCT FROM
+          (EXCLUDED.max_temperature, EXCLUDED.min_temperature,
+           EXCLUDED.precipitation, EXCLUDED.qc_flags)
+    RETURNING (xmax = 0), date;
     """
-    execute_insert_db(conn, logger, sql, data=data)
+    results, nbad = execute_batch_db(conn, logger, sql, rows, source=source, fetch=True)
+    return count_upserts(results, len(rows), nbad), {res[1] for res in results}
 
 
 def wxconv(x):
@@ -76,47 +128,466 @@ def wxconv(x):
     """
     return int(x)/10.
 
-if __name__ == "__main__":
+def station_from_file(file):
+    """
+    get station ID from the file name (e.g. wx_data/USC00110072.txt)
+    """
+    return os.path.splitext(os.path.basename(file))[0]
+
+def read_station_file(source):
+    """
+    read GHCN station data, set column names, set date column to date,
+    convert data to actual values and drop rows where all data are missing
+
+    Input:
+        source: file name or file-like object
+    Output:
+        DataFrame with Date, MaxTemp, MinTemp and Precip columns
+    """
+    df = pd.read_csv(source, sep='\t', header=None, parse_dates=[0],
+                     converters={1:wxconv, 2:wxconv, 3:wxconv},
+                     names=['Date','MaxTemp','MinTemp','Precip'])
+    df = df.astype({'MaxTemp': 'float','MinTemp':'float', 'Precip':'float'})
+    df.replace(-999.9, None, inplace=True) #set missing to None
+    return df.dropna(subset=['MaxTemp','MinTemp','Precip'])
+
+def qc_station_data(df):
+    """
+    check data for valid ranges, unphysical values (min > max, etc),
+    spikes, flat lines and duplicate dates; flag rather than drop
+
+    Output:
+        df sorted by date with a QCFlags column and one row per date
+    """
+    df = df.sort_values('Date', kind='stable')
+    df['QCFlags'] = qc_flags(df['Date'].values.astype('datetime64[D]'),
+                             df['MaxTemp'].values, df['MinTemp'].values,
+                             df['Precip'].values)
+    return df[~df['Date'].duplicated(keep='last')] #last value wins, as with row upserts
+
+def qc_with_context(df, tail):
+    """
+    QC a chunk of a station's rows together with the last rows before it, so
+    spike, flat line and duplicate checks see across the join
+
+    Input:
+        df: new rows as from read_station_file
+        tail: last TAIL_ROWS rows already QC'd (with QCFlags), or None
+    Output:
+        rows, tail: the QC'd rows to write (new rows, and rows of the old
+                    tail whose flags changed) and the tail for the next chunk
+    """
+    if tail is None or tail.empty:
+        df = qc_station_data(df)
+        return df, df.tail(TAIL_ROWS)
+    df = pd.concat([tail, df], ignore_index=True)
+    oldflags = df.pop('QCFlags')
+    df = qc_station_data(df)
+    #the tail holds one row per date, so keep the duplicate flags it already had
+    oldflags = oldflags.reindex(df.index)
+    df['QCFlags'] |= oldflags.fillna(0).astype(df['QCFlags'].dtype) & QC_DUP_DATE
+    #the first rows of the tail miss the rows before them and are only context;
+    #new rows can change flags of at most the last FLAT_RUN rows before them
+    context = df.index < len(tail) - FLAT_RUN
+    return df[~context & (oldflags != df['QCFlags'])], df.tail(TAIL_ROWS)
+
+def read_chunks(file, offset=0, whole=True):
+    """
+    Read a station file from offset in chunks of about CHUNK_BYTES that end
+    at a line break
+
+    Input:
+        file: station file
+        offset: byte offset to start from
+        whole: also return a last line without a line break (otherwise it
+               is left for a later read)
+    Output:
+        generator of (chunk bytes, offset after the chunk)
+    """
+    with open(file, 'rb') as f:
+        f.seek(offset)
+        rest = b''
+        while True:
+            data = f.read(CHUNK_BYTES)
+            if not data:
+                break
+            data = rest + data
+            cut = data.rfind(b'\n') + 1
+            data, rest = data[:cut], data[cut:]
+            if data:
+                offset += len(data)
+                yield data, offset
+        if whole and rest:
+            yield rest, offset + len(rest)
+
+def _put(q, item, stop):
+    """
+    Put item on a bounded queue, waiting while it is full (backpressure)
+    unless the pipeline is stopped
+    """
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _get(q, stop):
+    """
+    Get the next item from a queue, or _DONE once the pipeline is stopped
+    """
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return _DONE
+
+def prefix_sha1(file, nbytes):
+    """
+    sha1 (hashlib object) of the first nbytes of a file
+    """
+    sha1 = hashlib.sha1()
+    with open(file, 'rb') as f:
+        while nbytes > 0:
+            data = f.read(min(CHUNK_BYTES, nbytes))
+            if not data:
+                break
+            sha1.update(data)
+            nbytes -= len(data)
+    return sha1
+
+def _reader(files, state, out_q, stop, timer):
+    """
+    Pipeline stage 1 (I/O): read station files in chunks.  With state, only
+    the lines added since the previous read of each file are read, and the
+    whole file if it is new, was replaced, got shorter or was rewritten in
+    place (modified, and the bytes read before differ).
+    """
+    try:
+        for file in files:
+            ident, offset, tail = None, 0, None
+            if state is not None:
+                stat = os.stat(file)
+                (inode, mtime, sha1), offset, tail = state.get(file, ((None, None, None), 0, None))
+                with timer.stage('read'):
+                    if (stat.st_ino != inode or stat.st_size < offset
+                            or (stat.st_mtime_ns != mtime
+                                and prefix_sha1(file, offset).digest() != sha1.digest())):
+                        offset, tail, sha1 = 0, None, hashlib.sha1()
+                #the sha1 goes on with the bytes read now (a copy: the state keeps the old one)
+                ident = (stat.st_ino, stat.st_mtime_ns, sha1.copy())
+            first = True
+            chunks = read_chunks(file, offset, whole=state is None)
+            while True:
+                with timer.stage('read'):
+                    chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                data, offset = chunk
+                if ident is not None:
+                    ident[2].update(data)
+                if not _put(out_q, Chunk(file, ident, data, offset, first, False, tail), stop):
+                    return
+                first = False
+            if not _put(out_q, Chunk(file, ident, b'', offset, first, True, tail), stop):
+                return
+        _put(out_q, _DONE, stop)
+    except Exception as e:
+        _put(out_q, e, stop)
+
+def _parser(in_q, out_q, stop, timer):
+    """
+    Pipeline stage 2 (CPU): parse, clean and QC chunks, carrying the tail of
+    each file's previous chunk
+    """
+    try:
+        tail = None
+        while True:
+            chunk = _get(in_q, stop)
+            if chunk is _DONE or isinstance(chunk, Exception):
+                _put(out_q, chunk, stop)
+                return
+            if chunk.first:
+                tail = chunk.tail
+            rows = None
+            if chunk.data:
+                with timer.stage('parse'):
+                    rows, tail = qc_with_context(read_station_file(io.BytesIO(chunk.data)), tail)
+            if not _put(out_q, Parsed(chunk.file, chunk.ident, rows, chunk.offset, chunk.last, tail),
+                        stop):
+                return
+    except Exception as e:
+        _put(out_q, e, stop)
+
+def write_rows(conn, station, df, source, logger):
+    """
+    Upsert a chunk of a station's QC'd data
+
+    Output:
+        counts, dates: as from upsert_station_data_batch
+    """
+    rows = list(zip([station]*len(df), df['Date'].dt.date.tolist(),
+                    df['MaxTemp'].tolist(), df['MinTemp'].tolist(),
+                    df['Precip'].tolist(), df['QCFlags'].tolist()))
+    return upsert_station_data_batch(conn, rows, logger, source=source)
+
+def finish_station(conn, station, years, version, timer, logger):
+    """
+    Mark the station-years changed by an ingest with version and refresh
+    their pyramid levels and coverage bitmaps
+    """
+    with timer.stage('write'):
+        mark_dirty(conn, logger, station, years, version)
+    with timer.stage('pyramid'):
+        refresh_pyramid(conn, station, years, logger)
+    with timer.stage('coverage'):
+        refresh_coverage(conn, station, years, logger)
+
+def rebuild_derived(conn, timer, logger):
+    """
+    Refresh the pyramid levels and coverage bitmaps of every station-year in
+    station_data and the regional aggregates of every date.  The ingest only
+    refreshes what it changes, so this backfills the derived tables for data
+    loaded before they existed.  Rows are only rewritten where a value
+    changed; the run is recorded in job_versions so the API rebuilds its
+    cached pages.
+    """
+    sql = "SELECT station_id, MIN(date), MAX(date) FROM station_data GROUP BY station_id;"
+    stations = execute_select_db(conn, logger, sql) or []
+    for station, first, last in stations:
+        years = range(first.year, last.year + 1)
+        with timer.stage('pyramid'):
+            refresh_pyramid(conn, station, years, logger)
+        with timer.stage('coverage'):
+            refresh_coverage(conn, station, years, logger)
+    dates = execute_select_db(conn, logger, "SELECT DISTINCT date FROM station_data;") or []
+    with timer.stage('regional'):
+        refresh_regional(conn, [row[0] for row in dates], logger)
+    count_job_run(conn, logger, REBUILD_JOB)
+    logger.info(f'Rebuilt the derived tables of {len(stations)} stations and {len(dates)} dates')
+
+def ingest_files(conn, files, timer, logger, state=None):
+    """
+    Ingest station files, refresh the regional aggregates of the changed
+    dates and publish the changes as the next data version.
+
+    Files go through a three stage pipeline connected by bounded queues:
+    a reader thread reads them in chunks of about CHUNK_BYTES, a parser
+    thread parses and QCs the chunks and this thread writes them to the
+    database, so file I/O, parsing and database writes overlap and memory
+    stays bounded by the queue sizes whatever the file sizes.
+
+    Input:
+        conn: The connection object to the db
+        files: list of station files
+        timer: StageTimer
+        logger: logging object
+        state: dict of file -> (ident, offset, tail) to only read lines
+               added since the previous call (updated in place); None reads
+               whole files
+    Output:
+        counts, ningest, changed: Counter with inserted, updated, unchanged
+                                  and quarantined rows, the number of rows
+                                  written and whether anything changed
+    """
+    #the first file's item starts here, not with stages timed before the call
+    timer.reset_item()
+    #changes made by this run are published as the next data version
+    version = (get_data_version(conn, logger) or 0) + 1
+    counts = Counter() #inserted/updated/unchanged/quarantined rows
+    ningest = 0
+    changed_dates = set()
+
+    stop = threading.Event()
+    chunk_q = queue.Queue(maxsize=QUEUE_CHUNKS)
+    parsed_q = queue.Queue(maxsize=QUEUE_CHUNKS)
+    reader_timer, parser_timer = StageTimer(), StageTimer()
+    threads = [threading.Thread(target=_reader, args=(files, state, chunk_q, stop, reader_timer),
+                                daemon=True),
+               threading.Thread(target=_parser, args=(chunk_q, parsed_q, stop, parser_timer),
+                                daemon=True)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        dates, nrows = set(), 0 #of the current file
+        while True:
+            with timer.stage('wait'):
+                parsed = _get(parsed_q, stop)
+            if parsed is _DONE:
+                break
+            if isinstance(parsed, Exception):
+                raise parsed
+            station = station_from_file(parsed.file)
+            if parsed.rows is not None and not parsed.rows.empty:
+                #add data to database in batches
+                with timer.stage('write'):
+                    chunkcounts, chunkdates = write_rows(conn, station, parsed.rows,
+                                                         parsed.file, logger)
+                dates |= chunkdates
+                counts.update(chunkcounts)
+                nrows += len(parsed.rows) - chunkcounts['quarantined']
+            if parsed.last:
+                finish_station(conn, station, {date.year for date in dates}, version, timer, logger)
+                if state is not None:
+                    state[parsed.file] = (parsed.ident, parsed.offset, parsed.tail)
+                changed_dates |= dates
+                ningest += nrows
+                timer.log_item(logger, station, nrows)
+                dates, nrows = set(), 0
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    timer.merge(reader_timer)
+    timer.merge(parser_timer)
+
+    #regional aggregates span stations, so refresh them once for all changed dates
+    with timer.stage('regional'):
+        refresh_regional(conn, changed_dates, logger)
+    if changed_dates:
+        publish_data_version(conn, logger, version)
+        logger.info(f'Published data version {version}')
+    return counts, ningest, bool(changed_dates)
+
+def log_counts(counts, ningest, logger):
+    logger.info(f'Successfully ingested {ningest} rows '
+                f'({counts["inserted"]} inserted, {counts["updated"]} updated, '
+                f'{counts["unchanged"]} unchanged, {counts["quarantined"]} quarantined)')
+
+def update_stats(conn, timer, logger):
+    """
+    Run the incremental stats job for the station-years changed since its last run
+    """
+    #imported here so wxstats_ingest does not set up logging before this module
+    from wxstats_ingest import update_station_stats, JOB_NAME as STATS_JOB
+
+    version, dirty = get_dirty_station_years(conn, logger, STATS_JOB)
+    if dirty is None:
+        logger.info('Stats job has not run yet; run wxstats_ingest.py to build the statistics')
+        return
+    #own timer for the per-station items; its stage totals go to the run's
+    stats_timer = StageTimer()
+    with timer.stage('stats'):
+        update_station_stats(conn, dirty, stats_timer, logger)
+    timer.merge(stats_timer)
+    set_job_version(conn, logger, STATS_JOB, version)
+
+def watch(conn, args, timer):
+    """
+    Ingest the whole directory once, then ingest only the lines appended to
+    new or modified station files in micro-batches as they arrive, followed
+    by an incremental stats update, until interrupted
+    """
+    wxdir = args.data_dir
+    state = {}
+    #watch before the first pass, so files written during it are seen; the
+    #first batch then holds them (the state skips what the pass already read)
+    watcher = make_watcher(wxdir, '.txt', logger, poll=args.poll, interval_s=args.poll_s)
+    logger.info(f'Watching {wxdir} ({type(watcher).__name__})')
+    try:
+        counts, ningest, changed = ingest_files(conn, sorted(glob.glob(wxdir + '/*txt')),
+                                                timer, logger, state)
+        if changed:
+            update_stats(conn, timer, logger)
+        log_counts(counts, ningest, logger)
+        timer.log_totals(logger, ningest)
+
+        while True:
+            files = next_batch(watcher, WATCH_TIMEOUT_S)
+            if not files:
+                continue
+            batch_timer = StageTimer()
+            counts, ningest, changed = ingest_files(conn, sorted(files), batch_timer, logger, state)
+            if changed:
+                update_stats(conn, batch_timer, logger)
+            log_counts(counts, ningest, logger)
+            batch_timer.log_totals(logger, ningest)
+    except KeyboardInterrupt:
+        logger.info('Watch stopped')
+    finally:
+        watcher.close()
+
+def main(args):
+    """
+    Ingest all GHCN station files in wx_data into station_data (and, with
+    --watch, keep ingesting changes to them)
+
+    Input:
+        args: parsed command line arguments (see parse_args)
+    Output:
+        timer summary of the run (see StageTimer.summary), None without a database
+    """
+    if args.profile_sql:
+        enable_query_profiling(args.slow_ms, args.explain)
 
     #create table if not already created
     mytable = init_station_table(logger)
+    init_quarantine_table(logger)
+    init_version_tables(logger)
+    init_pyramid_table(logger)
+    init_regional_table(logger)
+    init_coverage_table(logger)
 
 
     #process weather data
     logger.info('Started ')
 
+    timer = StageTimer()
+    conn = connect_to_db(logger)
+    if conn is None:
+        return None
+
     ningest = 0
-    wxfiles = glob.glob(maindir+'wx_data/*txt') #get list of files
-    for file in wxfiles:
-        #read GHCN station data from file, set column names,
-        #set date column to date, convert data to actual values
-        df = pd.read_csv(file,sep='\t', header=None, parse_dates=[0],
-                         converters={1:wxconv, 2:wxconv, 3:wxconv},
-                         names=['Date','MaxTemp','MinTemp','Precip'])
-
-        # deal with missing data
-        df = df.astype({'MaxTemp': 'float','MinTemp':'float', 'Precip':'float'})
-        df.replace(-999.9, None, inplace=True) #set missing to None
-        df = df.dropna(subset=['MaxTemp','MinTemp','Precip']) #drop rows where all data are missing
-
-        #get station ID from the file name
-        station = file.lstrip(maindir+'/wx_data/').rstrip('.txt') #get station ID
-
-        #TBD: check data for valid ranges, unphysical values (min > max, etc)
-
-        #add data to database
-        conn = connect_to_db(logger)
-        if conn is not None:
-            for idx,row in df.iterrows():
-                #only put rows where data exists in the database
-                if ((row['MaxTemp'] is not None)
-                    and (row['MinTemp'] is not None)
-                    and (row['Precip'] is not None)):
-                    data = (station, row['Date'],row['MaxTemp'],row['MinTemp'],row['Precip'])
-                    upsert_station_data(conn, data, logger)
-                    ningest += 1
-
-
-    message = f'Successfully ingested {ningest} rows'
-    logger.info(message)
+    if args.full:
+        rebuild_derived(conn, timer, logger)
+    if args.watch:
+        watch(conn, args, timer)
+    else:
+        wxfiles = glob.glob(os.path.join(args.data_dir, '*txt')) #get list of files
+        counts, ningest, _ = ingest_files(conn, wxfiles, timer, logger)
+        log_counts(counts, ningest, logger)
+        timer.log_totals(logger, ningest)
+    conn.close()
+
+    log_query_profile(logger)
     logger.info('Ended')
+    return timer.summary(ningest)
+
+
+def parse_args(argv=None):
+    """
+    Parse command line arguments (sys.argv if argv is None)
+    """
+    parser = argparse.ArgumentParser(description='Ingest GHCN station files into station_data')
+    parser.add_argument('--profile-sql', action='store_true',
+                        help='time every statement and log a query profile at the end')
+    parser.add_argument('--slow-ms', type=float, default=250.,
+                        help='log statements slower than this many ms (with --profile-sql)')
+    parser.add_argument('--explain', action='store_true',
+                        help='log EXPLAIN (ANALYZE, BUFFERS) for slow statements')
+    parser.add_argument('--data-dir', default=maindir + 'wx_data',
+                        help='directory of GHCN station files (default ../wx_data)')
+    parser.add_argument('--full', action='store_true',
+                        help='also rebuild the pyramid, coverage and regional tables for all '
+                             'station data, not only for what the ingest changes')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running and ingest new or modified station files as they arrive')
+    parser.add_argument('--poll', action='store_true',
+                        help='with --watch, poll the directory instead of using inotify')
+    parser.add_argument('--poll-s', type=float, default=POLL_INTERVAL_S,
+                        help='seconds between directory scans when polling')
+    parser.add_argument('--cprofile', metavar='FILE',
+                        help='run under cProfile and write the stats to FILE')
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    if args.cprofile:
+        run_profiled(main, args.cprofile, logger, args)
+    else:
+        main(args)
@@ -0,0 +1,130 @@
+import threading
+import time
+from collections import namedtuple
+
+import psycopg2
+
+# In-process station directory for the API.
+# Holds every station id with its first and last date, so requests for
+# unknown stations or dates outside a station's data can be answered without
+# a database round trip.  The directory is reloaded when the
+# published data version (data_version) changes, checked at most every
+# DIRECTORY_CHECK_S seconds.
+
+DIRECTORY_CHECK_S = 30.
+
+StationInfo = namedtuple('StationInfo', ['first_date', 'last_date'])
+
+# station ids by skipping through the station_data primary key index (one
+# index probe per station instead of a scan of all rows), and first and last
+# dates from the same index
+DIRECTORY_SQL = """
+    WITH RECURSIVE ids AS (
+        (SELECT station_id FROM station_data ORDER BY station_id LIMIT 1)
+        UNION ALL
+        SELECT (SELECT d.station_id FROM station_data d WHERE d.station_id > ids.station_id
+                ORDER BY d.station_id LIMIT 1)
+        FROM ids WHERE ids.station_id IS NOT NULL
+    )
+    SELECT ids.station_id,
+           (SELECT MIN(date) FROM station_data d WHERE d.station_id = ids.station_id),
+           (SELECT MAX(date) FROM station_data d WHERE d.station_id = ids.station_id)
+    FROM ids WHERE ids.station_id IS NOT NULL;
+    """
+
+
+class StationDirectory:
+    """
+    Station ids and date ranges with data, reloaded on data version change
+
+    Attributes:
+        stations: dict of station id -> StationInfo
+        version: data version the directory was loaded at (None until loaded)
+        first_year, last_year: range of years over all stations
+    """
+
+    def __init__(self, connect, check_s=DIRECTORY_CHECK_S, release=None):
+        """
+        Input:
+            connect: function returning a new database connection (or None)
+            check_s: seconds between data version checks
+            release: function to give back a connection from connect
+                     (default closes it)
+        """
+        self.connect = connect
+        self.release = release
+        self.check_s = check_s
+        self.stations = {}
+        self.version = None
+        self.first_year = None
+        self.last_year = None
+        self.checked = None
+        self.lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self.version is not None
+
+    def refresh(self, force=False):
+        """
+        Reload the directory if the data version changed since it was loaded.
+        Checks at most every check_s seconds unless force is set; on a
+        database error the previous directory is kept.
+        """
+        if not force and self.checked is not None and time.monotonic() - self.checked < self.check_s:
+            return
+        with self.lock:
+            if not force and self.checked is not None and time.monotonic() - self.checked < self.check_s:
+                return #another thread just checked
+            self.checked = time.monotonic()
+            conn = self.connect()
+            if conn is None:
+                return
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT version FROM data_version;")
+                    version = cursor.fetchone()[0]
+                    if force or version != self.version:
+                        cursor.execute(DIRECTORY_SQL)
+                        self._load(cursor.fetchall(), version)
+            except psycopg2.Error as e:
+                print(f"Error loading station directory: {e}")
+            finally:
+                if self.release is not None:
+                    self.release(conn)
+                else:
+                    conn.close()
+
+    def _load(self, rows, version):
+        stations = {row[0]: StationInfo(row[1], row[2]) for row in rows}
+        #swap in complete state so readers never see a half-built directory
+        self.stations = stations
+        self.first_year = min(info.first_date.year for info in stations.values()) if stations else None
+        self.last_year = max(info.last_date.year for info in stations.values()) if stations else None
+        self.version = version
+
+    def has_station(self, station):
+        """
+        False only if the directory is loaded and station is not in it
+        """
+        return not self.loaded or station in self.stations
+
+    def covers_year(self, station, year):
+        """
+        False only if the directory is loaded and year is outside station's
+        first and last year (weather_stats has rows for every year in between)
+        """
+        if not self.loaded:
+            return True
+        info = self.stations.get(station)
+        return info is not None and info.first_date.year <= year <= info.last_date.year
+
+    def has_date(self, station, date):
+        """
+        False only if the directory is loaded and date is outside station's
+        first and last date
+        """
+        if not self.loaded:
+            return True
+        info = self.stations.get(station)
+        return info is not None and info.first_date <= date <= info.last_date
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+#general use libraries
+import argparse
+import os
+import numpy as np
+
+# Synthetic GHCN station files in the wx_data layout: one file per station
+# (<station id>.txt) with tab separated date (YYYYMMDD), max temperature,
+# min temperature (tenths of C) and precipitation (tenths of mm), each value
+# right aligned in 5 characters and -9999 for missing values.
+#
+# Temperatures follow a seasonal cycle that depends on the station's
+# latitude, with AR(1) day to day anomalies; precipitation comes from a two
+# state (wet/dry) Markov chain with gamma distributed amounts.
+
+MISSING = -9999
+
+# Station ids are network + state code + 4 digits (e.g. USC00110072);
+# stations are spread over these state codes
+STATE_CODES = ['11', '12', '13', '20', '21', '25', '33', '47']
+
+# Seasonal cycle: annual mean and half amplitude (C) at latitude 35 N, and
+# change per degree of latitude
+MEAN_TEMP_C = 16.
+AMPLITUDE_C = 11.
+MEAN_TEMP_PER_DEG = -0.8
+AMPLITUDE_PER_DEG = 0.35
+DIURNAL_RANGE_C = 11.
+# Day to day temperature anomalies
+ANOMALY_STD_C = 4.
+ANOMALY_LAG1 = 0.7
+# Precipitation: P(wet | dry yesterday), P(wet | wet yesterday), gamma shape and mean (mm)
+P_WET_AFTER_DRY = 0.2
+P_WET_AFTER_WET = 0.5
+PRECIP_SHAPE = 0.7
+PRECIP_MEAN_MM = 9.
+# Fraction of missing values that come in multi-day gaps, and their mean length
+GAP_FRACTION = 0.5
+GAP_MEAN_DAYS = 10
+# Stations generated together (vectorized across stations, looped over days)
+BLOCK_STATIONS = 200
+
+
+def station_ids(nstations):
+    """
+    Output:
+        list of nstations unique GHCN-like station ids
+    """
+    return [f'USC00{STATE_CODES[i % len(STATE_CODES)]}{i // len(STATE_CODES):04d}'
+            for i in range(nstations)]
+
+
+def _ar1(rng, shape, lag1, std):
+    """
+    AR(1) series along the last axis with the given lag-1 correlation and
+    stationary std
+    """
+    noise = rng.normal(0., std*np.sqrt(1. - lag1**2), shape)
+    series = np.empty(shape)
+    series[..., 0] = rng.normal(0., std, shape[:-1])
+    for i in range(1, shape[-1]):
+        series[..., i] = lag1*series[..., i-1] + noise[..., i]
+    return series
+
+
+def _missing_mask(rng, shape, rate):
+    """
+    Boolean mask with about rate of the values missing, part of them in gaps
+    """
+    missing = rng.random(shape) < rate*(1. - GAP_FRACTION)
+    n = shape[1]
+    for row in missing:
+        ngaps = rng.poisson(rate*GAP_FRACTION*n/GAP_MEAN_DAYS)
+        for start, length in zip(rng.integers(0, n, ngaps), rng.geometric(1./GAP_MEAN_DAYS, ngaps)):
+            row[start:start+length] = True
+    return missing
+
+
+def station_block(rng, dates, latitudes, missing_rate):
+    """
+    Synthetic daily values for a block of stations
+
+    Input:
+        rng: numpy Generator
+        dates: datetime64[D] array of n days
+        latitudes: station latitudes (degrees N)
+        missing_rate: fraction of missing values per variable
+    Output:
+        maxt, mint, precip: (stations, n) int arrays in tenths, MISSING where missing
+    """
+    shape = (len(latitudes), len(dates))
+    doy = (dates - dates.astype('datetime64[Y]')).astype(int)
+    latitudes = np.asarray(latitudes)[:, None]
+    mean = MEAN_TEMP_C + MEAN_TEMP_PER_DEG*(latitudes - 35.)
+    amplitude = AMPLITUDE_C + AMPLITUDE_PER_DEG*(latitudes - 35.)
+    #coldest around Jan 20
+    seasonal = mean - amplitude*np.cos(2*np.pi*(doy - 20)/365.25)
+    anomaly = _ar1(rng, shape, ANOMALY_LAG1, ANOMALY_STD_C)
+    diurnal = np.clip(rng.normal(DIURNAL_RANGE_C, 3., shape), 1., None)
+    maxt = seasonal + anomaly + diurnal/2.
+    mint = seasonal + anomaly - diurnal/2.
+
+    wet = np.empty(shape, dtype=bool)
+    draws = rng.random(shape)
+    wet[:, 0] = draws[:, 0] < P_WET_AFTER_DRY
+    for i in range(1, shape[1]):
+        wet[:, i] = draws[:, i] < np.where(wet[:, i-1], P_WET_AFTER_WET, P_WET_AFTER_DRY)
+    precip = np.where(wet, rng.gamma(PRECIP_SHAPE, PRECIP_MEAN_MM/PRECIP_SHAPE, shape), 0.)
+
+    values = []
+    for x in (maxt, mint, precip):
+        tenths = np.round(x*10.).astype(int)
+        tenths[_missing_mask(rng, shape, missing_rate)] = MISSING
+        values.append(tenths)
+    return values
+
+
+def write_station_file(file, dates, maxt, mint, precip):
+    """
+    Write one station file in the wx_data layout
+    """
+    days = dates.astype('datetime64[D]').astype(str)
+    with open(file, 'w') as f:
+        f.writelines(f'{day.replace("-", "")}\t{x:5d}\t{y:5d}\t{z:5d}\n'
+                     for day, x, y, z in zip(days, maxt, mint, precip))
+
+
+def generate(outdir, nstations, firstyear, lastyear, missing_rate, seed=0):
+    """
+    Write nstations synthetic station files covering firstyear-lastyear
+
+    Output:
+        number of rows written
+    """
+    os.makedirs(outdir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    dates = np.arange(np.datetime64(f'{firstyear}-01-01'), np.datetime64(f'{lastyear+1}-01-01'))
+    stations = station_ids(nstations)
+    for first in range(0, nstations, BLOCK_STATIONS):
+        block = stations[first:first+BLOCK_STATIONS]
+        maxt, mint, precip = station_block(rng, dates, rng.uniform(30., 48., len(block)),
+                                           missing_rate)
+        for i, station in enumerate(block):
+            write_station_file(os.path.join(outdir, station + '.txt'),
+                               dates, maxt[i], mint[i], precip[i])
+    return nstations*len(dates)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write synthetic GHCN station files')
+    parser.add_argument('outdir', help='directory for the station files')
+    parser.add_argument('--stations', type=int, default=167, help='number of stations')
+    parser.add_argument('--first-year', type=int, default=1985)
+    parser.add_argument('--last-year', type=int, default=2014)
+    parser.add_argument('--missing-rate', type=float, default=0.03,
+                        help='fraction of missing values per variable')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    nrows = generate(args.outdir, args.stations, args.first_year, args.last_year,
+                     args.missing_rate, args.seed)
+    print(f'Wrote {args.stations} station files, {nrows} rows, to {args.outdir}')
@@ -0,0 +1,202 @@
+import gzip
+import threading
+import time
+import zlib
+from collections import Counter, namedtuple
+from urllib.parse import urlencode
+
+import psycopg2
+
+# Response compression and pre-serialized hot pages for the API.
+# Responses are compressed with gzip or deflate, as negotiated with the
+# client's Accept-Encoding, when they are at least COMPRESS_MIN_BYTES long.
+#
+# HotPages keeps the most requested pages (path and query string) of the
+# process serialized and compressed in memory.  Every HOT_CHECK_S seconds it
+# checks the published data version and the versions the jobs (stats, yield
+# features, ...) processed; when any changed, all pages are rebuilt in a
+# background thread and swapped in at once.  Pages that become popular in
+# between are added at the next check.  Requests are counted per process, so
+# each API worker keeps its own hot pages.
+
+COMPRESS_MIN_BYTES = 1024
+COMPRESS_LEVEL = 6
+# Supported encodings, preferred first
+ENCODINGS = ('gzip', 'deflate')
+
+HOT_CHECK_S = 30.
+# Pages kept, and requests a page needs (since the last build) to be kept
+HOT_PAGES = 20
+HOT_MIN_HITS = 5
+# Distinct pages counted before the least requested ones are dropped
+HOT_TRACKED = 10000
+
+HotPage = namedtuple('HotPage', ['content_type', 'bodies'])
+
+# data version and the version each job processed (see db_util.set_job_version);
+# runs that change nothing leave them as they are
+VERSION_SQL = """
+    SELECT d.version, (SELECT array_agg(job || ':' || version ORDER BY job) FROM job_versions)
+    FROM data_version d;
+    """
+
+
+def accepted_encoding(header):
+    """
+    Encoding of ENCODINGS to use for an Accept-Encoding header
+
+    Output:
+        'gzip', 'deflate' or None (send uncompressed)
+    """
+    qvalues = {}
+    for part in (header or '').split(','):
+        name, _, params = part.strip().partition(';')
+        q = 1.
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.
+        if name:
+            qvalues[name.strip().lower()] = q
+    best, bestq = None, 0.
+    for encoding in ENCODINGS:
+        q = qvalues.get(encoding, qvalues.get('*', 0.))
+        if q > bestq:
+            best, bestq = encoding, q
+    return best
+
+
+def compress(body, encoding):
+    """
+    body compressed with encoding ('gzip' or 'deflate', the zlib format of HTTP)
+    """
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=COMPRESS_LEVEL, mtime=0)
+    return zlib.compress(body, COMPRESS_LEVEL)
+
+
+def page_key(path, args):
+    """
+    Cache key of a request: path and query parameters in a fixed order
+    """
+    query = urlencode(sorted(args.items(multi=True)))
+    return f'{path}?{query}' if query else path
+
+
+class HotPages:
+    """
+    Serialized and compressed pages, rebuilt when the data or stats change
+
+    Attributes:
+        pages: dict of page key -> HotPage
+        version: data version and job versions the pages were built at
+        hits: requests per page key since the last build
+    """
+
+    def __init__(self, connect, render, seeds=None, release=None,
+                 check_s=HOT_CHECK_S, npages=HOT_PAGES, min_hits=HOT_MIN_HITS):
+        """
+        Input:
+            connect: function returning a new database connection (or None)
+            render: function of a page key (path?query) returning status,
+                    content type and body bytes
+            seeds: function returning page keys to always keep
+            release: function to give back a connection from connect
+                     (default closes it)
+            check_s: seconds between version checks
+            npages: number of pages kept
+            min_hits: requests a page needs to be kept
+        """
+        self.connect = connect
+        self.render = render
+        self.seeds = seeds
+        self.release = release
+        self.check_s = check_s
+        self.npages = npages
+        self.min_hits = min_hits
+        self.pages = {}
+        self.version = None
+        self.hits = Counter()
+        self.checked = None
+        self.building = False
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Count a request for key and return its HotPage, or None
+        """
+        #approximate under concurrent requests, which is all the ranking needs
+        self.hits[key] += 1
+        return self.pages.get(key)
+
+    def _candidates(self):
+        keys = list(self.seeds() if self.seeds else [])
+        keys += [key for key, n in self.hits.most_common(self.npages) if n >= self.min_hits]
+        return list(dict.fromkeys(keys))[:self.npages]
+
+    def refresh(self):
+        """
+        Every check_s seconds: rebuild all pages in the background if the
+        version changed, or add newly popular pages.  On a database error the
+        current pages are kept.
+        """
+        if self.checked is not None and time.monotonic() - self.checked < self.check_s:
+            return
+        with self.lock:
+            if self.building or (self.checked is not None
+                                 and time.monotonic() - self.checked < self.check_s):
+                return
+            self.checked = time.monotonic()
+            if len(self.hits) > HOT_TRACKED:
+                self.hits = Counter(dict(self.hits.most_common(HOT_TRACKED // 2)))
+            conn = self.connect()
+            if conn is None:
+                return
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute(VERSION_SQL)
+                    data_version, job_versions = cursor.fetchone()
+                    version = (data_version, tuple(job_versions or ()))
+            except psycopg2.Error as e:
+                print(f"Error checking hot pages version: {e}")
+                return
+            finally:
+                if self.release is not None:
+                    self.release(conn)
+                else:
+                    conn.close()
+            if version != self.version:
+                #stop serving the stale pages while the new ones are built
+                self.pages = {}
+                keys, pages = self._candidates(), {}
+            else:
+                keys = [key for key in self._candidates() if key not in self.pages]
+                pages = dict(self.pages)
+            if not keys and version == self.version:
+                return
+            self.building = True
+        threading.Thread(target=self._build, args=(version, keys, pages), daemon=True).start()
+
+    def _build(self, version, keys, pages):
+        try:
+            for key in keys:
+                try:
+                    status, content_type, body = self.render(key)
+                except Exception as e:
+                    print(f"Error building hot page {key}: {e}")
+                    continue
+                if status != 200:
+                    continue
+                bodies = {None: body}
+                if len(body) >= COMPRESS_MIN_BYTES:
+                    bodies.update({encoding: compress(body, encoding) for encoding in ENCODINGS})
+                pages[key] = HotPage(content_type, bodies)
+            #swap in complete state so readers never see a half-built set
+            self.pages = pages
+            self.version = version
+            #rank on recent requests: halve the counts, keep the most requested
+            self.hits = Counter({key: n // 2 for key, n in self.hits.most_common(HOT_TRACKED) if n > 1})
+        finally:
+            self.building = False
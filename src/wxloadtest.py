@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+#general use libraries
+import argparse
+import http.client
+import json
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlsplit
+
+from wxbenchmark import API_QUERIES
+
+# Closed-loop HTTP load test of a running API server, for comparing serving
+# modes (e.g. the debug server against gunicorn).  Each client thread keeps
+# one keep-alive connection and sends the API_QUERIES of the benchmark in
+# turn, without think time, for a fixed duration; the result is the request
+# rate, latency percentiles and response status counts, as JSON.
+
+DEFAULT_CLIENTS = 16
+DEFAULT_DURATION_S = 30.
+DEFAULT_WARMUP_S = 3.
+
+
+def _client(host, port, urls, warmup_end, end, results):
+    """
+    Send urls in turn on one connection until end; record (status, latency)
+    of the requests that started after warmup_end
+    """
+    conn = http.client.HTTPConnection(host, port, timeout=60)
+    i = 0
+    while time.perf_counter() < end:
+        url = urls[i % len(urls)]
+        i += 1
+        t0 = time.perf_counter()
+        try:
+            conn.request('GET', url)
+            response = conn.getresponse()
+            response.read()
+            status = response.status
+            if response.getheader('Connection', '').lower() == 'close':
+                conn.close()
+        except (OSError, http.client.HTTPException):
+            status = 'error'
+            conn.close()
+        if t0 >= warmup_end:
+            results.append((status, time.perf_counter() - t0))
+    conn.close()
+
+
+def run_load(base_url, urls, clients, duration_s, warmup_s=DEFAULT_WARMUP_S):
+    """
+    Run clients threads against base_url for warmup_s + duration_s seconds
+
+    Output:
+        dict with requests, requests_per_s, p50_ms, p95_ms, p99_ms and status counts
+    """
+    parts = urlsplit(base_url)
+    start = time.perf_counter()
+    warmup_end = start + warmup_s
+    end = warmup_end + duration_s
+    results = [] #list.append is thread-safe
+    threads = [threading.Thread(target=_client,
+                                args=(parts.hostname, parts.port or 80,
+                                      urls[n % len(urls):] + urls[:n % len(urls)],
+                                      warmup_end, end, results))
+               for n in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies = sorted(latency*1000. for _, latency in results)
+    def percentile(q):
+        return latencies[min(len(latencies) - 1, int(len(latencies)*q))] if latencies else None
+    return {'url': base_url, 'clients': clients, 'duration_s': duration_s,
+            'requests': len(results),
+            'requests_per_s': len(results)/duration_s,
+            'p50_ms': percentile(0.5), 'p95_ms': percentile(0.95), 'p99_ms': percentile(0.99),
+            'status': {str(status): n for status, n in Counter(s for s, _ in results).items()}}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load test a running API server')
+    parser.add_argument('url', help='base URL of the server, e.g. http://127.0.0.1:5000')
+    parser.add_argument('--station', default='USC00110072', help='station id for the queries')
+    parser.add_argument('--year', type=int, default=2000, help='year for the queries')
+    parser.add_argument('--queries', nargs='+', choices=sorted(API_QUERIES),
+                        help='benchmark queries to send (default all)')
+    parser.add_argument('--clients', type=int, default=DEFAULT_CLIENTS,
+                        help='concurrent client connections')
+    parser.add_argument('--duration', type=float, default=DEFAULT_DURATION_S,
+                        help='seconds to measure (after a short warm-up)')
+    args = parser.parse_args()
+
+    urls = [API_QUERIES[name].format(station=args.station, year=args.year)
+            for name in (args.queries or API_QUERIES)]
+    print(json.dumps(run_load(args.url.rstrip('/'), urls, args.clients, args.duration), indent=2))
@@ -0,0 +1,103 @@
+from db_util import init_table, grant_select, execute_insert_db, prepared_sql
+from wxqc import QC_BAD_MAXT, QC_BAD_MINT, QC_BAD_PRECIP
+
+# Multi-resolution downsampled station series for charting.
+# station_data_pyramid holds weekly, monthly and yearly min/max/mean per
+# station; the ingest job refreshes the periods overlapping the years it changed.
+
+# Resolutions (date_trunc fields), finest first
+PYRAMID_RESOLUTIONS = ['week', 'month', 'year']
+
+
+def init_pyramid_table(logger):
+    """
+    Connect to the wxdata database and create the station_data_pyramid table.
+    """
+
+    create_table_sql = """
+        CREATE TABLE IF NOT EXISTS station_data_pyramid (
+            station_id VARCHAR(20) NOT NULL,
+            resolution VARCHAR(8) NOT NULL,
+            period_start DATE NOT NULL,
+            max_temperature_min DECIMAL(7, 2),
+            max_temperature_max DECIMAL(7, 2),
+            max_temperature_mean DECIMAL(7, 2),
+            min_temperature_min DECIMAL(7, 2),
+            min_temperature_max DECIMAL(7, 2),
+            min_temperature_mean DECIMAL(7, 2),
+            precipitation_min DECIMAL(7, 2),
+            precipitation_max DECIMAL(7, 2),
+            precipitation_mean DECIMAL(7, 2),
+            number_obs INT NOT NULL,
+            PRIMARY KEY (station_id, resolution, period_start)
+        );
+    """
+
+    init_table(create_table_sql, logger)
+    grant_select(['station_data_pyramid'], logger)
+
+
+def refresh_pyramid(conn, station, years, logger):
+    """
+    Recompute every pyramid level for the periods overlapping years.  Rows
+    are only rewritten where a value changed.
+
+    Input:
+        conn: The connection object to the db
+        station: station id
+        years: iterable of years that changed
+        logger: logging object
+    """
+    if not years:
+        return
+    firstyear, lastyear = min(years), max(years)
+
+    #periods overlapping [firstyear-01-01, lastyear-12-31]; weeks can straddle a new year
+    sql = prepared_sql(conn, logger, 'refresh_pyramid', f"""
+    INSERT INTO station_data_pyramid
+            (station_id, resolution, period_start,
+             max_temperature_min, max_temperature_max, max_temperature_mean,
+             min_temperature_min, min_temperature_max, min_temperature_mean,
+             precipitation_min, precipitation_max, precipitation_mean, number_obs)
+    SELECT station_id, %s, date_trunc(%s, date::timestamp)::date,
+           MIN(max_temperature) FILTER (WHERE qc_flags & {QC_BAD_MAXT} = 0),
+           MAX(max_temperature) FILTER (WHERE qc_flags & {QC_BAD_MAXT} = 0),
+           AVG(max_temperature) FILTER (WHERE qc_flags & {QC_BAD_MAXT} = 0),
+           MIN(min_temperature) FILTER (WHERE qc_flags & {QC_BAD_MINT} = 0),
+           MAX(min_temperature) FILTER (WHERE qc_flags & {QC_BAD_MINT} = 0),
+           AVG(min_temperature) FILTER (WHERE qc_flags & {QC_BAD_MINT} = 0),
+           MIN(precipitation) FILTER (WHERE qc_flags & {QC_BAD_PRECIP} = 0),
+           MAX(precipitation) FILTER (WHERE qc_flags & {QC_BAD_PRECIP} = 0),
+           AVG(precipitation) FILTER (WHERE qc_flags & {QC_BAD_PRECIP} = 0),
+           COUNT(*)
+    FROM station_data
+    WHERE station_id = %s
+      AND date >= date_trunc(%s, make_date(%s, 1, 1)::timestamp)
+      AND date < date_trunc(%s, make_date(%s, 12, 31)::timestamp) + ('1 ' || %s)::interval
+    GROUP BY 1, 3
+    ON CONFLICT (station_id, resolution, period_start) DO UPDATE
+    SET max_temperature_min = EXCLUDED.max_temperature_min,
+        max_temperature_max = EXCLUDED.max_temperature_max,
+        max_temperature_mean = EXCLUDED.max_temperature_mean,
+        min_temperature_min = EXCLUDED.min_temperature_min,
+        min_temperature_max = EXCLUDED.min_temperature_max,
+        min_temperature_mean = EXCLUDED.min_temperature_mean,
+        precipitation_min = EXCLUDED.precipitation_min,
+        precipitation_max = EXCLUDED.precipitation_max,
+        precipitation_mean = EXCLUDED.precipitation_mean,
+        number_obs = EXCLUDED.number_obs
+    WHERE (station_data_pyramid.max_temperature_min, station_data_pyramid.max_temperature_max,
+           station_data_pyramid.max_temperature_mean, station_data_pyramid.min_temperature_min,
+           station_data_pyramid.min_temperature_max, station_data_pyramid.min_temperature_mean,
+           station_data_pyramid.precipitation_min, station_data_pyramid.precipitation_max,
+           station_data_pyramid.precipitation_mean, station_data_pyramid.number_obs)
+          IS DISTINCT FROM
+          (EXCLUDED.max_temperature_min, EXCLUDED.max_temperature_max,
+           EXCLUDED.max_temperature_mean, EXCLUDED.min_temperature_min,
+           EXCLUDED.min_temperature_max, EXCLUDED.min_temperature_mean,
+           EXCLUDED.precipitation_min, EXCLUDED.precipitation_max,
+           EXCLUDED.precipitation_mean, EXCLUDED.number_obs);
+    """)
+    for res in PYRAMID_RESOLUTIONS:
+        execute_insert_db(conn, logger, sql,
+                          (res, res, station, res, firstyear, res, lastyear, res))
@@ -0,0 +1,108 @@
+import numpy as np
+
+# Quality control checks for GHCN station data.
+# Every check works on whole station arrays (sorted by date) and sets bits in
+# a per-row flag mask that is stored in station_data.qc_flags.
+
+# QC flag bits
+QC_RANGE_MAXT = 1       #max temperature outside valid range
+QC_RANGE_MINT = 2       #min temperature outside valid range
+QC_RANGE_PRECIP = 4     #precipitation outside valid range
+QC_MIN_GT_MAX = 8       #min temperature > max temperature
+QC_SPIKE_MAXT = 16      #max temperature jumps away from and back to both neighbours
+QC_SPIKE_MINT = 32      #min temperature jumps away from and back to both neighbours
+QC_FLAT_MAXT = 64       #max temperature repeated for FLAT_RUN or more days
+QC_FLAT_MINT = 128      #min temperature repeated for FLAT_RUN or more days
+QC_DUP_DATE = 256       #date appears more than once in the file
+
+# Flags that exclude a value from the statistics, per variable
+QC_BAD_MAXT = QC_RANGE_MAXT | QC_MIN_GT_MAX | QC_SPIKE_MAXT
+QC_BAD_MINT = QC_RANGE_MINT | QC_MIN_GT_MAX | QC_SPIKE_MINT
+QC_BAD_PRECIP = QC_RANGE_PRECIP
+
+# Thresholds
+TEMP_RANGE = (-60., 60.)    #C
+PRECIP_RANGE = (0., 1000.)  #mm/day
+SPIKE_C = 25.               #C change from both neighbouring days
+FLAT_RUN = 7                #days of identical temperature
+
+
+def _consecutive(dates):
+    """
+    True where dates[i] is the day after dates[i-1] (length len(dates)-1)
+    """
+    return np.diff(dates) == np.timedelta64(1, 'D')
+
+
+def flag_range(values, valid_range, flag):
+    """
+    Flag values outside valid_range (inclusive)
+    """
+    lo, hi = valid_range
+    return np.where((values < lo) | (values > hi), flag, 0)
+
+
+def flag_spikes(dates, values, flag, threshold=SPIKE_C):
+    """
+    Flag values that differ by more than threshold, in the same direction,
+    from both the previous and the next day
+    """
+    flags = np.zeros(len(values), dtype=np.int16)
+    if len(values) < 3:
+        return flags
+    consec = _consecutive(dates)
+    diff = np.diff(values)
+    #value i compared with i-1 (up) and i+1 (down) for i = 1 .. n-2
+    up, down = diff[:-1], diff[1:]
+    spike = (consec[:-1] & consec[1:]
+             & (np.abs(up) > threshold) & (np.abs(down) > threshold)
+             & (np.sign(up) != np.sign(down)))
+    flags[1:-1][spike] = flag
+    return flags
+
+
+def flag_flat(dates, values, flag, run=FLAT_RUN):
+    """
+    Flag runs of at least run consecutive days with identical values
+    """
+    flags = np.zeros(len(values), dtype=np.int16)
+    if len(values) < run:
+        return flags
+    same = _consecutive(dates) & (np.diff(values) == 0)
+    #label runs: a new run starts wherever the value is not the same as the day before
+    run_id = np.concatenate(([0], np.cumsum(~same)))
+    run_len = np.bincount(run_id)
+    flags[run_len[run_id] >= run] = flag
+    return flags
+
+
+def flag_duplicates(dates, flag=QC_DUP_DATE):
+    """
+    Flag every row whose date appears more than once
+    """
+    _, inverse, counts = np.unique(dates, return_inverse=True, return_counts=True)
+    return np.where(counts[inverse] > 1, flag, 0)
+
+
+def qc_flags(dates, maxt, mint, precip):
+    """
+    Run all QC checks on one station's data
+
+    Input:
+        dates: datetime64[D] array, sorted
+        maxt, mint, precip: float arrays of maximum temperature (C),
+                            minimum temperature (C) and precipitation (mm)
+    Output:
+        int16 array of QC flag bitmasks, one per row
+    """
+    flags = np.zeros(len(dates), dtype=np.int16)
+    flags |= flag_range(maxt, TEMP_RANGE, QC_RANGE_MAXT).astype(np.int16)
+    flags |= flag_range(mint, TEMP_RANGE, QC_RANGE_MINT).astype(np.int16)
+    flags |= flag_range(precip, PRECIP_RANGE, QC_RANGE_PRECIP).astype(np.int16)
+    flags |= np.where(mint > maxt, QC_MIN_GT_MAX, 0).astype(np.int16)
+    flags |= flag_spikes(dates, maxt, QC_SPIKE_MAXT)
+    flags |= flag_spikes(dates, mint, QC_SPIKE_MINT)
+    flags |= flag_flat(dates, maxt, QC_FLAT_MAXT)
+    flags |= flag_flat(dates, mint, QC_FLAT_MINT)
+    flags |= flag_duplicates(dates).astype(np.int16)
+    return flags
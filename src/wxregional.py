@@ -0,0 +1,102 @@
+from db_util import init_table, grant_select, execute_insert_db, prepared_sql
+from wxqc import QC_BAD_MAXT, QC_BAD_MINT, QC_BAD_PRECIP
+
+# Cross-station daily aggregates.
+# regional_daily holds the mean, min, max and station count of each variable
+# per date for the whole network (region 'ALL') and for groups of stations
+# sharing the first REGION_PREFIX_LEN characters of their id (network and
+# state code, e.g. 'USC0011' for Illinois).
+
+REGION_ALL = 'ALL'
+REGION_PREFIX_LEN = 7
+
+# Number of dates refreshed per statement
+REGIONAL_BATCH_DAYS = 366
+
+
+def init_regional_table(logger):
+    """
+    Connect to the wxdata database and create the regional_daily table (and
+    the station_data date index used to refresh it).
+    """
+
+    create_table_sql = """
+        CREATE TABLE IF NOT EXISTS regional_daily (
+            region VARCHAR(20) NOT NULL,
+            date DATE NOT NULL,
+            max_temperature_mean DECIMAL(7, 2),
+            max_temperature_min DECIMAL(7, 2),
+            max_temperature_max DECIMAL(7, 2),
+            min_temperature_mean DECIMAL(7, 2),
+            min_temperature_min DECIMAL(7, 2),
+            min_temperature_max DECIMAL(7, 2),
+            precipitation_mean DECIMAL(7, 2),
+            precipitation_min DECIMAL(7, 2),
+            precipitation_max DECIMAL(7, 2),
+            station_count INT NOT NULL,
+            PRIMARY KEY (region, date)
+        );
+        CREATE INDEX IF NOT EXISTS station_data_date ON station_data (date);
+    """
+
+    init_table(create_table_sql, logger)
+    grant_select(['regional_daily'], logger)
+
+
+def refresh_regional(conn, dates, logger):
+    """
+    Recompute the network and prefix group aggregates for the given dates in
+    one grouped pass per batch of dates.  Rows are only rewritten where a
+    value changed.
+
+    Input:
+        conn: The connection object to the db
+        dates: iterable of datetime.date that changed
+        logger: logging object
+    """
+    sql = prepared_sql(conn, logger, 'refresh_regional', f"""
+    INSERT INTO regional_daily
+            (region, date,
+             max_temperature_mean, max_temperature_min, max_temperature_max,
+             min_temperature_mean, min_temperature_min, min_temperature_max,
+             precipitation_mean, precipitation_min, precipitation_max, station_count)
+    SELECT COALESCE(left(station_id, {REGION_PREFIX_LEN}), '{REGION_ALL}'), date,
+           AVG(max_temperature) FILTER (WHERE qc_flags & {QC_BAD_MAXT} = 0),
+           MIN(max_temperature) FILTER (WHERE qc_flags & {QC_BAD_MAXT} = 0),
+           MAX(max_temperature) FILTER (WHERE qc_flags & {QC_BAD_MAXT} = 0),
+           AVG(min_temperature) FILTER (WHERE qc_flags & {QC_BAD_MINT} = 0),
+           MIN(min_temperature) FILTER (WHERE qc_flags & {QC_BAD_MINT} = 0),
+           MAX(min_temperature) FILTER (WHERE qc_flags & {QC_BAD_MINT} = 0),
+           AVG(precipitation) FILTER (WHERE qc_flags & {QC_BAD_PRECIP} = 0),
+           MIN(precipitation) FILTER (WHERE qc_flags & {QC_BAD_PRECIP} = 0),
+           MAX(precipitation) FILTER (WHERE qc_flags & {QC_BAD_PRECIP} = 0),
+           COUNT(DISTINCT station_id)
+    FROM station_data
+    WHERE date = ANY(%s::date[])
+    GROUP BY GROUPING SETS ((date), (left(station_id, {REGION_PREFIX_LEN}), date))
+    ON CONFLICT (region, date) DO UPDATE
+    SET max_temperature_mean = EXCLUDED.max_temperature_mean,
+        max_temperature_min = EXCLUDED.max_temperature_min,
+        max_temperature_max = EXCLUDED.max_temperature_max,
+        min_temperature_mean = EXCLUDED.min_temperature_mean,
+        min_temperature_min = EXCLUDED.min_temperature_min,
+        min_temperature_max = EXCLUDED.min_temperature_max,
+        precipitation_mean = EXCLUDED.precipitation_mean,
+        precipitation_min = EXCLUDED.precipitation_min,
+        precipitation_max = EXCLUDED.precipitation_max,
+        station_count = EXCLUDED.station_count
+    WHERE (regional_daily.max_temperature_mean, regional_daily.max_temperature_min,
+           regional_daily.max_temperature_max, regional_daily.min_temperature_mean,
+           regional_daily.min_temperature_min, regional_daily.min_temperature_max,
+           regional_daily.precipitation_mean, regional_daily.precipitation_min,
+           regional_daily.precipitation_max, regional_daily.station_count)
+          IS DISTINCT FROM
+          (EXCLUDED.max_temperature_mean, EXCLUDED.max_temperature_min,
+           EXCLUDED.max_temperature_max, EXCLUDED.min_temperature_mean,
+           EXCLUDED.min_temperature_min, EXCLUDED.min_temperature_max,
+           EXCLUDED.precipitation_mean, EXCLUDED.precipitation_min,
+           EXCLUDED.precipitation_max, EXCLUDED.station_count);
+    """)
+    dates = sorted(dates)
+    for start in range(0, len(dates), REGIONAL_BATCH_DAYS):
+        execute_insert_db(conn, logger, sql, (dates[start:start+REGIONAL_BATCH_DAYS],))
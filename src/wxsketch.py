@@ -0,0 +1,199 @@
+import struct
+
+import numpy as np
+
+from db_util import init_table, grant_select, execute_batch_db, count_upserts
+
+# Mergeable quantile sketches (t-digest) per station, year and variable.
+# Sketches are stored as bytea in station_year_sketches so percentiles for any
+# set of station-years can be answered by merging sketches instead of
+# scanning station_data.
+
+# t-digest compression: the k1 scale spans compression/2 units, so about
+# compression/2 centroids are kept (200, about 1.4 KB per sketch).  At 100 the
+# merged q=0.999 of skewed (gamma) data was about 10% high, at 400 within
+# about 1%.  Sketches built with another compression still merge; rebuild
+# them (wxstats_ingest.py --full) to get the accuracy of the new one.
+SKETCH_COMPRESSION = 400
+
+# Serialized header: count, min, max, number of centroids
+_HEADER = struct.Struct('<dddI')
+
+
+class TDigest:
+    """
+    Merging t-digest: a sorted list of weighted centroids whose size is
+    bounded by the scale function k(q) = compression/(2 pi) asin(2q - 1), so
+    centroids are small near the tails and larger around the median.
+
+    Attributes:
+        means, weights: float arrays of centroid means and weights, sorted by mean
+        vmin, vmax: smallest and largest value added
+    """
+
+    def __init__(self, means=(), weights=(), vmin=np.nan, vmax=np.nan,
+                 compression=SKETCH_COMPRESSION):
+        self.means = np.asarray(means, dtype=float)
+        self.weights = np.asarray(weights, dtype=float)
+        self.vmin = vmin
+        self.vmax = vmax
+        self.compression = compression
+
+    @classmethod
+    def from_values(cls, values, compression=SKETCH_COMPRESSION):
+        """
+        Build a digest from an array of values (NaN are ignored)
+        """
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return cls(compression=compression)
+        digest = cls(values, np.ones(len(values)), values.min(), values.max(), compression)
+        return digest.compress()
+
+    @property
+    def count(self):
+        return self.weights.sum()
+
+    def compress(self):
+        """
+        Merge neighbouring centroids so each spans at most one unit of k
+        """
+        if len(self.means) == 0:
+            return self
+        order = np.argsort(self.means, kind='stable')
+        means, weights = self.means[order], self.weights[order]
+        cum = np.cumsum(weights)
+        total = cum[-1]
+        #k at the left edge of each centroid; centroids in the same unit of k are merged
+        qleft = (cum - weights)/total
+        k = self.compression/(2*np.pi)*np.arcsin(2*qleft - 1)
+        cluster = np.floor(k - k[0]).astype(int)
+        cluster = np.unique(cluster, return_inverse=True)[1]
+        wsum = np.bincount(cluster, weights=weights)
+        self.means = np.bincount(cluster, weights=means*weights)/wsum
+        self.weights = wsum
+        return self
+
+    def merge(self, other):
+        """
+        Output:
+            a new digest summarizing the values of both digests
+        """
+        digest = TDigest(np.concatenate((self.means, other.means)),
+                         np.concatenate((self.weights, other.weights)),
+                         np.fmin(self.vmin, other.vmin), np.fmax(self.vmax, other.vmax),
+                         self.compression)
+        return digest.compress()
+
+    def quantile(self, q):
+        """
+        Estimate quantile(s) q (0-1) by interpolating between centroid centres
+
+        Input:
+            q: float or array of floats
+        Output:
+            float or array of floats (NaN if the digest is empty)
+        """
+        if len(self.means) == 0:
+            return np.full(np.shape(q), np.nan) if np.ndim(q) else np.nan
+        total = self.count
+        centres = np.cumsum(self.weights) - self.weights/2.
+        positions = np.concatenate(([0.], centres, [total]))
+        values = np.concatenate(([self.vmin], self.means, [self.vmax]))
+        return np.interp(np.asarray(q)*total, positions, values)
+
+    def to_bytes(self):
+        """
+        Serialize to bytes (header, then float32 means and weights)
+        """
+        return (_HEADER.pack(self.count, self.vmin, self.vmax, len(self.means))
+                + self.means.astype('<f4').tobytes() + self.weights.astype('<f4').tobytes())
+
+    @classmethod
+    def from_bytes(cls, data, compression=SKETCH_COMPRESSION):
+        """
+        Deserialize bytes written by to_bytes
+        """
+        data = bytes(data)
+        _, vmin, vmax, n = _HEADER.unpack_from(data)
+        arrays = np.frombuffer(data, dtype='<f4', offset=_HEADER.size, count=2*n)
+        return cls(arrays[:n], arrays[n:], vmin, vmax, compression)
+
+
+def merge_all(digests):
+    """
+    Merge any number of digests in one compression pass
+    """
+    digests = list(digests)
+    if not digests:
+        return TDigest()
+    merged = TDigest(np.concatenate([d.means for d in digests]),
+                     np.concatenate([d.weights for d in digests]),
+                     np.fmin.reduce([d.vmin for d in digests]),
+                     np.fmax.reduce([d.vmax for d in digests]),
+                     digests[0].compression)
+    return merged.compress()
+
+
+def init_sketch_table(logger):
+    """
+    Connect to the wxdata database and create the station_year_sketches table.
+    """
+
+    create_table_sql = """
+        CREATE TABLE IF NOT EXISTS station_year_sketches (
+            station_id VARCHAR(20) NOT NULL,
+            year INT NOT NULL,
+            variable VARCHAR(20) NOT NULL,
+            number_obs INT NOT NULL,
+            sketch BYTEA NOT NULL,
+            PRIMARY KEY (station_id, year, variable)
+        );
+    """
+
+    init_table(create_table_sql, logger)
+    grant_select(['station_year_sketches'], logger)
+
+
+def station_year_sketches(station, years, dates, values, flags, variables):
+    """
+    Build sketches for each year and variable of one station's series
+
+    Input:
+        station: station id
+        years: years to build sketches for
+        dates, values, flags: station series (see wxclimo.get_station_series)
+        variables: list of (name, column index, QC flags that exclude a value)
+    Output:
+        list of (station_id, year, variable, number_obs, sketch bytes)
+    """
+    rows = []
+    dateyears = dates.astype('datetime64[Y]').astype(int) + 1970
+    for year in sorted(years):
+        inyear = dateyears == year
+        for name, i, badflags in variables:
+            ok = inyear & (flags & badflags == 0)
+            digest = TDigest.from_values(values[ok, i])
+            rows.append((station, int(year), name, int(digest.count), digest.to_bytes()))
+    return rows
+
+
+def upsert_sketches(conn, rows, logger):
+    """
+    Inserts or updates (only if the sketch changed) station_year_sketches
+    Output:
+        Counter with inserted, updated, unchanged and quarantined rows
+    """
+    sql = """
+    INSERT INTO station_year_sketches (station_id, year, variable, number_obs, sketch)
+    VALUES %s
+    ON CONFLICT (station_id, year, variable) DO UPDATE
+    SET number_obs = EXCLUDED.number_obs,
+        sketch = EXCLUDED.sketch
+    WHERE (station_year_sketches.number_obs, station_year_sketches.sketch)
+          IS DISTINCT FROM (EXCLUDED.number_obs, EXCLUDED.sketch)
+    RETURNING (xmax = 0);
+    """
+    results, nbad = execute_batch_db(conn, logger, sql, rows, source='station_year_sketches', fetch=True)
+    return count_upserts(results, len(rows), nbad)
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+
+#general use libraries
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+from datetime import datetime
+
+from psycopg2.extensions import quote_ident
+
+#PostgreSQL local library
+from db_util import connect_to_db, get_data_version
+from timing_util import StageTimer
+
+# Binary snapshots of the wxdata tables.
+# export writes each table with COPY (FORMAT binary), gzip compressed, to a
+# snapshot directory with a manifest holding the data version, row counts,
+# sha256 checksums and the table definitions.  restore checks every file,
+# loads each table into a new unlogged table, builds its keys and indexes
+# after the load, and then swaps all restored tables in at once in the same
+# transaction, so readers see either the old or the new data.  The privileges
+# granted on each table (e.g. SELECT for the API's web_user) are recorded in
+# the manifest and granted again on the swapped in table.
+
+maindir = '../'
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO,
+                    format = '%(asctime)s - %(message)s',
+                    filename=maindir + 'wxsnapshot.log')
+
+# Tables in a snapshot (tables that do not exist are skipped)
+SNAPSHOT_TABLES = ['data_version', 'job_versions', 'dirty_station_years',
+                   'station_data', 'weather_stats', 'weather_stats_monthly',
+                   'weather_stats_seasonal', 'station_climatology', 'station_data_pyramid',
+                   'regional_daily', 'station_coverage', 'station_year_sketches',
+                   'station_rolling_stats', 'station_trends',
+                   'corn_yield', 'station_year_features', 'yield_features']
+
+MANIFEST = 'manifest.json'
+COMPRESS_LEVEL = 6
+COPY_BUFFER = 1 << 20
+
+# Suffix of the tables (and their constraints and indexes) being restored
+RESTORE_SUFFIX = '__restore'
+
+
+class _HashingFile:
+    """
+    File wrapper that computes the sha256 of the bytes written or read
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+        self.nbytes = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.nbytes += len(data)
+        return self.f.write(data)
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.sha256.update(data)
+        self.nbytes += len(data)
+        return data
+
+    def flush(self):
+        self.f.flush()
+
+
+def table_definition(cursor, table):
+    """
+    Columns, constraints and indexes of a table, as stored in the manifest
+
+    Output:
+        dict with columns ([name, type, not null, default]), constraints
+        ([name, definition]), indexes (CREATE INDEX statements of indexes
+        that do not belong to a constraint) and grants ([grantee, privilege,
+        grantable] of the roles other than the owner, PUBLIC for everyone),
+        or None if the table does not exist
+    """
+    cursor.execute("SELECT to_regclass(%s);", (table,))
+    if cursor.fetchone()[0] is None:
+        return None
+    cursor.execute("""
+        SELECT a.attname, format_type(a.atttypid, a.atttypmod), a.attnotnull,
+               pg_get_expr(d.adbin, d.adrelid)
+        FROM pg_attribute a
+        LEFT JOIN pg_attrdef d ON d.adrelid = a.attrelid AND d.adnum = a.attnum
+        WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped
+        ORDER BY a.attnum;
+        """, (table,))
+    columns = [list(row) for row in cursor.fetchall()]
+    cursor.execute("""
+        SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+        WHERE conrelid = %s::regclass AND contype IN ('p', 'u', 'c', 'x')
+        ORDER BY contype DESC, conname;
+        """, (table,))
+    constraints = [list(row) for row in cursor.fetchall()]
+    cursor.execute("""
+        SELECT indexdef FROM pg_indexes i
+        WHERE tablename = %s AND NOT EXISTS
+            (SELECT 1 FROM pg_constraint c WHERE c.conindid = (quote_ident(i.indexname))::regclass)
+        ORDER BY indexname;
+        """, (table,))
+    indexes = [row[0] for row in cursor.fetchall()]
+    cursor.execute("""
+        SELECT CASE WHEN a.grantee = 0 THEN 'PUBLIC' ELSE pg_get_userbyid(a.grantee) END,
+               a.privilege_type, a.is_grantable
+        FROM pg_class c CROSS JOIN LATERAL aclexplode(c.relacl) a
+        WHERE c.oid = %s::regclass AND a.grantee <> c.relowner
+        ORDER BY 1, 2;
+        """, (table,))
+    grants = [list(row) for row in cursor.fetchall()]
+    return {'columns': columns, 'constraints': constraints, 'indexes': indexes, 'grants': grants}
+
+
+def export_snapshot(conn, outdir, timer, logger):
+    """
+    Write a snapshot of SNAPSHOT_TABLES to outdir.  All tables are read in one
+    repeatable read transaction, so they are consistent with each other and
+    with the data version in the manifest.
+
+    Output:
+        manifest dict
+    """
+    os.makedirs(outdir, exist_ok=True)
+    conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    manifest = {'created': datetime.now().isoformat(timespec='seconds'),
+                'data_version': get_data_version(conn, logger),
+                'tables': []}
+    with conn.cursor() as cursor:
+        for table in SNAPSHOT_TABLES:
+            definition = table_definition(cursor, table)
+            if definition is None:
+                logger.info(f'Snapshot: {table} does not exist, skipped')
+                continue
+            file = table + '.copy.gz'
+            columns = ', '.join(col[0] for col in definition['columns'])
+            with timer.stage(table):
+                with open(os.path.join(outdir, file), 'wb') as raw:
+                    hashed = _HashingFile(raw)
+                    with gzip.GzipFile(fileobj=hashed, mode='wb', compresslevel=COMPRESS_LEVEL) as gz:
+                        cursor.copy_expert(f'COPY {table} ({columns}) TO STDOUT (FORMAT binary)',
+                                           gz, size=COPY_BUFFER)
+                cursor.execute(f'SELECT count(*) FROM {table};')
+                nrows = cursor.fetchone()[0]
+            manifest['tables'].append({'name': table, 'file': file, 'rows': nrows,
+                                       'bytes': hashed.nbytes, 'sha256': hashed.sha256.hexdigest(),
+                                       **definition})
+            timer.log_item(logger, table, nrows)
+    conn.rollback()
+    conn.set_session(isolation_level='DEFAULT', readonly=False)
+
+    with open(os.path.join(outdir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def _rename_index_sql(indexdef, table, name):
+    """
+    CREATE INDEX statement of indexdef for the restore table
+    """
+    indexdef = re.sub(r' ON (\w+\.)?' + re.escape(table) + ' ',
+                      f' ON {table}{RESTORE_SUFFIX} ', indexdef, count=1)
+    return indexdef.replace(f'INDEX {name} ', f'INDEX {name}{RESTORE_SUFFIX} ', 1)
+
+
+def load_table(cursor, indir, entry, timer):
+    """
+    Load one table of a snapshot into an unlogged restore table, then build
+    its constraints and indexes and make it logged
+
+    Output:
+        number of rows loaded
+    """
+    table = entry['name']
+    restore = table + RESTORE_SUFFIX
+    columns = ', '.join(f'{name} {coltype}' + (' NOT NULL' if notnull else '')
+                        + (f' DEFAULT {default}' if default else '')
+                        for name, coltype, notnull, default in entry['columns'])
+    cursor.execute(f'DROP TABLE IF EXISTS {restore};')
+    cursor.execute(f'CREATE UNLOGGED TABLE {restore} ({columns});')
+
+    with timer.stage('load'):
+        with open(os.path.join(indir, entry['file']), 'rb') as raw:
+            hashed = _HashingFile(raw)
+            with gzip.GzipFile(fileobj=hashed, mode='rb') as gz:
+                names = ', '.join(col[0] for col in entry['columns'])
+                cursor.copy_expert(f'COPY {restore} ({names}) FROM STDIN (FORMAT binary)',
+                                   gz, size=COPY_BUFFER)
+            while hashed.read(COPY_BUFFER):
+                pass
+    if hashed.sha256.hexdigest() != entry['sha256']:
+        raise ValueError(f"Checksum mismatch for {entry['file']}")
+
+    #keys and indexes are built once over the loaded table
+    with timer.stage('index'):
+        for name, definition in entry['constraints']:
+            cursor.execute(f'ALTER TABLE {restore} ADD CONSTRAINT {name}{RESTORE_SUFFIX} {definition};')
+        for indexdef in entry['indexes']:
+            name = re.search(r'INDEX (\w+) ', indexdef).group(1)
+            cursor.execute(_rename_index_sql(indexdef, table, name) + ';')
+        cursor.execute(f'ANALYZE {restore};')
+    with timer.stage('logged'):
+        cursor.execute(f'ALTER TABLE {restore} SET LOGGED;')
+    cursor.execute(f'SELECT count(*) FROM {restore};')
+    nrows = cursor.fetchone()[0]
+    if nrows != entry['rows']:
+        raise ValueError(f"{table}: loaded {nrows} rows, manifest has {entry['rows']}")
+    return nrows
+
+
+def swap_table(cursor, entry, logger):
+    """
+    Replace a table by its restore table, renaming its constraints and indexes
+    back and granting the privileges recorded in the manifest again (roles
+    that do not exist in this database are skipped)
+    """
+    table = entry['name']
+    cursor.execute(f'DROP TABLE IF EXISTS {table};')
+    cursor.execute(f'ALTER TABLE {table}{RESTORE_SUFFIX} RENAME TO {table};')
+    for name, _ in entry['constraints']:
+        cursor.execute(f'ALTER TABLE {table} RENAME CONSTRAINT {name}{RESTORE_SUFFIX} TO {name};')
+    for indexdef in entry['indexes']:
+        name = re.search(r'INDEX (\w+) ', indexdef).group(1)
+        cursor.execute(f'ALTER INDEX {name}{RESTORE_SUFFIX} RENAME TO {name};')
+    for grantee, privilege, grantable in entry.get('grants', []):
+        if grantee != 'PUBLIC':
+            cursor.execute("SELECT to_regrole(%s);", (quote_ident(grantee, cursor),))
+            if cursor.fetchone()[0] is None:
+                logger.warning(f'Snapshot: role {grantee} does not exist, '
+                               f'{privilege} on {table} not granted')
+                continue
+            grantee = quote_ident(grantee, cursor)
+        cursor.execute(f'GRANT {privilege} ON {table} TO {grantee}'
+                       + (' WITH GRANT OPTION;' if grantable else ';'))
+
+
+def restore_snapshot(conn, indir, timer, logger, tables=None):
+    """
+    Restore a snapshot written by export_snapshot.  Everything runs in one
+    transaction: on any error (including a checksum or row count mismatch)
+    the database is left unchanged.
+
+    Input:
+        conn: The connection object to the db
+        indir: snapshot directory
+        timer: StageTimer
+        logger: logging object
+        tables: names of the tables to restore (default all in the manifest)
+    Output:
+        manifest dict
+    """
+    with open(os.path.join(indir, MANIFEST)) as f:
+        manifest = json.load(f)
+    entries = [entry for entry in manifest['tables'] if tables is None or entry['name'] in tables]
+    try:
+        with conn.cursor() as cursor:
+            for entry in entries:
+                nrows = load_table(cursor, indir, entry, timer)
+                timer.log_item(logger, entry['name'], nrows)
+            with timer.stage('swap'):
+                for entry in entries:
+                    swap_table(cursor, entry, logger)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return manifest
+
+
+def main(args):
+    """
+    Export or restore a snapshot
+    """
+    logger.info(f'Started snapshot {args.command} {args.dir}')
+    timer = StageTimer()
+    conn = connect_to_db(logger)
+    if conn is None:
+        return
+    if args.command == 'export':
+        manifest = export_snapshot(conn, args.dir, timer, logger)
+    else:
+        manifest = restore_snapshot(conn, args.dir, timer, logger, args.tables)
+    conn.close()
+    nrows = sum(entry['rows'] for entry in manifest['tables']
+                if args.command == 'export' or args.tables is None or entry['name'] in args.tables)
+    logger.info(f"Snapshot {args.command} at data version {manifest['data_version']}: "
+                f"{len(manifest['tables'])} tables in the manifest")
+    timer.log_totals(logger, nrows)
+    logger.info('Ended snapshot')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export or restore a binary snapshot of the wxdata tables')
+    parser.add_argument('command', choices=['export', 'restore'])
+    parser.add_argument('dir', help='snapshot directory')
+    parser.add_argument('--tables', nargs='+',
+                        help='with restore, only restore these tables')
+    args = parser.parse_args()
+    main(args)
@@ -1,10 +1,22 @@
 #!/usr/bin/env python
 
 #logging
+import argparse
 import logging
+from collections import Counter
 
 #PostgreSQL local library
-from db_util import connect_to_db, init_table, execute_insert_db, execute_select_db
+from db_util import (connect_to_db, init_table, grant_select, init_quarantine_table,
+                     execute_select_db, execute_batch_db, count_upserts,
+                     prepared_sql, log_prepared_stats,
+                     enable_query_profiling, log_query_profile,
+                     init_version_tables, get_dirty_station_years, set_job_version)
+from timing_util import StageTimer, run_profiled
+from wxqc import QC_BAD_MAXT, QC_BAD_MINT, QC_BAD_PRECIP
+from wxclimo import (init_climatology_table, get_station_series, climatology, upsert_climatology,
+                     CLIMO_VARIABLES)
+from wxsketch import init_sketch_table, station_year_sketches, upsert_sketches
+from wxtrends import init_trend_tables, has_trends, refresh_trends
 
 maindir = '../'
 
@@ -21,6 +33,16 @@ dbpassword = "test"
 dbhost = "localhost"
 dbport = "5432"
 
+# Value columns shared by weather_stats, weather_stats_monthly and weather_stats_seasonal
+STATS_COLUMNS = ['max_temperature_avg', 'min_temperature_avg', 'precipitation_accum',
+                 'number_obs_maxtemp', 'number_obs_precip']
+
+# Seasons summarized in weather_stats_seasonal: name -> months
+SEASONS = {'growing': (4, 5, 6, 7, 8, 9)}
+
+# Name of this job in job_versions
+JOB_NAME = 'stats'
+
 def init_stats_table(logger):
     """
     Connect to the wxdata database and create the station_data table.
@@ -40,132 +62,321 @@ def init_stats_table(logger):
     """
 
     init_table(create_table_sql, logger)
+    grant_select(['weather_stats'], logger)
+
+def init_rollup_tables(logger):
+    """
+    Connect to the wxdata database and create the monthly and seasonal stats tables.
+    """
 
-def get_stations(logger):
+    create_table_sql = """
+        CREATE TABLE IF NOT EXISTS weather_stats_monthly (
+            station_id VARCHAR(20) NOT NULL,
+            year INT NOT NULL,
+            month INT NOT NULL,
+            max_temperature_avg DECIMAL(7, 2),
+            min_temperature_avg DECIMAL(7, 2),
+            precipitation_accum DECIMAL(10, 2),
+            number_obs_maxtemp INT NOT NULL,
+            number_obs_precip INT NOT NULL,
+            PRIMARY KEY (station_id, year, month)
+        );
+        CREATE TABLE IF NOT EXISTS weather_stats_seasonal (
+            station_id VARCHAR(20) NOT NULL,
+            year INT NOT NULL,
+            season VARCHAR(20) NOT NULL,
+            max_temperature_avg DECIMAL(7, 2),
+            min_temperature_avg DECIMAL(7, 2),
+            precipitation_accum DECIMAL(10, 2),
+            number_obs_maxtemp INT NOT NULL,
+            number_obs_precip INT NOT NULL,
+            PRIMARY KEY (station_id, year, season)
+        );
+    """
+
+    init_table(create_table_sql, logger)
+    grant_select(['weather_stats_monthly', 'weather_stats_seasonal'], logger)
+
+def get_stations(conn, logger):
     """
     Retrieve list of stations
     Input:
+        conn: The connection object to the db
         logger: logging object
     Output:
         stations: list of stations
     """
-    conn = connect_to_db(logger)
-    if conn is not None:
-        sql = """
-            SELECT DISTINCT station_id FROM station_data;
-            """
-        stations = [row[0] for row in execute_select_db(conn, logger, sql)]
-        conn.close()
-        return stations
-
-    return None
+    sql = """
+        SELECT DISTINCT station_id FROM station_data;
+        """
+    return [row[0] for row in execute_select_db(conn, logger, sql) or []]
 
-def get_min_max_year(station, logger):
+def get_min_max_year(conn, station, logger):
     """
     Get min and max year in db
     Input:
+        conn: The connection object to the db
         station: station id
         logger: logging object
     Output:
         minyear, maxyear: min and max year for station
     """
-    conn = connect_to_db(logger)
-    if conn is not None:
-        sql = """
-            SELECT MIN(date_part('year',date)), MAX(date_part('year',date)) FROM station_data 
-            WHERE station_id = '{}';
-            """
-        res = execute_select_db(conn, logger, sql.format(station))
-        conn.close()
-        return res[0][0],res[0][1]
+    sql = prepared_sql(conn, logger, 'min_max_date', """
+        SELECT MIN(date), MAX(date) FROM station_data
+        WHERE station_id = %s;
+        """)
+    res = execute_select_db(conn, logger, sql, (station,))
+    if not res or res[0][0] is None:
+        return None, None
+    return res[0][0].year, res[0][1].year
 
-    return None
 
-
-def get_stats(station, year, logger):
+def get_monthly_sums(conn, station, firstyear, lastyear, logger):
     """
-    Get average max T, average min T, accumulated precip, and number of obs for station and year
+    Get monthly sums and numbers of obs of max T, min T and precip for a station
+    and range of years, in one pass over station_data.  Values with QC flags
+    that mark them as bad (see wxqc) are left out.
     Input:
+        conn: The connection object to the db
         station: station id for db
-        year: year to calculate statistics
+        firstyear, lastyear: range of years (inclusive)
         logger: logging object
     Output:
-        maxt_avg, mint_avg, precip_sum, nobs_temp, nobs_precip
+        list of (year, month, maxt_sum, nobs_maxt, mint_sum, nobs_mint, precip_sum, nobs_precip)
     """
-    conn = connect_to_db(logger)
-    if conn is not None:
-        sql = """
-            SELECT AVG(max_temperature), AVG(min_temperature), SUM(precipitation), 
-                   count(max_temperature),count(precipitation)
-            FROM station_data 
-            WHERE station_id = '{}' and date_part('year',date) = {};
-            """
-        res = execute_select_db(conn, logger, sql.format(station, year))
-        conn.close()
-        return res[0]
+    #a date range (rather than date_part) lets the primary key index be used
+    sql = prepared_sql(conn, logger, 'monthly_sums', f"""
+        SELECT date_part('year', date)::int, date_part('month', date)::int,
+               SUM(max_temperature) FILTER (WHERE qc_flags & {QC_BAD_MAXT} = 0),
+               count(max_temperature) FILTER (WHERE qc_flags & {QC_BAD_MAXT} = 0),
+               SUM(min_temperature) FILTER (WHERE qc_flags & {QC_BAD_MINT} = 0),
+               count(min_temperature) FILTER (WHERE qc_flags & {QC_BAD_MINT} = 0),
+               SUM(precipitation) FILTER (WHERE qc_flags & {QC_BAD_PRECIP} = 0),
+               count(precipitation) FILTER (WHERE qc_flags & {QC_BAD_PRECIP} = 0)
+        FROM station_data
+        WHERE station_id = %s AND date BETWEEN make_date(%s, 1, 1) AND make_date(%s, 12, 31)
+        GROUP BY 1, 2;
+        """)
+    return execute_select_db(conn, logger, sql, (station, firstyear, lastyear)) or []
 
-    return None
 
-def upsert_stats_data(conn, data, logger):
+def _stats_values(sums):
+    """
+    Convert summed values to the statistics columns
+    Input:
+        sums: [maxt_sum, nobs_maxt, mint_sum, nobs_mint, precip_sum, nobs_precip]
+    Output:
+        maxt_avg, mint_avg, precip_accum (cm), nobs_maxt, nobs_precip
     """
-    Inserts data into the weather_stats table or updates the record
-    if station_id and date already exist.
+    smaxt, nmaxt, smint, nmint, sprecip, nprecip = sums
+    return (smaxt/nmaxt if nmaxt else None,
+            smint/nmint if nmint else None,
+            sprecip/10. if nprecip else None, #convert to cm
+            nmaxt, nprecip)
+
+
+def rollup_stats(station, years, monthly):
+    """
+    Build yearly, monthly and seasonal statistics rows from monthly sums
+    Input:
+        station: station id
+        years: years to build yearly and seasonal rows for (all of them,
+               even without data, as for the original per-year stats)
+        monthly: output of get_monthly_sums
+    Output:
+        yearly, monthly, seasonal: lists of rows for weather_stats,
+        weather_stats_monthly and weather_stats_seasonal
+    """
+    years = set(years)
+    yearsums = {year: [0., 0, 0., 0, 0., 0] for year in years}
+    seasonsums = {(year, season): [0., 0, 0., 0, 0., 0] for year in years for season in SEASONS}
+    monthrows = []
+    for year, month, *sums in monthly:
+        if year not in years:
+            continue
+        sums = [float(value) if value is not None else 0. for value in sums]
+        sums[1::2] = [int(n) for n in sums[1::2]]
+        monthrows.append((station, year, month) + _stats_values(sums))
+        targets = [yearsums[year]] + [seasonsums[(year, season)]
+                                      for season, months in SEASONS.items() if month in months]
+        for target in targets:
+            for i, value in enumerate(sums):
+                target[i] += value
+
+    yearrows = [(station, year) + _stats_values(yearsums[year]) for year in sorted(years)]
+    seasonrows = [(station, year, season) + _stats_values(seasonsums[(year, season)])
+                  for year, season in sorted(seasonsums)]
+    return yearrows, monthrows, seasonrows
+
+def upsert_rollup_batch(conn, table, keys, rows, logger):
+    """
+    Inserts or updates (only if any value differs) statistics rows in one of
+    weather_stats, weather_stats_monthly or weather_stats_seasonal, in batches.
 
     Input:
         conn: The connection object to the db
-        data: a tuple containing:
-            station_id: station id (key)
-            year: year to be added (key)
-            avgmaxt: maximum temperature (C)
-            avgmint: minimum temperature (C)
-            accprecip: accumulated precipitation (mm)
-            nobs_temperature: number of temperature obs included
-            nobs_precip: number of precip obs included
+        table: table name
+        keys: primary key columns, e.g. ['station_id', 'year', 'month']
+        rows: list of tuples of the key columns followed by STATS_COLUMNS
+        logger: logging object
+    Output:
+        Counter with inserted, updated, unchanged and quarantined rows
+    """
 
+    sql = f"""
+    INSERT INTO {table} ({', '.join(keys + STATS_COLUMNS)})
+    VALUES %s
+    ON CONFLICT ({', '.join(keys)}) DO UPDATE
+    SET {', '.join(f'{col} = EXCLUDED.{col}' for col in STATS_COLUMNS)}
+    WHERE ({', '.join(f'{table}.{col}' for col in STATS_COLUMNS)})
+          IS DISTINCT FROM
+          ({', '.join(f'EXCLUDED.{col}' for col in STATS_COLUMNS)})
+    RETURNING (xmax = 0);
     """
+    results, nbad = execute_batch_db(conn, logger, sql, rows, source=table, fetch=True)
+    return count_upserts(results, len(rows), nbad)
 
-    sql = """
-    INSERT INTO weather_stats 
-            (station_id, 
-            year, 
-            max_temperature_avg,
-            min_temperature_avg,
-            precipitation_accum,
-            number_obs_maxtemp,
-            number_obs_precip)
-    VALUES (%s, %s, %s, %s, %s, %s, %s)
-    ON CONFLICT (station_id, year) DO UPDATE
-    SET max_temperature_avg = EXCLUDED.max_temperature_avg,
-        min_temperature_avg = EXCLUDED.min_temperature_avg,
-        precipitation_accum = EXCLUDED.precipitation_accum,
-        number_obs_maxtemp = EXCLUDED.number_obs_maxtemp,
-        number_obs_precip = EXCLUDED.number_obs_precip;
-    """
-    execute_insert_db(conn, logger, sql, data=data)
+def upsert_stats_data_batch(conn, rows, logger):
+    """
+    Inserts rows into the weather_stats table or updates the record if
+    station_id and year already exist and any value differs.  Writes rows in
+    multi-row batches, committing every batch and quarantining rows that
+    cannot be written.
 
-if __name__ == "__main__":
+    Input:
+        conn: The connection object to the db
+        rows: list of (station_id, year) tuples followed by STATS_COLUMNS
+        logger: logging object
+    Output:
+        Counter with inserted, updated, unchanged and quarantined rows
+    """
+    return upsert_rollup_batch(conn, 'weather_stats', ['station_id', 'year'], rows, logger)
+
+def update_station_stats(conn, dirty, timer, logger, all_trends=False):
     """
-    for each station:
-    - retrieve min/max year
-    - for each year:
-        - calculate avg maxt, mint, sum precip, nobs_temp, nobs_precip
-        - upsert to weather stats db
+    Recompute all statistics, the climatology and the sketches of the given
+    station-years, then the rolling means and trends of the stations whose
+    yearly stats changed
+
+    Input:
+        conn: The connection object to the db
+        dirty: dict of station -> list of years (None for all of its years)
+        timer: StageTimer
+        logger: logging object
+        all_trends: refresh the rolling means and trends of all stations
+    Output:
+        counts, nstats: Counter with inserted, updated, unchanged and
+                        quarantined yearly rows, and the number of yearly rows
     """
-    #create stats table if it does not exist
+    counts = Counter() #inserted/updated/unchanged/quarantined rows
+    nstats = 0
+    changed = [] #stations whose yearly stats changed
+    for stn, years in dirty.items():
+        with timer.stage('query'):
+            if years is None:
+                miny, maxy = get_min_max_year(conn, stn, logger)
+                years = range(int(miny), int(maxy+1)) if miny is not None else []
+            monthly = get_monthly_sums(conn, stn, min(years), max(years), logger) if years else []
+        with timer.stage('rollup'):
+            yearly, monthly, seasonal = rollup_stats(stn, years, monthly)
+        if yearly:
+            with timer.stage('upsert'):
+                yearcounts = upsert_stats_data_batch(conn, yearly, logger)
+                counts.update(yearcounts)
+                if yearcounts['inserted'] or yearcounts['updated']:
+                    changed.append(stn)
+                upsert_rollup_batch(conn, 'weather_stats_monthly',
+                                    ['station_id', 'year', 'month'], monthly, logger)
+                upsert_rollup_batch(conn, 'weather_stats_seasonal',
+                                    ['station_id', 'year', 'season'], seasonal, logger)
+            with timer.stage('climatology'):
+                dates, values, flags = get_station_series(conn, stn, logger)
+                means, stds, nobs = climatology(dates, values, flags)
+                upsert_climatology(conn, stn, means, stds, nobs, logger)
+            with timer.stage('sketch'):
+                upsert_sketches(conn, station_year_sketches(stn, years, dates, values, flags,
+                                                            CLIMO_VARIABLES), logger)
+        nstats += len(yearly)
+        timer.log_item(logger, stn, len(yearly))
+    with timer.stage('trends'):
+        refresh_trends(conn, None if all_trends else changed, logger)
+    return counts, nstats
+
+def main(args):
+    """
+    for each station (all of them, or only those changed since the last run):
+    - retrieve the years to update
+    - sum maxt, mint, precip and count obs by month in one query
+    - roll the months up to years and seasons
+    - upsert the yearly, monthly and seasonal stats in batches
+    - recompute the station's day-of-year climatology from its full series
+    - build quantile sketches for the station-years
+    then refresh the rolling means and trends of the stations whose yearly
+    stats changed (all stations with --full or when there are none yet)
+    """
+    if args.profile_sql:
+        enable_query_profiling(args.slow_ms, args.explain)
+
+    #create stats tables if they do not exist
     init_stats_table(logger)
+    init_rollup_tables(logger)
+    init_climatology_table(logger)
+    init_sketch_table(logger)
+    init_trend_tables(logger)
+    init_quarantine_table(logger)
+    init_version_tables(logger)
     logger.info('Started stats')
-    for stn in get_stations(logger):
-        miny, maxy = get_min_max_year(stn, logger)
-        if miny is not None:
-            for year in range(int(miny), int(maxy+1)):
-                avgmaxt, avgmint, psum, nobst, nobsp = get_stats(stn, year, logger)
-                if psum is not None:
-                    psum = float(psum)/10. #convert to cm
-                conn = connect_to_db(logger)
-                if conn is not None:
-                    upsert_stats_data(conn,
-                                      (stn, year, avgmaxt, avgmint, psum, nobst, nobsp),
-                                      logger)
-                conn.close()
+    counts = Counter()
+    timer = StageTimer()
+    nstats = 0
+    conn = connect_to_db(logger)
+    if conn is not None:
+        version, dirty = get_dirty_station_years(conn, logger, JOB_NAME)
+        if args.full or dirty is None:
+            logger.info(f'Full stats run at data version {version}')
+            dirty = {stn: None for stn in get_stations(conn, logger)}
+        else:
+            logger.info(f'Incremental stats run at data version {version}: '
+                        f'{sum(len(years) for years in dirty.values())} station-years')
 
+        all_trends = args.full or not has_trends(conn, logger)
+        counts, nstats = update_station_stats(conn, dirty, timer, logger, all_trends)
+
+        if version is not None:
+            set_job_version(conn, logger, JOB_NAME, version)
+        log_prepared_stats(conn, logger)
+        conn.close()
+
+    logger.info(f'Stats rows: {counts["inserted"]} inserted, {counts["updated"]} updated, '
+                f'{counts["unchanged"]} unchanged, {counts["quarantined"]} quarantined')
+    timer.log_totals(logger, nstats)
+    log_query_profile(logger)
     logger.info('Ended stats')
+    return timer.summary(nstats)
+
+
+def parse_args(argv=None):
+    """
+    Parse command line arguments (sys.argv if argv is None)
+    """
+    parser = argparse.ArgumentParser(description='Calculate yearly, monthly and seasonal statistics')
+    parser.add_argument('--profile-sql', action='store_true',
+                        help='time every statement and log a query profile at the end')
+    parser.add_argument('--slow-ms', type=float, default=250.,
+                        help='log statements slower than this many ms (with --profile-sql)')
+    parser.add_argument('--explain', action='store_true',
+                        help='log EXPLAIN (ANALYZE, BUFFERS) for slow statements')
+    parser.add_argument('--full', action='store_true',
+                        help='recompute all stations and years, not only those changed since the last run')
+    parser.add_argument('--cprofile', metavar='FILE',
+                        help='run under cProfile and write the stats to FILE')
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    if args.cprofile:
+        run_profiled(main, args.cprofile, logger, args)
+    else:
+        main(args)
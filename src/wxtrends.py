@@ -0,0 +1,129 @@
+from db_util import init_table, grant_select, execute_insert_db, execute_select_db
+
+# Rolling multi-year means and linear trends of the yearly statistics.
+# station_rolling_stats holds, per station and variable of weather_stats,
+# the mean over the ROLLING_WINDOWS years ending at each year with the
+# number of years that had a value; station_trends holds the least-squares
+# slope (units per year) over all years with a value.  Both are computed in
+# the database with window and regression aggregates over weather_stats, and
+# the stats job refreshes them only for stations whose yearly stats changed.
+
+# Lengths (years) of the rolling windows
+ROLLING_WINDOWS = [5, 10]
+
+# weather_stats columns with rolling means and trends
+TREND_VARIABLES = ['max_temperature_avg', 'min_temperature_avg', 'precipitation_accum']
+
+# (variable, value) rows of a weather_stats row s
+_VARIABLES_SQL = ', '.join(f"('{col}', s.{col})" for col in TREND_VARIABLES)
+
+
+def init_trend_tables(logger):
+    """
+    Connect to the wxdata database and create the station_rolling_stats and
+    station_trends tables.
+    """
+
+    create_table_sql = """
+        CREATE TABLE IF NOT EXISTS station_rolling_stats (
+            station_id VARCHAR(20) NOT NULL,
+            variable VARCHAR(32) NOT NULL,
+            window_years INT NOT NULL,
+            year INT NOT NULL,
+            mean DECIMAL(10, 2),
+            number_years INT NOT NULL,
+            PRIMARY KEY (station_id, variable, window_years, year)
+        );
+        CREATE TABLE IF NOT EXISTS station_trends (
+            station_id VARCHAR(20) NOT NULL,
+            variable VARCHAR(32) NOT NULL,
+            first_year INT,
+            last_year INT,
+            mean DECIMAL(10, 2),
+            slope_per_year DECIMAL(10, 4),
+            number_years INT NOT NULL,
+            PRIMARY KEY (station_id, variable)
+        );
+        CREATE INDEX IF NOT EXISTS station_trends_variable_slope
+            ON station_trends (variable, slope_per_year);
+    """
+
+    init_table(create_table_sql, logger)
+    grant_select(['station_rolling_stats', 'station_trends'], logger)
+
+
+def has_trends(conn, logger):
+    """
+    Output:
+        True if station_trends has any rows
+    """
+    res = execute_select_db(conn, logger, "SELECT EXISTS (SELECT 1 FROM station_trends);")
+    return bool(res and res[0][0])
+
+
+def refresh_trends(conn, stations, logger):
+    """
+    Recompute the rolling means and trends of stations from weather_stats.
+    Rows are only rewritten where a value changed.
+
+    Input:
+        conn: The connection object to the db
+        stations: list of station ids, or None for all stations
+        logger: logging object
+    """
+    if stations is not None and not stations:
+        return
+    where = 'WHERE s.station_id = ANY(%s)' if stations is not None else ''
+    params = (list(stations),) if stations is not None else None
+
+    #one window per length; RANGE over the year also works across years without a row
+    windows = [f"""
+    SELECT station_id, variable, {nyears}, year, AVG(value) OVER w, COUNT(value) OVER w
+    FROM yearly
+    WINDOW w AS (PARTITION BY station_id, variable ORDER BY year
+                 RANGE BETWEEN {nyears - 1} PRECEDING AND CURRENT ROW)"""
+               for nyears in ROLLING_WINDOWS]
+    yearly = f"""
+    WITH yearly AS (
+        SELECT s.station_id, s.year, v.variable, v.value
+        FROM weather_stats s
+        CROSS JOIN LATERAL (VALUES {_VARIABLES_SQL}) AS v(variable, value)
+        {where}
+    )"""
+
+    rolling_sql = f"""
+    INSERT INTO station_rolling_stats
+            (station_id, variable, window_years, year, mean, number_years)
+    {yearly}
+    {' UNION ALL '.join(windows)}
+    ON CONFLICT (station_id, variable, window_years, year) DO UPDATE
+    SET mean = EXCLUDED.mean,
+        number_years = EXCLUDED.number_years
+    WHERE (station_rolling_stats.mean, station_rolling_stats.number_years)
+          IS DISTINCT FROM (EXCLUDED.mean, EXCLUDED.number_years);
+    """
+    execute_insert_db(conn, logger, rolling_sql, params)
+
+    trends_sql = f"""
+    INSERT INTO station_trends
+            (station_id, variable, first_year, last_year, mean, slope_per_year, number_years)
+    {yearly}
+    SELECT station_id, variable,
+           MIN(year) FILTER (WHERE value IS NOT NULL),
+           MAX(year) FILTER (WHERE value IS NOT NULL),
+           AVG(value), regr_slope(value, year), regr_count(value, year)
+    FROM yearly
+    GROUP BY station_id, variable
+    ON CONFLICT (station_id, variable) DO UPDATE
+    SET first_year = EXCLUDED.first_year,
+        last_year = EXCLUDED.last_year,
+        mean = EXCLUDED.mean,
+        slope_per_year = EXCLUDED.slope_per_year,
+        number_years = EXCLUDED.number_years
+    WHERE (station_trends.first_year, station_trends.last_year, station_trends.mean,
+           station_trends.slope_per_year, station_trends.number_years)
+          IS DISTINCT FROM
+          (EXCLUDED.first_year, EXCLUDED.last_year, EXCLUDED.mean,
+           EXCLUDED.slope_per_year, EXCLUDED.number_years);
+    """
+    execute_insert_db(conn, logger, trends_sql, params)
@@ -0,0 +1,123 @@
+import os
+import time
+
+# Watch a directory for new or modified station files.
+# Uses inotify (through the optional inotify_simple package) so changes are
+# reported by the kernel without rescanning the directory; falls back to
+# polling file sizes and modification times where inotify is not available.
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
+# Seconds between directory scans when polling
+POLL_INTERVAL_S = 2.
+
+# After the first change, keep collecting changes for this long so that a
+# file being written (or many files arriving together) makes one micro-batch
+BATCH_WINDOW_S = 1.
+
+
+class InotifyWatcher:
+    """
+    Report files in a directory that were closed after writing or moved in
+    """
+
+    def __init__(self, directory, suffix):
+        self.directory = directory
+        self.suffix = suffix
+        self.inotify = INotify()
+        self.inotify.add_watch(directory, inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO)
+
+    def changes(self, timeout_s):
+        """
+        Wait up to timeout_s for changes
+        Output:
+            set of changed file paths (empty on timeout)
+        """
+        events = self.inotify.read(timeout=int(timeout_s*1000))
+        return {os.path.join(self.directory, event.name) for event in events
+                if event.name.endswith(self.suffix)}
+
+    def close(self):
+        self.inotify.close()
+
+
+class PollingWatcher:
+    """
+    Report files in a directory whose size or modification time changed
+    since the previous scan
+    """
+
+    def __init__(self, directory, suffix, interval_s=POLL_INTERVAL_S):
+        self.directory = directory
+        self.suffix = suffix
+        self.interval_s = interval_s
+        self.seen = self._scan()
+
+    def _scan(self):
+        seen = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.endswith(self.suffix) and entry.is_file():
+                    stat = entry.stat()
+                    seen[entry.path] = (stat.st_size, stat.st_mtime_ns)
+        return seen
+
+    def changes(self, timeout_s):
+        """
+        Scan every interval_s until something changed or timeout_s passed
+        Output:
+            set of changed file paths (empty on timeout)
+        """
+        deadline = time.monotonic() + timeout_s
+        while True:
+            seen = self._scan()
+            changed = {path for path, sig in seen.items() if self.seen.get(path) != sig}
+            self.seen = seen
+            remaining = deadline - time.monotonic()
+            if changed or remaining <= 0:
+                return changed
+            time.sleep(min(self.interval_s, remaining))
+
+    def close(self):
+        pass
+
+
+def make_watcher(directory, suffix, logger, poll=False, interval_s=POLL_INTERVAL_S):
+    """
+    Input:
+        directory: directory to watch
+        suffix: only report files ending with suffix
+        logger: logging object
+        poll: use polling even if inotify is available
+        interval_s: seconds between scans when polling
+    Output:
+        InotifyWatcher, or PollingWatcher if inotify is unavailable
+    """
+    if not poll and INotify is not None:
+        try:
+            return InotifyWatcher(directory, suffix)
+        except OSError as e:
+            logger.warning(f'inotify unavailable ({e}), polling instead')
+    elif not poll:
+        logger.info('inotify_simple not installed, polling instead')
+    return PollingWatcher(directory, suffix, interval_s)
+
+
+def next_batch(watcher, timeout_s, window_s=BATCH_WINDOW_S):
+    """
+    Wait up to timeout_s for a change, then collect further changes for
+    window_s seconds
+    Output:
+        set of changed file paths (empty on timeout)
+    """
+    changed = watcher.changes(timeout_s)
+    if changed:
+        deadline = time.monotonic() + window_s
+        remaining = window_s
+        while remaining > 0:
+            changed |= watcher.changes(remaining)
+            remaining = deadline - time.monotonic()
+    return changed
@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+
+#general use libraries
+import argparse
+import logging
+import pandas as pd
+
+#PostgreSQL local library
+from db_util import (connect_to_db, init_table, grant_select, init_quarantine_table, init_version_tables,
+                     execute_select_db, execute_batch_db, count_upserts,
+                     get_dirty_station_years, set_job_version, count_job_run)
+from timing_util import StageTimer, run_profiled
+from wxqc import QC_BAD_MAXT, QC_BAD_MINT, QC_BAD_PRECIP
+
+maindir = '../'
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO,
+                    format = '%(asctime)s - %(message)s',
+                    filename=maindir + 'wxfeatures.log')
+
+# Corn growing degree days: temperatures are clipped to [GDD_BASE_C, GDD_CAP_C]
+GDD_BASE_C = 10.
+GDD_CAP_C = 30.
+# Days with max temperature at or above this count as heat stress days
+HEAT_STRESS_C = 35.
+# Growing season months
+GROWING_MONTHS = (4, 9)
+# Station-years need at least this many growing season days to enter the
+# cross-station means (the season has 183 days)
+MIN_SEASON_OBS = 150
+
+# Name of this job in job_versions, and of the count of corn_yield changes
+JOB_NAME = 'yield_features'
+YIELD_JOB = 'corn_yield'
+
+
+def init_feature_tables(logger):
+    """
+    Connect to the wxdata database and create the yield and feature tables.
+    """
+
+    create_table_sql = """
+        CREATE TABLE IF NOT EXISTS corn_yield (
+            year INT PRIMARY KEY,
+            grain_yield BIGINT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS station_year_features (
+            station_id VARCHAR(20) NOT NULL,
+            year INT NOT NULL,
+            gdd DECIMAL(8, 1),
+            precipitation_accum DECIMAL(8, 1),
+            heat_stress_days INT,
+            number_obs INT NOT NULL,
+            PRIMARY KEY (station_id, year)
+        );
+        CREATE TABLE IF NOT EXISTS yield_features (
+            year INT PRIMARY KEY,
+            number_stations INT NOT NULL,
+            gdd_mean DECIMAL(8, 1),
+            gdd_std DECIMAL(8, 1),
+            precipitation_mean DECIMAL(8, 1),
+            precipitation_std DECIMAL(8, 1),
+            heat_stress_days_mean DECIMAL(6, 2),
+            grain_yield BIGINT
+        );
+    """
+
+    init_table(create_table_sql, logger)
+    grant_select(['yield_features'], logger)
+
+
+def upsert_yield(conn, file, logger):
+    """
+    Load the yearly corn yield series into corn_yield
+    Input:
+        conn: The connection object to the db
+        file: tab separated file of year, yield
+        logger: logging object
+    Output:
+        set of years whose yield was inserted or updated
+    """
+    df = pd.read_csv(file, sep='\t', header=None, names=['year', 'grain_yield'])
+    sql = """
+    INSERT INTO corn_yield (year, grain_yield) VALUES %s
+    ON CONFLICT (year) DO UPDATE SET grain_yield = EXCLUDED.grain_yield
+    WHERE corn_yield.grain_yield IS DISTINCT FROM EXCLUDED.grain_yield
+    RETURNING year;
+    """
+    rows = list(zip(df['year'].tolist(), df['grain_yield'].tolist()))
+    results, _ = execute_batch_db(conn, logger, sql, rows, source=file, fetch=True)
+    return {res[0] for res in results}
+
+
+def get_growing_season_data(conn, years, logger):
+    """
+    Get the growing season data of all stations for the given years
+    Input:
+        conn: The connection object to the db
+        years: list of years, or None for all years
+        logger: logging object
+    Output:
+        DataFrame with station_id, year, maxt, mint, precip (bad values set to NaN)
+    """
+    columns = f"""
+               CASE WHEN d.qc_flags & {QC_BAD_MAXT} = 0 THEN d.max_temperature END,
+               CASE WHEN d.qc_flags & {QC_BAD_MINT} = 0 THEN d.min_temperature END,
+               CASE WHEN d.qc_flags & {QC_BAD_PRECIP} = 0 THEN d.precipitation END"""
+    if years is None:
+        #most of the table: one scan
+        sql = f"""
+            SELECT d.station_id, date_part('year', d.date)::int, {columns}
+            FROM station_data d
+            WHERE date_part('month', d.date) BETWEEN %s AND %s
+            """
+        params = GROWING_MONTHS
+    else:
+        #one date range per year, so the date index can be used
+        sql = f"""
+            SELECT d.station_id, y.year, {columns}
+            FROM unnest(%s::int[]) AS y(year)
+            JOIN station_data d
+              ON d.date >= make_date(y.year, %s, 1)
+             AND d.date < (make_date(y.year, %s, 1) + interval '1 month')::date
+            """
+        params = (list(years), *GROWING_MONTHS)
+    res = execute_select_db(conn, logger, sql, tuple(params)) or []
+    df = pd.DataFrame(res, columns=['station_id', 'year', 'maxt', 'mint', 'precip'])
+    return df.astype({'maxt': float, 'mint': float, 'precip': float})
+
+
+def station_year_features(df):
+    """
+    Growing season features for every station-year, vectorized over all rows
+    Input:
+        df: output of get_growing_season_data
+    Output:
+        DataFrame indexed by (station_id, year) with gdd (C days),
+        precipitation_accum (cm), heat_stress_days and number_obs
+    """
+    tmax = df['maxt'].clip(GDD_BASE_C, GDD_CAP_C)
+    tmin = df['mint'].clip(GDD_BASE_C, GDD_CAP_C)
+    daily = pd.DataFrame({'station_id': df['station_id'],
+                          'year': df['year'],
+                          'gdd': (tmax + tmin)/2. - GDD_BASE_C,
+                          'precipitation_accum': df['precip']/10., #convert to cm
+                          'heat_stress_days': (df['maxt'] >= HEAT_STRESS_C).astype(int),
+                          'number_obs': 1})
+    return daily.groupby(['station_id', 'year']).sum(min_count=1)
+
+
+def year_features(features, yields):
+    """
+    Cross-station year x feature matrix joined to the yield series
+    Input:
+        features: output of station_year_features
+        yields: Series of grain_yield indexed by year
+    Output:
+        DataFrame indexed by year
+    """
+    complete = features[features['number_obs'] >= MIN_SEASON_OBS]
+    grouped = complete.groupby(level='year')
+    matrix = pd.DataFrame({'number_stations': grouped.size(),
+                           'gdd_mean': grouped['gdd'].mean(),
+                           'gdd_std': grouped['gdd'].std(),
+                           'precipitation_mean': grouped['precipitation_accum'].mean(),
+                           'precipitation_std': grouped['precipitation_accum'].std(),
+                           'heat_stress_days_mean': grouped['heat_stress_days'].mean()})
+    matrix = matrix.reindex(features.index.get_level_values('year').unique())
+    matrix['number_stations'] = matrix['number_stations'].fillna(0).astype(int)
+    return matrix.join(yields, how='left')
+
+
+def _to_rows(df):
+    """
+    DataFrame (with its index) to a list of tuples with NaN as None
+    """
+    df = df.reset_index().astype(object)
+    return list(df.where(pd.notna(df), None).itertuples(index=False, name=None))
+
+
+def upsert_station_year_features(conn, features, logger):
+    """
+    Inserts or updates (only if any value differs) station_year_features
+    Output:
+        Counter with inserted, updated, unchanged and quarantined rows
+    """
+    sql = """
+    INSERT INTO station_year_features
+            (station_id, year, gdd, precipitation_accum, heat_stress_days, number_obs)
+    VALUES %s
+    ON CONFLICT (station_id, year) DO UPDATE
+    SET gdd = EXCLUDED.gdd,
+        precipitation_accum = EXCLUDED.precipitation_accum,
+        heat_stress_days = EXCLUDED.heat_stress_days,
+        number_obs = EXCLUDED.number_obs
+    WHERE (station_year_features.gdd, station_year_features.precipitation_accum,
+           station_year_features.heat_stress_days, station_year_features.number_obs)
+          IS DISTINCT FROM
+          (EXCLUDED.gdd, EXCLUDED.precipitation_accum,
+           EXCLUDED.heat_stress_days, EXCLUDED.number_obs)
+    RETURNING (xmax = 0);
+    """
+    rows = _to_rows(features.round(1))
+    results, nbad = execute_batch_db(conn, logger, sql, rows,
+                                     source='station_year_features', fetch=True)
+    return count_upserts(results, len(rows), nbad)
+
+
+def upsert_year_features(conn, matrix, logger):
+    """
+    Inserts or updates (only if any value differs) yield_features
+    Output:
+        Counter with inserted, updated, unchanged and quarantined rows
+    """
+    sql = """
+    INSERT INTO yield_features
+            (year, number_stations, gdd_mean, gdd_std, precipitation_mean,
+             precipitation_std, heat_stress_days_mean, grain_yield)
+    VALUES %s
+    ON CONFLICT (year) DO UPDATE
+    SET number_stations = EXCLUDED.number_stations,
+        gdd_mean = EXCLUDED.gdd_mean,
+        gdd_std = EXCLUDED.gdd_std,
+        precipitation_mean = EXCLUDED.precipitation_mean,
+        precipitation_std = EXCLUDED.precipitation_std,
+        heat_stress_days_mean = EXCLUDED.heat_stress_days_mean,
+        grain_yield = EXCLUDED.grain_yield
+    WHERE (yield_features.number_stations, yield_features.gdd_mean, yield_features.gdd_std,
+           yield_features.precipitation_mean, yield_features.precipitation_std,
+           yield_features.heat_stress_days_mean, yield_features.grain_yield)
+          IS DISTINCT FROM
+          (EXCLUDED.number_stations, EXCLUDED.gdd_mean, EXCLUDED.gdd_std,
+           EXCLUDED.precipitation_mean, EXCLUDED.precipitation_std,
+           EXCLUDED.heat_stress_days_mean, EXCLUDED.grain_yield)
+    RETURNING (xmax = 0);
+    """
+    rows = _to_rows(matrix[['number_stations', 'gdd_mean', 'gdd_std', 'precipitation_mean',
+                            'precipitation_std', 'heat_stress_days_mean', 'grain_yield']]
+                    .round(2))
+    results, nbad = execute_batch_db(conn, logger, sql, rows, source='yield_features', fetch=True)
+    return count_upserts(results, len(rows), nbad)
+
+
+def get_yields(conn, logger):
+    """
+    Output:
+        Series of grain_yield indexed by year
+    """
+    res = execute_select_db(conn, logger, "SELECT year, grain_yield FROM corn_yield;") or []
+    return pd.Series(dict(res), name='grain_yield', dtype=float).rename_axis('year')
+
+
+def main(args):
+    """
+    - load the yield series
+    - find the years with changed station data or yield (all years with --full)
+    - compute per-station growing season features for those years in one pass
+    - aggregate across stations into the year x feature matrix joined to yield
+
+    Input:
+        args: parsed command line arguments (see parse_args)
+    Output:
+        timer summary of the run (see StageTimer.summary), None without a database
+    """
+    init_feature_tables(logger)
+    init_quarantine_table(logger)
+    init_version_tables(logger)
+    logger.info('Started features')
+    timer = StageTimer()
+    conn = connect_to_db(logger)
+    if conn is None:
+        return None
+
+    with timer.stage('yield'):
+        yield_years = upsert_yield(conn, maindir + 'yld_data/US_corn_grain_yield.txt', logger)
+        yields = get_yields(conn, logger)
+
+    version, dirty = get_dirty_station_years(conn, logger, JOB_NAME)
+    if args.full or dirty is None:
+        years = None
+        logger.info(f'Full feature run at data version {version}')
+    else:
+        years = sorted({year for stnyears in dirty.values() for year in stnyears} | yield_years)
+        logger.info(f'Incremental feature run at data version {version}: years {years}')
+
+    nrows = 0
+    if years is None or years:
+        with timer.stage('query'):
+            df = get_growing_season_data(conn, years, logger)
+        with timer.stage('features'):
+            features = station_year_features(df)
+            matrix = year_features(features, yields)
+        with timer.stage('upsert'):
+            counts = upsert_station_year_features(conn, features, logger)
+            logger.info(f'Station-year features: {counts["inserted"]} inserted, '
+                        f'{counts["updated"]} updated, {counts["unchanged"]} unchanged')
+            upsert_year_features(conn, matrix, logger)
+        nrows = len(df)
+
+    if version is not None:
+        set_job_version(conn, logger, JOB_NAME, version)
+    if yield_years:
+        #after the features, so pages rebuilt on the change include them
+        count_job_run(conn, logger, YIELD_JOB)
+    conn.close()
+    timer.log_totals(logger, nrows)
+    logger.info('Ended features')
+    return timer.summary(nrows)
+
+
+def parse_args(argv=None):
+    """
+    Parse command line arguments (sys.argv if argv is None)
+    """
+    parser = argparse.ArgumentParser(description='Build growing season features joined to corn yield')
+    parser.add_argument('--full', action='store_true',
+                        help='recompute all years, not only those changed since the last run')
+    parser.add_argument('--cprofile', metavar='FILE',
+                        help='run under cProfile and write the stats to FILE')
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    if args.cprofile:
+        run_profiled(main, args.cprofile, logger, args)
+    else:
+        main(args)
@@ -0,0 +1,46 @@
+import logging
+import os
+
+import psycopg2
+import pytest
+
+import db_util
+from db_util import enable_query_profiling, execute_insert_db
+
+# Scratch database for the tests that need PostgreSQL; they are skipped when
+# it cannot be reached
+TEST_DB = os.environ.get('WXDATA_TEST_DB', 'wxtest')
+
+
+@pytest.fixture
+def conn():
+    try:
+        conn = psycopg2.connect(dbname=TEST_DB, user=db_util.dbuser, password=db_util.dbpassword,
+                                host=db_util.dbhost, port=db_util.dbport)
+    except psycopg2.OperationalError as e:
+        pytest.skip(f'no test database: {e}')
+    with conn.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS explain_test;"
+                       "CREATE TABLE explain_test (id INT PRIMARY KEY);")
+    conn.commit()
+    yield conn
+    conn.rollback()
+    with conn.cursor() as cursor:
+        cursor.execute("DROP TABLE explain_test;")
+    conn.commit()
+    conn.close()
+
+
+def test_failed_explain_keeps_write(conn, monkeypatch):
+    for name in ('profile_queries', 'slow_query_ms', 'explain_slow_queries'):
+        monkeypatch.setattr(db_util, name, getattr(db_util, name))
+    monkeypatch.setattr(db_util, 'query_profile', {})
+    #every statement is slow; explaining the insert runs it again, which
+    #fails on the primary key
+    enable_query_profiling(slow_ms=-1., explain=True)
+    execute_insert_db(conn, logging.getLogger('test'), "INSERT INTO explain_test VALUES (%s);", (1,))
+
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT id FROM explain_test;")
+        assert cursor.fetchall() == [(1,)]
+    assert db_util.query_profile
@@ -0,0 +1,123 @@
+import argparse
+import io
+import logging
+import os
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import wxdata_ingest
+from wxdata_ingest import read_chunks, read_station_file, qc_station_data, qc_with_context
+from wxqc import FLAT_RUN
+from wxwatch import next_batch
+
+
+def write_station_file(path, ndays=400, seed=0):
+    """
+    GHCN station file (tenths, -9999 missing) with a range outlier, spikes,
+    flat runs, min > max, missing values and a repeated date
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range('2003-01-01', periods=ndays).strftime('%Y%m%d').tolist()
+    maxt = (150 + 100*np.sin(np.arange(ndays)/58.) + rng.normal(0, 30, ndays)).astype(int)
+    mint = maxt - 80 - rng.integers(0, 30, ndays)
+    precip = (rng.gamma(0.5, 40., ndays)).astype(int)
+    maxt[30] = 700
+    maxt[101] += 300
+    mint[202] -= 300
+    maxt[150:150 + FLAT_RUN + 3] = 222
+    mint[297:297 + FLAT_RUN] = -11
+    mint[320] = maxt[320] + 5
+    maxt[50], mint[51], precip[52] = -9999, -9999, -9999
+    lines = [f'{d}\t{x:5d}\t{n:5d}\t{p:5d}\n' for d, x, n, p in zip(dates, maxt, mint, precip)]
+    lines.insert(251, lines[250])
+    path.write_text(''.join(lines))
+    return path
+
+
+def chunked_qc(file):
+    """
+    QC a file chunk by chunk as the ingest pipeline does; later rows for a
+    date replace earlier ones, as the upserts do
+    """
+    written = {}
+    tail = None
+    for data, _ in read_chunks(file):
+        rows, tail = qc_with_context(read_station_file(io.BytesIO(data)), tail)
+        for row in rows.itertuples(index=False):
+            written[row.Date] = row
+    return pd.DataFrame(list(written.values())).sort_values('Date').reset_index(drop=True)
+
+
+@pytest.mark.parametrize('chunk_bytes', [64, 250, 1000, 4096, 1 << 20])
+def test_chunked_qc_matches_whole_file(tmp_path, monkeypatch, chunk_bytes):
+    file = write_station_file(tmp_path / 'USC00000001.txt')
+    monkeypatch.setattr(wxdata_ingest, 'CHUNK_BYTES', chunk_bytes)
+
+    whole = qc_station_data(read_station_file(str(file))).reset_index(drop=True)
+    chunked = chunked_qc(str(file))
+
+    assert whole['QCFlags'].astype(bool).sum() > 10 #the file exercises the checks
+    pd.testing.assert_frame_equal(chunked[whole.columns], whole, check_dtype=False)
+
+
+def test_watch_sees_files_written_during_first_pass(tmp_path, monkeypatch):
+    write_station_file(tmp_path / 'USC00000001.txt')
+    batches = []
+
+    def fake_ingest(conn, files, timer, logger, state=None):
+        batches.append([os.path.basename(file) for file in files])
+        if len(batches) == 1:
+            #a new file and a rewrite arrive while the first pass runs
+            write_station_file(tmp_path / 'USC00000002.txt')
+            write_station_file(tmp_path / 'USC00000001.txt', seed=1)
+            return Counter(), 0, False
+        raise KeyboardInterrupt
+
+    def bounded_next_batch(watcher, timeout_s):
+        #stop a watch that does not see the files instead of waiting forever
+        waits.append(timeout_s)
+        if len(waits) > 3:
+            raise KeyboardInterrupt
+        return next_batch(watcher, timeout_s)
+
+    waits = []
+    monkeypatch.setattr(wxdata_ingest, 'ingest_files', fake_ingest)
+    monkeypatch.setattr(wxdata_ingest, 'next_batch', bounded_next_batch)
+    monkeypatch.setattr(wxdata_ingest, 'WATCH_TIMEOUT_S', 1.)
+    args = argparse.Namespace(data_dir=str(tmp_path), poll=True, poll_s=0.05)
+    wxdata_ingest.watch(None, args, wxdata_ingest.StageTimer())
+
+    assert batches == [['USC00000001.txt'], ['USC00000001.txt', 'USC00000002.txt']]
+
+
+def test_stats_items_leave_out_ingest_stages(monkeypatch, caplog):
+    import wxstats_ingest
+
+    def fake_update_station_stats(conn, dirty, timer, logger):
+        for stn in dirty:
+            with timer.stage('query'):
+                pass
+            timer.log_item(logger, stn, 1)
+
+    monkeypatch.setattr(wxstats_ingest, 'update_station_stats', fake_update_station_stats)
+    monkeypatch.setattr(wxdata_ingest, 'get_dirty_station_years',
+                        lambda conn, logger, job: (2, {'USC00000001': [2003]}))
+    monkeypatch.setattr(wxdata_ingest, 'set_job_version', lambda conn, logger, job, version: None)
+    logger = logging.getLogger('test_wxdata_ingest')
+    timer = wxdata_ingest.StageTimer()
+    #left over from an ingest batch after its last file
+    with timer.stage('wait'):
+        pass
+    with timer.stage('regional'):
+        pass
+
+    with caplog.at_level(logging.INFO, logger='test_wxdata_ingest'):
+        wxdata_ingest.update_stats(None, timer, logger)
+
+    item = [record.getMessage() for record in caplog.records
+            if record.getMessage().startswith('USC00000001:')]
+    assert item == ['USC00000001: query 0.000s, 1 rows']
+    assert {'wait', 'regional', 'stats', 'query'} <= set(timer.totals)
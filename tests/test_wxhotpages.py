@@ -0,0 +1,60 @@
+import time
+
+from wxhotpages import HotPages
+
+
+class FakeConnection:
+    """
+    Connection whose cursor returns the current row of VERSION_SQL
+    """
+
+    def __init__(self, versions):
+        self.versions = versions
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql):
+        pass
+
+    def fetchone(self):
+        return self.versions[-1]
+
+    def close(self):
+        pass
+
+
+def refresh_and_wait(pages):
+    pages.checked = None
+    pages.refresh()
+    while pages.building:
+        time.sleep(0.01)
+
+
+def test_rebuild_only_when_versions_change():
+    versions = [(3, ['stats:3', 'yield_features:3'])]
+    renders = []
+
+    def render(key):
+        renders.append(key)
+        return 200, 'application/json', b'{}'
+
+    pages = HotPages(lambda: FakeConnection(versions), render, seeds=lambda: ['/api/weather/trends'])
+    refresh_and_wait(pages)
+    assert renders == ['/api/weather/trends']
+
+    #a job run that processed nothing new leaves the versions as they are
+    versions.append((3, ['stats:3', 'yield_features:3']))
+    refresh_and_wait(pages)
+    assert renders == ['/api/weather/trends']
+
+    versions.append((3, ['corn_yield:1', 'stats:3', 'yield_features:3']))
+    refresh_and_wait(pages)
+    assert renders == ['/api/weather/trends']*2
+    assert '/api/weather/trends' in pages.pages
@@ -0,0 +1,70 @@
+import numpy as np
+
+from wxqc import (qc_flags, QC_RANGE_MAXT, QC_RANGE_MINT, QC_RANGE_PRECIP, QC_MIN_GT_MAX,
+                  QC_SPIKE_MAXT, QC_SPIKE_MINT, QC_FLAT_MAXT, QC_DUP_DATE, FLAT_RUN)
+
+
+def clean_series(ndays=60, seed=0):
+    """
+    Daily dates and plausible, varying max/min temperature and precipitation
+    """
+    rng = np.random.default_rng(seed)
+    dates = np.datetime64('2001-01-01') + np.arange(ndays)
+    maxt = 10. + rng.normal(0., 3., ndays).round(1)
+    mint = maxt - 8. - rng.uniform(0., 2., ndays).round(1)
+    precip = rng.gamma(0.5, 4., ndays).round(1)
+    return dates, maxt, mint, precip
+
+
+def test_clean_series_not_flagged():
+    dates, maxt, mint, precip = clean_series()
+    assert not qc_flags(dates, maxt, mint, precip).any()
+
+
+def test_range_outliers():
+    dates, maxt, mint, precip = clean_series()
+    maxt[5], mint[10], precip[15], precip[20] = 75., -80., 1500., -1.
+    flags = qc_flags(dates, maxt, mint, precip)
+    assert np.flatnonzero(flags & QC_RANGE_MAXT).tolist() == [5]
+    assert np.flatnonzero(flags & QC_RANGE_MINT).tolist() == [10]
+    assert np.flatnonzero(flags & QC_RANGE_PRECIP).tolist() == [15, 20]
+
+
+def test_min_greater_than_max():
+    dates, maxt, mint, precip = clean_series()
+    mint[7] = maxt[7] + 1.
+    flags = qc_flags(dates, maxt, mint, precip)
+    assert np.flatnonzero(flags & QC_MIN_GT_MAX).tolist() == [7]
+
+
+def test_spikes():
+    dates, maxt, mint, precip = clean_series()
+    maxt[20] += 30.
+    mint[30] -= 30.
+    flags = qc_flags(dates, maxt, mint, precip)
+    assert np.flatnonzero(flags & QC_SPIKE_MAXT).tolist() == [20]
+    assert np.flatnonzero(flags & QC_SPIKE_MINT).tolist() == [30]
+
+
+def test_spike_needs_consecutive_days():
+    dates, maxt, mint, precip = clean_series()
+    maxt[20] += 30.
+    #a gap before the jump: not a spike
+    keep = np.arange(len(dates)) != 19
+    flags = qc_flags(dates[keep], maxt[keep], mint[keep], precip[keep])
+    assert not (flags & QC_SPIKE_MAXT).any()
+
+
+def test_flat_runs():
+    dates, maxt, mint, precip = clean_series()
+    maxt[10:10 + FLAT_RUN] = 12.3
+    maxt[40:40 + FLAT_RUN - 1] = 15.
+    flags = qc_flags(dates, maxt, mint, np.zeros(len(dates)))
+    assert np.flatnonzero(flags & QC_FLAT_MAXT).tolist() == list(range(10, 10 + FLAT_RUN))
+
+
+def test_duplicate_dates():
+    dates, maxt, mint, precip = clean_series()
+    dates, maxt, mint, precip = [np.insert(a, 3, a[3]) for a in (dates, maxt, mint, precip)]
+    flags = qc_flags(dates, maxt, mint, precip)
+    assert np.flatnonzero(flags & QC_DUP_DATE).tolist() == [3, 4]
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from wxsketch import TDigest, merge_all
+
+QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99, 0.999]
+
+
+@pytest.mark.parametrize('name, values', [
+    ('normal', np.random.default_rng(0).normal(15., 8., 20000)),
+    ('gamma', np.random.default_rng(1).gamma(0.7, 8., 20000)),
+])
+def test_quantiles_match_numpy(name, values):
+    digest = TDigest.from_values(values)
+    exact = np.quantile(values, QUANTILES)
+    #within 2%, or 0.5% of the spread of the data near zero
+    spread = np.quantile(values, 0.999) - np.quantile(values, 0.001)
+    np.testing.assert_allclose(digest.quantile(QUANTILES), exact, rtol=0.02, atol=0.005*spread)
+
+
+def test_merged_tail_of_skewed_data():
+    rng = np.random.default_rng(2)
+    samples = [rng.gamma(0.7, 8., 300) for _ in range(500)]
+    merged = merge_all(TDigest.from_values(sample) for sample in samples)
+    values = np.concatenate(samples)
+    for q in (0.5, 0.95, 0.99, 0.999):
+        assert merged.quantile(q) == pytest.approx(np.quantile(values, q), rel=0.02)
+    assert merged.count == len(values)
+
+
+def test_small_digest_is_exact_at_the_ends():
+    values = np.array([3., 1., 2., np.nan, 5., 4.])
+    digest = TDigest.from_values(values)
+    assert digest.count == 5
+    assert digest.quantile(0.) == 1.
+    assert digest.quantile(1.) == 5.
+    assert digest.quantile(0.5) == pytest.approx(3.)
+
+
+def test_empty_digest():
+    assert np.isnan(TDigest.from_values([np.nan]).quantile(0.5))
+    assert np.isnan(merge_all([]).quantile([0.1, 0.9])).all()
+
+
+def test_serialization_round_trip():
+    digest = TDigest.from_values(np.random.default_rng(3).normal(0., 1., 5000))
+    copy = TDigest.from_bytes(digest.to_bytes())
+    assert copy.count == pytest.approx(digest.count)
+    np.testing.assert_allclose(copy.quantile(QUANTILES), digest.quantile(QUANTILES), rtol=1e-5, atol=1e-5)